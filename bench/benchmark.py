@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+# Offline benchmarks of the CI hot paths, using synthetic repositories
+# (synthrepo.py) and the fake GitHub API (pull-request/fake-github-api.py)
+# instead of production data and live GitHub. Results are written as
+# JSON; all metrics are lower-is-better, either times ('*_seconds', best
+# of --repeat runs) or counts of work done (requests, scans, paths...).
+# With --baseline, metrics worse than in earlier results are reported
+# and the exit status is 1.
+
+import argparse
+import importlib.util
+import json
+import os
+import os.path
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import synthrepo
+
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = {
+    'small': {'categories': 10, 'packages': 500, 'commits': 20,
+              'breakages': 5, 'pulls': 50, 'reports': 10, 'borked': 200},
+    'medium': {'categories': 50, 'packages': 5000, 'commits': 50,
+               'breakages': 10, 'pulls': 500, 'reports': 20,
+               'borked': 2000},
+    'large': {'categories': 150, 'packages': 20000, 'commits': 100,
+              'breakages': 20, 'pulls': 1000, 'reports': 50,
+              'borked': 10000},
+}
+# time differences smaller than that are noise
+MIN_TIME_DELTA = 0.05
+
+SCENARIOS = []
+
+
+def scenario(name):
+    def wrap(f):
+        SCENARIOS.append((name, f))
+        return f
+    return wrap
+
+
+def load_script(path):
+    """Import one of the scripts as a module."""
+    path = os.path.join(SCRIPT_DIR, path)
+    # for their own imports
+    if os.path.dirname(path) not in sys.path:
+        sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(
+            os.path.basename(path)[:-3].replace('-', '_'), path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+class Context(object):
+    def __init__(self, tmp, size, seed):
+        self.tmp = tmp
+        self.size = size
+        self.seed = seed
+        self._repo = None
+        # utils/ is on PYTHONPATH via repo-mirror-ci.conf normally
+        utils = os.path.join(SCRIPT_DIR, 'utils')
+        pythonpath = os.environ.get('PYTHONPATH')
+        self.env = dict(os.environ, SCRIPT_DIR=SCRIPT_DIR,
+                        PYTHONPATH=(utils + ':' + pythonpath if pythonpath
+                                    else utils),
+                        GIT_AUTHOR_NAME='bench',
+                        GIT_AUTHOR_EMAIL='bench@example.org',
+                        GIT_COMMITTER_NAME='bench',
+                        GIT_COMMITTER_EMAIL='bench@example.org')
+        # do not record spans of the benchmarked scripts
+        self.env.pop('SPANS_FILE', None)
+        os.environ.update(self.env)
+        os.environ.pop('SPANS_FILE', None)
+        if utils not in sys.path:
+            sys.path.insert(0, utils)
+
+    def path(self, *parts):
+        return os.path.join(self.tmp, *parts)
+
+    def repo(self):
+        """Return the synthetic repo (in $SYNC_DIR/gentoo)."""
+        if self._repo is None:
+            print('Generating synthetic repository...', file=sys.stderr)
+            self._repo = synthrepo.generate(
+                    self.path('sync', 'gentoo'), self.size['categories'],
+                    self.size['packages'], commits=self.size['commits'],
+                    breakages=self.size['breakages'], seed=self.seed)
+        return self._repo
+
+    def run(self, *args, **kwargs):
+        env = dict(self.env, **kwargs.pop('env', {}))
+        return subprocess.run(args, env=env, check=True, **kwargs)
+
+    def script(self, path, *args, **kwargs):
+        return self.run(sys.executable, os.path.join(SCRIPT_DIR, path),
+                        *args, **kwargs)
+
+    def scratch(self, name):
+        """Return a new empty directory."""
+        path = self.path(name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+
+class FakeAPI(object):
+    """fake-github-api.py running in the background."""
+
+    def __init__(self, pulls):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.url = 'http://127.0.0.1:{}'.format(port)
+        self.proc = subprocess.Popen(
+                [sys.executable,
+                 os.path.join(SCRIPT_DIR, 'pull-request',
+                              'fake-github-api.py'),
+                 '-p', str(port), '-g', str(pulls)],
+                stderr=subprocess.DEVNULL)
+        for i in range(100):
+            try:
+                self.call('GET', '/_stats')
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            self.close()
+            raise RuntimeError('fake GitHub API did not start')
+
+    def call(self, method, path):
+        req = urllib.request.Request(self.url + path, method=method)
+        with urllib.request.urlopen(req) as resp:
+            data = resp.read()
+        return json.loads(data) if data else None
+
+    def stats(self):
+        """Return and reset request statistics."""
+        st = self.call('GET', '/_stats')
+        self.call('POST', '/_reset')
+        return st
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def github_env(ctx, api, name):
+    d = ctx.scratch(name)
+    token = os.path.join(d, 'token')
+    with open(token, 'w') as f:
+        f.write('bench\n')
+    return {
+        'GITHUB_API_URL': api.url,
+        'GITHUB_TOKEN_FILE': token,
+        'GITHUB_REPO': 'gentoo/gentoo',
+        'GITHUB_USERNAME': 'gentoo-repo-qa-bot',
+        'GENTOO_CI_URI_PREFIX': 'https://qa-reports.example.org/output',
+        'PULL_REQUEST_DB': os.path.join(d, 'pull-requests.sqlite'),
+        'PULL_REQUEST_GITHUB_CACHE': os.path.join(d, 'github-cache.sqlite'),
+        'PULL_REQUEST_DIR': d,
+    }
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+@scenario('scan-pull-requests')
+def bench_scan(ctx):
+    """Scan N open PRs, with empty and warm state and ETag caches."""
+    with FakeAPI(ctx.size['pulls']) as api:
+        env = github_env(ctx, api, 'scan')
+        ret = {}
+        for run in ('cold', 'warm'):
+            ret[run + '_seconds'] = timed(lambda: ctx.script(
+                'pull-request/scan-pull-requests.py', env=env,
+                stderr=subprocess.DEVNULL))
+            st = api.stats()
+            ret[run + '_requests'] = st['total']
+            ret[run + '_full_responses'] = (
+                    st['total'] - sum(st['not_modified'].values()))
+    return ret
+
+
+@scenario('report-pull-request')
+def bench_report(ctx):
+    """Post PR reports, then update them in place."""
+    repo = ctx.repo()
+    pkgs = sorted('{}/{}'.format(c, p) for c, p in repo.packages)
+    borked = pkgs[:ctx.size['borked']]
+    d = ctx.scratch('report-lists')
+    lists = {}
+    for name, items in (('borked', borked),
+                        ('pre', borked[::2]),
+                        ('fewer', borked[:len(borked) // 10]),
+                        ('empty', [])):
+        lists[name] = os.path.join(d, name)
+        with open(lists[name], 'w') as f:
+            f.writelines(p + '\n' for p in items)
+
+    with FakeAPI(ctx.size['pulls']) as api:
+        env = github_env(ctx, api, 'report')
+        os.environ.update(env)
+        ghapi = load_script('pull-request/ghapi.py')
+        prstate = load_script('pull-request/prstate.py')
+        reporter = load_script('pull-request/report-pull-request.py')
+        heads = dict((pr['number'], pr['head'])
+                     for pr in api.call('GET', '/_state')['pulls'])
+        prids = sorted(heads)[:ctx.size['reports']]
+
+        client = ghapi.open_client()
+        state = prstate.open_db()
+        ret = {}
+        try:
+            for run, borked_list in (('create', 'borked'),
+                                     ('update', 'fewer'),
+                                     ('fixed', 'empty')):
+                api.stats()
+                ret[run + '_seconds'] = timed(lambda: [
+                    reporter.report(client, state, prid, '0123abc',
+                                    lists[borked_list], lists['pre'],
+                                    heads[prid])
+                    for prid in prids])
+                ret[run + '_requests'] = api.stats()['total']
+        finally:
+            state.close()
+            client.close()
+    return ret
+
+
+@scenario('report-borked')
+def bench_blame(ctx):
+    """Compare result lists and update blame, as report-borked.bash."""
+    repo = ctx.repo()
+    pkgs = sorted('{}/{}'.format(c, p) for c, p in repo.packages)
+    n = ctx.size['borked']
+    ci = ctx.scratch('gentoo-ci')
+    lists = {
+        'borked.last': pkgs[:n],
+        'borked.list': pkgs[n // 10:n + n // 10],
+        'warning.last': pkgs[-n:],
+        'warning.list': pkgs[-n:-n // 10],
+    }
+    for name, items in lists.items():
+        with open(os.path.join(ci, name), 'w') as f:
+            f.writelines(p + '\n' for p in items)
+
+    # blame the newly broken packages on commits from the history
+    new = pkgs[n:n + n // 10]
+    bisect_out = os.path.join(ci, 'bisect')
+    with open(bisect_out, 'w') as f:
+        for i, p in enumerate(new):
+            f.write('e {} {}\n'.format(p, repo.commits[
+                1 + i % (len(repo.commits) - 1)]))
+    env = {'GENTOO_CI_GIT': ci, 'SYNC_DIR': ctx.path('sync')}
+
+    ret = {}
+    out = []
+    ret['diff_seconds'] = timed(lambda: out.append(ctx.script(
+        'gentoo-ci/blame.py', 'diff',
+        '-e', os.path.join(ci, 'borked.last'),
+        os.path.join(ci, 'borked.list'),
+        '-w', os.path.join(ci, 'warning.last'),
+        os.path.join(ci, 'warning.list'),
+        env=env, stdout=subprocess.PIPE)))
+    fixed = [l.split()[2] for l in out[0].stdout.decode().splitlines()
+             if l.startswith('e fixed ')]
+    ret['update_seconds'] = timed(lambda: ctx.script(
+        'gentoo-ci/blame.py', 'update', '--bisect', bisect_out,
+        '--skip', repo.commits[0], '--fixed-errors', *fixed,
+        env=env, stdout=subprocess.DEVNULL))
+    # and fix them again
+    ret['fix_seconds'] = timed(lambda: ctx.script(
+        'gentoo-ci/blame.py', 'update', '--fixed-errors', *new,
+        env=env, stdout=subprocess.DEVNULL))
+    return ret
+
+
+@scenario('bisect')
+def bench_bisect(ctx):
+    """
+    Bisect the injected breakages. pkgcheck is modelled using the known
+    breakages, so this measures the scans bisect-borked.py asks for.
+    """
+    repo = ctx.repo()
+    bisect = load_script('gentoo-ci/bisect-borked.py')
+    index = dict((c, i) for i, c in enumerate(repo.commits))
+    last = len(repo.commits) - 1
+    counts = {'scans': 0, 'packages_scanned': 0}
+
+    class ModelWorktree(object):
+        def scan(self, commit, pkgs, jobs):
+            counts['scans'] += 1
+            counts['packages_scanned'] += len(pkgs)
+            broken = repo.broken_at(index[commit])
+            return tuple(set(p for f, p in broken
+                             if f == flag and p in pkgs)
+                         for flag in 'ew')
+
+    targets = repo.broken_at(last) - repo.broken_at(0)
+    found = {}
+    seconds = timed(lambda: found.update(bisect.bisect(
+        repo.commits, targets, [ModelWorktree() for i in range(4)], 1)))
+    expected = dict(((b['flag'], b['package']), b['index'])
+                    for b in repo.breakages if b['fixed'] is None)
+    return dict(counts, seconds=seconds, mismatches=sum(
+        1 for t in targets if found.get(t) != expected.get(t)))
+
+
+RESULT_XML = '''<result><category>{cat}</category><package>{pn}</package>\
+<version>{ver}</version><class>{cls}</class><msg>{msg}</msg></result>
+'''
+RESULT_CLASSES = ('MissingSlot', 'DeprecatedEapi', 'HttpsAvailable',
+                  'RedundantVersion', 'UnstableOnly', 'VisibleVcsPkg')
+
+
+@scenario('sort-results')
+def bench_sort(ctx):
+    """
+    Sort pkgcheck results and list borked packages in one pass, and
+    check that the lists match pkgcheck2borked.py run on the sorted
+    output separately, as before.
+    """
+    parser_dir = os.environ.get('PKGCHECK_RESULT_PARSER_GIT',
+                                os.path.join(SCRIPT_DIR, 'pkgcheck2html'))
+    parser = os.path.join(parser_dir, 'pkgcheck2borked.py')
+    if not os.path.exists(parser):
+        print('sort-results: pkgcheck2borked.py not found, skipping',
+              file=sys.stderr)
+        return {}
+    excludes = os.path.join(parser_dir, 'excludes.json')
+    pkgcheckxml = load_script('gentoo-ci/pkgcheckxml.py')
+    repo = ctx.repo()
+    rnd = random.Random(ctx.seed)
+    d = ctx.scratch('sort-results')
+    xml = os.path.join(d, 'scan.xml')
+    with open(xml, 'w') as f:
+        f.write(pkgcheckxml.XML_HEADER)
+        for (cat, pn), pkg in sorted(repo.packages.items(),
+                                     key=lambda x: rnd.random()):
+            for i in range(rnd.choice((0, 0, 1, 3))):
+                f.write(RESULT_XML.format(
+                    cat=cat, pn=pn, ver=rnd.choice(pkg['versions']),
+                    cls=rnd.choice(RESULT_CLASSES), msg=i))
+        f.write(pkgcheckxml.XML_FOOTER)
+
+    lists = (('borked', []), ('warning', ['-s', '-w']))
+    ret = {}
+    ret['seconds'] = timed(lambda: ctx.script(
+        'gentoo-ci/sort-results.py', '-o', os.path.join(d, 'output.xml'),
+        '-x', excludes, '-p', parser,
+        *('--list={}:{}'.format(' '.join(opts), os.path.join(d, name))
+          for name, opts in lists),
+        xml))
+    ret['separate_seconds'] = ret['seconds'] + sum(timed(lambda: ctx.run(
+        parser, '-x', excludes, *opts, '-o', os.path.join(d, name + '.old'),
+        os.path.join(d, 'output.xml'))) for name, opts in lists)
+    mismatches = 0
+    for name, opts in lists:
+        with open(os.path.join(d, name)) as f:
+            new = f.read()
+        with open(os.path.join(d, name + '.old')) as f:
+            mismatches += new != f.read()
+    ret['mismatches'] = mismatches
+    return ret
+
+
+def checkout(repo, commit, dest):
+    """Extract the tree of commit into dest."""
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    archive = subprocess.Popen(['git', 'archive', commit], cwd=repo.path,
+                               stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', dest], stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait() != 0:
+        raise subprocess.CalledProcessError(archive.returncode, 'git archive')
+
+
+@scenario('repos-copy')
+def bench_copy(ctx):
+    """Update the $REPOS_DIR copy after sync, as repos.bash does."""
+    repo = ctx.repo()
+    excludes = ['--exclude=.*/', '--exclude=/metadata/md5-cache']
+    ret = {}
+    dest = ctx.path('repos-stage')
+    checkout(repo, repo.commits[0], dest)
+    ret['stage_seconds'] = timed(lambda: ctx.script(
+        'repos/stage-changes.py', *excludes,
+        '--diff', repo.commits[0], repo.commits[-1], repo.path, dest,
+        stderr=subprocess.DEVNULL))
+    if shutil.which('rsync'):
+        dest = ctx.path('repos-rsync')
+        checkout(repo, repo.commits[0], dest)
+        ret['rsync_seconds'] = timed(lambda: ctx.run(
+            'rsync', '-rlpt', '--delete', *excludes,
+            repo.path + '/.', dest))
+    else:
+        print('repos-copy: rsync not found, skipping it', file=sys.stderr)
+    return ret
+
+
+@scenario('repos-merge')
+def bench_merge(ctx):
+    """Merge the synced updates into a mirror with md5-cache."""
+    repo = ctx.repo()
+    mirror_merge = load_script('repos/mirror-merge.py')
+    ret = {}
+    trees = set()
+    for method in ('tree', 'git'):
+        m = ctx.path('mirror-' + method)
+        shutil.rmtree(m, ignore_errors=True)
+        ctx.run('git', 'clone', '-q', '-n', repo.path, m)
+        ctx.run('git', 'checkout', '-q', '-B', 'master', repo.commits[0],
+                cwd=m)
+        repo.write_cache(os.path.join(m, 'metadata', 'md5-cache'))
+        ctx.run('git', 'add', '-A', cwd=m)
+        ctx.run('git', 'commit', '-q', '-m', 'cache', cwd=m)
+        ctx.run('git', 'fetch', '-q', repo.path, '+master:refs/orig/master',
+                cwd=m)
+        if method == 'tree':
+            ret['tree_seconds'] = timed(lambda: mirror_merge.merge(
+                m, 'refs/orig/master', 'master', 'Merge updates'))
+        else:
+            ret['git_merge_seconds'] = timed(lambda: ctx.run(
+                'git', 'merge', '-q', '-s', 'recursive', '-X', 'theirs',
+                '-m', 'Merge updates', 'refs/orig/master', cwd=m))
+        trees.add(subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD^{tree}'], cwd=m))
+    ret['mismatches'] = len(trees) - 1
+    return ret
+
+
+def compare(results, baseline, tolerance):
+    """Return (scenario, metric, baseline, value) for regressions."""
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        base = baseline.get('results', {}).get(name, {})
+        for k, v in sorted(metrics.items()):
+            b = base.get(k)
+            if b is None:
+                continue
+            if k.endswith('seconds'):
+                if v > b * (1 + tolerance) and v - b > MIN_TIME_DELTA:
+                    regressions.append((name, k, b, v))
+            elif v > b:
+                regressions.append((name, k, b, v))
+    return regressions
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Run offline benchmarks of the CI scripts')
+    argp.add_argument('-s', '--scenario', action='append',
+                      choices=[n for n, f in SCENARIOS],
+                      help='Scenario to run (default: all)')
+    argp.add_argument('-S', '--size', choices=sorted(SIZES),
+                      default='small',
+                      help='Synthetic data size (default: small)')
+    argp.add_argument('-r', '--repeat', type=int, default=3,
+                      help='Runs of each scenario, best time is reported '
+                           '(default: 3)')
+    argp.add_argument('--seed', type=int, default=0,
+                      help='Random seed for synthetic data (default: 0)')
+    argp.add_argument('-o', '--output',
+                      help='Write results to file (default: stdout)')
+    argp.add_argument('-b', '--baseline',
+                      help='Compare with results in file')
+    argp.add_argument('-t', '--tolerance', type=float, default=0.25,
+                      help='Allowed relative time increase over baseline '
+                           '(default: 0.25)')
+    argp.add_argument('--keep-dir', action='store_true',
+                      help='Do not remove the temporary directory')
+    args = argp.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='repo-mirror-ci-bench.')
+    results = {}
+    try:
+        ctx = Context(tmp, SIZES[args.size], args.seed)
+        for name, func in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            metrics = {}
+            for i in range(args.repeat):
+                print('Running {} ({}/{})'.format(name, i + 1, args.repeat),
+                      file=sys.stderr)
+                for k, v in func(ctx).items():
+                    if k.endswith('seconds'):
+                        metrics[k] = round(min(v, metrics.get(k, v)), 4)
+                    else:
+                        metrics.setdefault(k, v)
+            results[name] = metrics
+    finally:
+        if args.keep_dir:
+            print('Data left in {}'.format(tmp), file=sys.stderr)
+        else:
+            shutil.rmtree(tmp)
+
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    data = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'commit': commit.stdout.decode().strip() or None,
+            'python': sys.version.split()[0],
+            'size': args.size,
+            'seed': args.seed,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    out = json.dumps(data, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        sys.stdout.write(out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, k, b, v in regressions:
+            print('** {} {}: {} -> {}'.format(name, k, b, v),
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
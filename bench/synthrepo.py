@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# Generate synthetic ebuild repositories for benchmarks: categories,
+# packages with a few versions each, eclasses inherited by them, the
+# md5-cache, and git history of version bumps and eclass changes with
+# breakages injected into some commits. The history and the injected
+# breakages are recorded in .git/synthrepo.json, so that results can
+# be checked against them.
+
+import argparse
+import hashlib
+import json
+import os
+import os.path
+import random
+import subprocess
+import sys
+
+
+MANIFEST = 'synthrepo.json'
+
+EBUILD = '''# Copyright 1999-2024 Gentoo Authors
+# Distributed under the terms of the GNU General Public License v2
+
+EAPI={eapi}
+
+inherit {inherit}
+
+DESCRIPTION="Synthetic package {cat}/{pn}"
+HOMEPAGE="{homepage}"
+SRC_URI="https://example.org/{pn}-{pv}.tar.gz"
+
+LICENSE="MIT"
+{slot}KEYWORDS="~amd64 ~x86"
+'''
+
+METADATA_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE pkgmetadata SYSTEM "https://www.gentoo.org/dtd/metadata.dtd">
+<pkgmetadata>
+\t<maintainer type="person">
+\t\t<email>{maint}@example.org</email>
+\t</maintainer>
+\t<use>
+\t\t<flag name="{pn}-extra">Enable extra features of {pn}</flag>
+\t</use>
+</pkgmetadata>
+'''
+
+ECLASS = '''# Copyright 1999-2024 Gentoo Authors
+# Distributed under the terms of the GNU General Public License v2
+
+# @ECLASS: {name}.eclass
+# @BLURB: synthetic eclass, revision {rev}
+
+{name}_src_configure() {{
+\t:
+}}
+
+EXPORT_FUNCTIONS src_configure
+'''
+
+
+def md5(data):
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+class SyntheticRepo(object):
+    def __init__(self, path, categories=20, packages=2000, versions=2,
+                 eclasses=20, seed=0):
+        self.path = path
+        self.rnd = random.Random(seed)
+        self.eclasses = {'synth-{}'.format(i): 0 for i in range(eclasses)}
+        self.packages = {}
+        for i in range(packages):
+            cat = 'cat-{}'.format(i % categories)
+            pn = 'pkg-{}'.format(i)
+            inherit = sorted(self.rnd.sample(sorted(self.eclasses),
+                                             min(eclasses,
+                                                 self.rnd.choice((0, 1, 1,
+                                                                  2)))))
+            self.packages[(cat, pn)] = {
+                'versions': list(range(1, versions + 1)),
+                'inherit': inherit,
+                'broken': {},
+            }
+        self.commits = []
+        self.breakages = []
+
+    def git(self, *args, **kwargs):
+        return subprocess.check_output(('git',) + args, cwd=self.path,
+                                       **kwargs).decode().strip()
+
+    def write(self, path, data):
+        full = os.path.join(self.path, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'w') as f:
+            f.write(data)
+        return path
+
+    def ebuild(self, cat, pn, ver):
+        pkg = self.packages[(cat, pn)]
+        flag = pkg['broken'].get(ver)
+        return EBUILD.format(
+                eapi=8, cat=cat, pn=pn, pv=ver,
+                inherit=' '.join(pkg['inherit']) or 'synth-base',
+                # errors: no SLOT, warnings: insecure HOMEPAGE
+                slot='' if flag == 'e' else 'SLOT="0"\n',
+                homepage=('http://example.org/' if flag == 'w'
+                          else 'https://example.org/'))
+
+    def ebuild_path(self, cat, pn, ver):
+        return '{}/{}/{}-{}.ebuild'.format(cat, pn, pn, ver)
+
+    def cache_entry(self, cat, pn, ver):
+        pkg = self.packages[(cat, pn)]
+        inherit = pkg['inherit'] or ['synth-base']
+        return ''.join((
+            'DEFINED_PHASES=configure\n',
+            'DESCRIPTION=Synthetic package {}/{}\n'.format(cat, pn),
+            'EAPI=8\n',
+            'HOMEPAGE=https://example.org/\n',
+            'INHERIT={}\n'.format(' '.join(inherit)),
+            'KEYWORDS=~amd64 ~x86\n',
+            'LICENSE=MIT\n',
+            'SLOT=0\n',
+            'SRC_URI=https://example.org/{}-{}.tar.gz\n'.format(pn, ver),
+            '_eclasses_={}\n'.format('\t'.join(
+                '{}\t{}'.format(ec, md5(str(self.eclasses.get(ec, 0))))
+                for ec in inherit)),
+            '_md5_={}\n'.format(md5(self.ebuild(cat, pn, ver))),
+        ))
+
+    def write_cache(self, dest=None, packages=None):
+        """Write md5-cache entries (for all or given packages) to dest."""
+        dest = dest or os.path.join(self.path, 'metadata', 'md5-cache')
+        for cat, pn in packages or self.packages:
+            d = os.path.join(dest, cat)
+            os.makedirs(d, exist_ok=True)
+            for ver in self.packages[(cat, pn)]['versions']:
+                with open(os.path.join(d, '{}-{}'.format(pn, ver)),
+                          'w') as f:
+                    f.write(self.cache_entry(cat, pn, ver))
+
+    def commit(self, message, paths):
+        self.git('add', '-A', '--', *sorted(set(paths)))
+        self.git('commit', '-q', '-m', message)
+        sha = self.git('rev-parse', 'HEAD')
+        self.commits.append(sha)
+        return sha
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.git('init', '-q', '-b', 'master')
+        paths = [
+            self.write('profiles/repo_name', 'gentoo\n'),
+            self.write('profiles/categories', ''.join(
+                c + '\n' for c in sorted(set(c for c, p in self.packages)))),
+            self.write('metadata/layout.conf',
+                       'masters =\nthin-manifests = true\n'
+                       'sign-commits = false\n'),
+            self.write('eclass/synth-base.eclass',
+                       ECLASS.format(name='synth-base', rev=0)),
+        ]
+        for ec in self.eclasses:
+            paths.append(self.write('eclass/{}.eclass'.format(ec),
+                                    ECLASS.format(name=ec, rev=0)))
+        for (cat, pn), pkg in self.packages.items():
+            paths.append(self.write('{}/{}/metadata.xml'.format(cat, pn),
+                                    METADATA_XML.format(
+                                        pn=pn, maint=self.rnd.choice(
+                                            ('alice', 'bob', 'carol')))))
+            for ver in pkg['versions']:
+                paths.append(self.write(self.ebuild_path(cat, pn, ver),
+                                        self.ebuild(cat, pn, ver)))
+        return self.commit('Initial synthetic repository', paths)
+
+    def bump(self, cat, pn):
+        """Add a new version and drop the oldest, return changed paths."""
+        pkg = self.packages[(cat, pn)]
+        new = pkg['versions'][-1] + 1
+        old = pkg['versions'].pop(0)
+        pkg['versions'].append(new)
+        if pkg['broken'].pop(old, None) is not None:
+            for b in self.breakages:
+                if (b['package'] == '{}/{}'.format(cat, pn)
+                        and b['version'] == old):
+                    b['fixed'] = len(self.commits)
+        full = os.path.join(self.path, self.ebuild_path(cat, pn, old))
+        os.unlink(full)
+        return [self.ebuild_path(cat, pn, old),
+                self.write(self.ebuild_path(cat, pn, new),
+                           self.ebuild(cat, pn, new))]
+
+    def history(self, commits, changes=5, breakages=5, eclass_every=10):
+        """
+        Add commits bumping packages (and every eclass_every-th, an
+        eclass). breakages commits break a random package each.
+        """
+        broken_at = set(self.rnd.sample(range(commits),
+                                        min(breakages, commits)))
+        keys = sorted(self.packages)
+        for i in range(commits):
+            paths = []
+            for cat, pn in self.rnd.sample(keys, changes):
+                paths.extend(self.bump(cat, pn))
+            if eclass_every and i % eclass_every == eclass_every - 1:
+                ec = self.rnd.choice(sorted(self.eclasses))
+                self.eclasses[ec] += 1
+                paths.append(self.write('eclass/{}.eclass'.format(ec),
+                             ECLASS.format(name=ec, rev=self.eclasses[ec])))
+            breakage = None
+            if i in broken_at:
+                cat, pn = self.rnd.choice([k for k in keys
+                                           if not self.packages[k]['broken']])
+                pkg = self.packages[(cat, pn)]
+                ver = pkg['versions'][-1]
+                pkg['broken'][ver] = self.rnd.choice('ew')
+                paths.append(self.write(self.ebuild_path(cat, pn, ver),
+                                        self.ebuild(cat, pn, ver)))
+                breakage = {
+                    'flag': pkg['broken'][ver],
+                    'package': '{}/{}'.format(cat, pn),
+                    'version': ver,
+                    'index': len(self.commits),
+                    'fixed': None,
+                }
+            sha = self.commit('Synthetic update {}'.format(i + 1), paths)
+            if breakage is not None:
+                breakage['commit'] = sha
+                self.breakages.append(breakage)
+
+    def broken_at(self, index):
+        """Return (flag, package) pairs broken at commit index."""
+        return set((b['flag'], b['package']) for b in self.breakages
+                   if b['index'] <= index
+                   and (b['fixed'] is None or index < b['fixed']))
+
+    def broken(self):
+        """Return (flag, package) pairs broken at the last commit."""
+        return sorted((flag, '{}/{}'.format(cat, pn))
+                      for (cat, pn), pkg in self.packages.items()
+                      for flag in set(pkg['broken'].values()))
+
+    def save_manifest(self):
+        git_dir = self.git('rev-parse', '--absolute-git-dir')
+        with open(os.path.join(git_dir, MANIFEST), 'w') as f:
+            json.dump({'commits': self.commits,
+                       'breakages': self.breakages,
+                       'broken': self.broken()}, f, indent=1)
+
+
+def generate(path, categories=20, packages=2000, versions=2, eclasses=20,
+             commits=50, changes=5, breakages=5, cache=False, seed=0):
+    """Create a synthetic repository with history, return it."""
+    repo = SyntheticRepo(path, categories, packages, versions, eclasses,
+                         seed)
+    repo.create()
+    repo.history(commits, changes, breakages)
+    if cache:
+        repo.write_cache()
+    repo.save_manifest()
+    return repo
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Generate a synthetic ebuild repository')
+    argp.add_argument('-C', '--categories', type=int, default=20,
+                      help='Number of categories (default: 20)')
+    argp.add_argument('-n', '--packages', type=int, default=2000,
+                      help='Number of packages (default: 2000)')
+    argp.add_argument('-V', '--versions', type=int, default=2,
+                      help='Versions per package (default: 2)')
+    argp.add_argument('-e', '--eclasses', type=int, default=20,
+                      help='Number of eclasses (default: 20)')
+    argp.add_argument('-c', '--commits', type=int, default=50,
+                      help='Number of commits after the initial one '
+                           '(default: 50)')
+    argp.add_argument('--changes', type=int, default=5,
+                      help='Packages bumped per commit (default: 5)')
+    argp.add_argument('-b', '--breakages', type=int, default=5,
+                      help='Number of commits breaking a package '
+                           '(default: 5)')
+    argp.add_argument('--cache', action='store_true',
+                      help='Write metadata/md5-cache (not committed)')
+    argp.add_argument('-s', '--seed', type=int, default=0,
+                      help='Random seed (default: 0)')
+    argp.add_argument('path', help='Directory to create the repository in')
+    args = argp.parse_args()
+
+    repo = generate(args.path, args.categories, args.packages, args.versions,
+                    args.eclasses, args.commits, args.changes,
+                    args.breakages, args.cache, args.seed)
+    print('{}: {} packages, {} commits, {} broken'.format(
+        args.path, len(repo.packages), len(repo.commits),
+        len(repo.broken())), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
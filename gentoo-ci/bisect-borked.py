@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# Find commits introducing new breakages and warnings. All packages
+# are bisected together: in every round, pkgcheck is run on a few probe
+# commits in parallel (each in its own worktree) and every result is
+# used to narrow down the commit range of all packages scanned.
+#
+# Prints '<flag> <package> <commit>' for every package, where flag is
+# 'e' for errors and 'w' for warnings.
+
+import argparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+import resultstore
+
+
+class Worktree(object):
+    def __init__(self, repo, path, commit):
+        self.path = os.path.join(path, 'tree')
+        self.home = os.path.join(path, 'home')
+
+        subprocess.check_call(['git', 'worktree', 'add', '-q', '--detach',
+                               self.path, commit], cwd=repo)
+        # pkgcheck picks the repo up from the user config
+        conf_dir = os.path.join(self.home, '.config', 'pkgcore')
+        os.makedirs(conf_dir)
+        with open(os.path.join(os.environ['SCRIPT_DIR'], 'gentoo-ci',
+                               'pkgcore.conf.in')) as f:
+            conf = f.read().replace('@path@', self.path)
+        with open(os.path.join(conf_dir, 'pkgcore.conf'), 'w') as f:
+            f.write(conf)
+
+    def scan(self, commit, pkgs, jobs):
+        """Return (borked, warning) package sets at commit."""
+        subprocess.check_call(['git', 'checkout', '-q', '--detach', commit],
+                              cwd=self.path)
+
+        xml = os.path.join(self.home, 'output.xml')
+        env = dict(os.environ, HOME=self.home)
+        with open(xml, 'wb') as f:
+            # pkgcheck exit status depends on results found
+            subprocess.call(
+                    ['pkgcheck', '--config', os.environ['CONFIG_DIR'],
+                     'scan', '--reporter', 'XmlReporter']
+                    + sorted(pkgs)
+                    + ['--glsa-dir', os.path.join(os.environ['MIRROR_DIR'],
+                                                  'gentoo', 'metadata',
+                                                  'glsa'),
+                       '--jobs', str(jobs)]
+                    + os.environ.get('PKGCHECK_BISECT_OPTIONS', '').split(),
+                    cwd=self.path, env=env, stdout=f)
+
+        parser = os.path.join(os.environ['PKGCHECK_RESULT_PARSER_GIT'],
+                              'pkgcheck2borked.py')
+        excludes = os.path.join(os.environ['PKGCHECK_RESULT_PARSER_GIT'],
+                                'excludes.json')
+        ret = []
+        for name, opts in (('borked', []), ('warning', ['-s', '-w'])):
+            out = os.path.join(self.home, name + '.list')
+            subprocess.check_call([parser, '-x', excludes] + opts
+                                  + ['-o', out, xml])
+            with open(out) as f:
+                ret.append(set(l.strip() for l in f if l.strip()))
+        return tuple(ret)
+
+
+def pick_probes(ranges, count):
+    """
+    Pick up to count commit indexes splitting the ranges. ranges maps
+    (good, bad) index pairs to the number of packages in them.
+    """
+    alloc = dict.fromkeys(ranges, 0)
+    for i in range(count):
+        best = None
+        best_score = 0
+        for (lo, hi), npkgs in ranges.items():
+            k = alloc[(lo, hi)]
+            if hi - lo - 1 <= k:
+                continue
+            # remaining range width saved by another probe
+            score = npkgs * (hi - lo) / (k + 1) / (k + 2)
+            if score > best_score:
+                best = (lo, hi)
+                best_score = score
+        if best is None:
+            break
+        alloc[best] += 1
+
+    probes = set()
+    for (lo, hi), k in alloc.items():
+        for j in range(1, k + 1):
+            probes.add(lo + (hi - lo) * j // (k + 1))
+    return sorted(probes)
+
+
+def bisect(commits, targets, worktrees, jobs, store=None):
+    """
+    Bisect (flag, pkg) targets over commits, assuming all of them
+    are fine at the first and broken at the last commit. Returns
+    a dict mapping targets to the index of the first broken commit.
+
+    If store is specified, results already stored for probe commits
+    are reused and new results are added to it.
+    """
+    if store is not None:
+        key = resultstore.scan_key(
+                os.environ.get('PKGCHECK_BISECT_OPTIONS', '').split())
+    bounds = dict((t, [0, len(commits) - 1]) for t in targets)
+
+    with ThreadPoolExecutor(len(worktrees)) as executor:
+        while True:
+            ranges = {}
+            for lo, hi in bounds.values():
+                if hi - lo > 1:
+                    ranges[(lo, hi)] = ranges.get((lo, hi), 0) + 1
+            if not ranges:
+                break
+
+            probes = pick_probes(ranges, len(worktrees))
+            scans = []
+            for wt, idx in zip(worktrees, probes):
+                pkgs = set(pkg for (flag, pkg), (lo, hi) in bounds.items()
+                           if lo < idx < hi)
+                known = {}
+                if store is not None:
+                    known = store.lookup(key, commits[idx], pkgs)
+                    pkgs.difference_update(known)
+                res = None
+                if pkgs:
+                    print('Scanning {} packages at {}'.format(
+                        len(pkgs), commits[idx]), file=sys.stderr)
+                    res = executor.submit(wt.scan, commits[idx], pkgs, jobs)
+                scans.append((idx, pkgs, known, res))
+
+            for idx, pkgs, known, res in scans:
+                if res is not None:
+                    borked, warning = res.result()
+                    results = dict((pkg, set()) for pkg in pkgs)
+                    for flag, found in (('e', borked), ('w', warning)):
+                        for pkg in found:
+                            results.setdefault(pkg, set()).add(flag)
+                    if store is not None:
+                        store.store(key, commits[idx], results)
+                    known.update(results)
+
+                for (flag, pkg), b in bounds.items():
+                    if not b[0] < idx < b[1]:
+                        continue
+                    if flag in known.get(pkg, ''):
+                        b[1] = idx
+                    else:
+                        b[0] = idx
+
+    return dict((t, hi) for t, (lo, hi) in bounds.items())
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Find commits introducing breakages')
+    argp.add_argument('-j', '--workers', type=int,
+                      default=int(os.environ.get(
+                          'GENTOO_CI_BISECT_WORKERS', 4)),
+                      help='Number of commits scanned in parallel')
+    argp.add_argument('-e', '--errors', nargs='*', default=[],
+                      help='Packages with new errors')
+    argp.add_argument('-w', '--warnings', nargs='*', default=[],
+                      help='Packages with new warnings')
+    argp.add_argument('good', help='Last commit known to be good')
+    argp.add_argument('bad', help='Commit with the breakages')
+    args = argp.parse_args()
+
+    repo = os.path.join(os.environ['SYNC_DIR'], 'gentoo')
+    commits = subprocess.check_output(
+            ['git', 'rev-list', '--first-parent', '--reverse',
+             '{}..{}'.format(args.good, args.bad)],
+            cwd=repo).decode().split()
+    commits.insert(0, subprocess.check_output(
+            ['git', 'rev-parse', args.good], cwd=repo).decode().strip())
+
+    targets = ([('e', p) for p in args.errors]
+               + [('w', p) for p in args.warnings])
+    if not targets or len(commits) < 2:
+        return 0
+
+    workers = min(args.workers, len(commits) - 2) or 1
+    jobs = max((os.cpu_count() or 1) // workers, 1)
+    tmp = tempfile.mkdtemp(prefix='bisect-',
+                           dir=os.environ.get('BISECT_TMP'))
+    store = resultstore.open_store()
+    worktrees = []
+    try:
+        for i in range(workers):
+            worktrees.append(Worktree(repo, os.path.join(tmp, str(i)),
+                                      commits[0]))
+        found = bisect(commits, targets, worktrees, jobs, store)
+    finally:
+        if store is not None:
+            store.close()
+        for wt in worktrees:
+            subprocess.call(['git', 'worktree', 'remove', '--force',
+                             wt.path], cwd=repo)
+        subprocess.call(['git', 'worktree', 'prune'], cwd=repo)
+        shutil.rmtree(tmp)
+
+    for flag, pkg in targets:
+        commit = subprocess.check_output(
+                ['git', 'rev-parse', '--short',
+                 commits[found[(flag, pkg)]]], cwd=repo).decode().strip()
+        print('{} {} {}'.format(flag, pkg, commit))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
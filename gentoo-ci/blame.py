@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# Breakage blame database (SQLite) for report-borked.bash: which commit
+# broke which package, and who to CC when it gets fixed.
+
+import argparse
+import contextlib
+import os
+import os.path
+import sqlite3
+import subprocess
+import sys
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blame (
+    package TEXT NOT NULL,
+    -- 'e' for errors, 'w' for warnings
+    flag TEXT NOT NULL,
+    commit_id TEXT NOT NULL,
+    author TEXT,
+    committer TEXT,
+    first_seen REAL NOT NULL,
+    PRIMARY KEY (package, flag)
+);
+'''
+
+
+class BlameDB(object):
+    def __init__(self, path, git_dir):
+        self.git_dir = git_dir
+        self.people = {}
+        self.conn = sqlite3.connect(path, timeout=300,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self.conn.execute('COMMIT')
+
+    def commit_people(self, commit):
+        """Return (author, committer) e-mails for commit."""
+        if commit not in self.people:
+            out = subprocess.check_output(
+                    ['git', 'log', '--pretty=%ae %ce', '-1', commit],
+                    cwd=self.git_dir).decode()
+            self.people[commit] = tuple(out.split())
+        return self.people[commit]
+
+    def record(self, package, flag, commit):
+        author, committer = self.commit_people(commit)
+        self.conn.execute('''
+            INSERT INTO blame (package, flag, commit_id, author,
+                committer, first_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (package, flag) DO UPDATE SET
+                commit_id = excluded.commit_id, author = excluded.author,
+                committer = excluded.committer''',
+            (package, flag, commit, author, committer, time.time()))
+        return author, committer
+
+    def remove(self, package, flag):
+        """Remove blame for package, return (author, committer) or None."""
+        row = self.conn.execute('''
+            SELECT author, committer FROM blame
+            WHERE package = ? AND flag = ?''', (package, flag)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute('DELETE FROM blame WHERE package = ? AND flag = ?',
+                          (package, flag))
+        return tuple(row)
+
+    def import_files(self, prefix):
+        """Import old '<prefix>.{e,w}' files with 'package commit' lines."""
+        count = 0
+        with self.transaction():
+            for flag in ('e', 'w'):
+                try:
+                    f = open('{}.{}'.format(prefix, flag))
+                except (IOError, OSError):
+                    continue
+                with f:
+                    for l in f:
+                        l = l.split()
+                        if len(l) == 2:
+                            self.record(l[0], flag, l[1])
+                            count += 1
+        return count
+
+
+def read_list(path):
+    try:
+        with open(path) as f:
+            return set(l.strip() for l in f if l.strip())
+    except (IOError, OSError):
+        return set()
+
+
+def cmd_diff(db, args):
+    """
+    Print fixed, old and new packages for error and warning lists,
+    as '<flag> <type> <package>' lines.
+    """
+    for flag, paths in (('e', args.errors), ('w', args.warnings)):
+        if paths is None:
+            continue
+        old = read_list(paths[0])
+        new = read_list(paths[1])
+        for t, pkgs in (('fixed', old - new), ('old', old & new),
+                        ('new', new - old)):
+            for pkg in sorted(pkgs):
+                print('{} {} {}'.format(flag, t, pkg))
+
+
+def cmd_update(db, args):
+    """
+    Record blame from bisect-borked.py output and drop blame for fixed
+    packages. Print broken commits and people to CC, as 'commit <id>'
+    and 'cc <e-mail>' lines.
+    """
+    commits = []
+    cc = []
+
+    def add_cc(people):
+        for p in people:
+            if p not in cc:
+                cc.append(p)
+
+    with db.transaction():
+        if args.bisect is not None:
+            with open(args.bisect) as f:
+                for l in f:
+                    flag, pkg, commit = l.split()
+                    # skip breakages introduced before the commit set
+                    if args.skip and args.skip.startswith(commit):
+                        continue
+                    people = db.record(pkg, flag, commit)
+                    if commit not in commits:
+                        commits.append(commit)
+                        add_cc(people)
+
+        # CC people whose breakages have been fixed
+        for flag, pkgs in (('e', args.fixed_errors),
+                           ('w', args.fixed_warnings)):
+            for pkg in pkgs:
+                people = db.remove(pkg, flag)
+                if people is not None:
+                    add_cc(people)
+
+    for c in commits:
+        print('commit {}'.format(c))
+    for p in cc:
+        print('cc {}'.format(p))
+
+
+def cmd_show(db, args):
+    q = 'SELECT * FROM blame'
+    params = ()
+    if args.packages:
+        q += ' WHERE package IN ({})'.format(
+                ','.join('?' * len(args.packages)))
+        params = args.packages
+    for row in db.conn.execute(q + ' ORDER BY package, flag', params):
+        print('{} {} {} {} {}'.format(row[0], row[1], row[2], row[3],
+                                      row[4]))
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Manage the breakage blame database')
+    argp.add_argument('-d', '--db',
+                      default=os.path.join(os.environ.get('GENTOO_CI_GIT',
+                                                          '.'),
+                                           'blame.sqlite'),
+                      help='Database path (default: '
+                           '$GENTOO_CI_GIT/blame.sqlite)')
+    argp.add_argument('--import-prefix',
+                      help='Import old blame files if database is new '
+                           '(e.g. $GENTOO_CI_GIT/blame)')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('diff', help='Compare old and new package lists')
+    p.add_argument('-e', '--errors', nargs=2, metavar=('OLD', 'NEW'),
+                   help='Lists of packages with errors')
+    p.add_argument('-w', '--warnings', nargs=2, metavar=('OLD', 'NEW'),
+                   help='Lists of packages with warnings')
+    p.set_defaults(func=cmd_diff)
+    p = subp.add_parser('update', help='Update blame, print CC list')
+    p.add_argument('--bisect', help='bisect-borked.py output')
+    p.add_argument('--skip', help='Ignore breakages blamed on this commit')
+    p.add_argument('-e', '--fixed-errors', nargs='*', default=[],
+                   help='Packages with errors fixed')
+    p.add_argument('-w', '--fixed-warnings', nargs='*', default=[],
+                   help='Packages with warnings fixed')
+    p.set_defaults(func=cmd_update)
+    p = subp.add_parser('show', help='Print blame')
+    p.add_argument('packages', nargs='*')
+    p.set_defaults(func=cmd_show)
+
+    args = argp.parse_args()
+    if args.command == 'diff':
+        return args.func(None, args)
+    is_new = not os.path.exists(args.db)
+    db = BlameDB(args.db, os.path.join(os.environ['SYNC_DIR'], 'gentoo'))
+    try:
+        if is_new and args.import_prefix:
+            db.import_files(args.import_prefix)
+        return args.func(db, args)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,15 @@
 
 set -e -x
 
+. "${SCRIPT_DIR}"/utils/spans.bash
+
 # SANITY!
 export TZ=UTC
 
 cd -- "${SYNC_DIR}"/gentoo
 touch -r "${MIRROR_DIR}"/gentoo/metadata/timestamp.chk .git/timestamp
 CURRENT_COMMIT=$(git rev-parse --short HEAD)
+CURRENT_HASH=$(git rev-parse HEAD)
 cd -- "${GENTOO_CI_GIT}"
 if [[ -f .last-commit ]]; then
 	PREV_COMMIT=$(<.last-commit)
@@ -26,24 +29,67 @@ if [[ ${PREV_COMMIT} != ${CURRENT_COMMIT} ]]; then
 	fi
 
 	export CONFIG_DIR=${CONFIG_ROOT_GENTOO_CI}/etc/portage
-	( cd -- "${MIRROR_DIR}"/gentoo &&
-		time timeout -k 30s "${CI_TIMEOUT}" pkgcheck --config "${CONFIG_DIR}" scan \
-			--reporter XmlReporter ${PKGCHECK_OPTIONS}
-	) | xsltproc "${SCRIPT_DIR}"/sort-output.xsl - > output.xml
-	# ^^ Sort XML for better Git delta compression
-
-	"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
-		-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
-		-o borked.list *.xml
-	"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
-		-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
-		-s -w -o warning.list *.xml
-
-	git add -- *.xml
+
+	# rescan only packages affected since the last run, unless a full
+	# scan is due (periodically, or when pkgcheck or options change)
+	scan_key=$("${SCRIPT_DIR}"/gentoo-ci/resultstore.py key "${PKGCHECK_OPTIONS}")
+	full_scan=1
+	if [[ ${PREV_COMMIT} && -s output.xml && -f .last-full-scan ]]; then
+		read full_scan_time full_scan_key < .last-full-scan
+		if [[ ${full_scan_key} == ${scan_key} &&
+			$(( $(date +%s) - full_scan_time )) -lt $(( GENTOO_CI_FULL_SCAN_INTERVAL * 3600 )) ]] &&
+			"${SCRIPT_DIR}"/gentoo-ci/incremental-scan.py affected \
+				"${PREV_COMMIT}" "${CURRENT_COMMIT}" > .affected.list
+		then
+			full_scan=
+		fi
+	fi
+
+	if [[ ${full_scan} ]]; then
+		# shards finished before a timeout are reused by the next run
+		time span scan "" timeout -k 30s "${CI_TIMEOUT}" \
+			"${SCRIPT_DIR}"/gentoo-ci/sharded-scan.py \
+			--commit "${CURRENT_HASH}" --options "${PKGCHECK_OPTIONS}" \
+			"${MIRROR_DIR}"/gentoo > .full-scan.xml
+		# sort XML for better Git delta compression, and list breakages
+		span sort "" "${SCRIPT_DIR}"/gentoo-ci/sort-results.py \
+			-o output.xml -i results.jsonl \
+			-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
+			--list=:borked.list --list='-s -w:warning.list' .full-scan.xml
+		echo "$(date +%s) ${scan_key}" > .last-full-scan
+	else
+		# removed packages only have their results dropped
+		pkgs=()
+		while read l; do
+			[[ -d ${MIRROR_DIR}/gentoo/${l} ]] && pkgs+=( "${l}" )
+		done < .affected.list
+		outfiles=()
+		if [[ ${#pkgs[@]} -gt 0 ]]; then
+			( cd -- "${MIRROR_DIR}"/gentoo &&
+				time span scan "" timeout -k 30s "${CI_TIMEOUT}" \
+					pkgcheck --config "${CONFIG_DIR}" scan \
+					--reporter XmlReporter ${PKGCHECK_OPTIONS} \
+					-s pkg,ver "${pkgs[@]}"
+			) > .incremental.xml
+			outfiles+=( .incremental.xml )
+		fi
+		"${SCRIPT_DIR}"/gentoo-ci/incremental-scan.py splice \
+			output.xml .affected.list "${outfiles[@]}" |
+			span sort "" "${SCRIPT_DIR}"/gentoo-ci/sort-results.py \
+			-o output.xml -i results.jsonl \
+			-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
+			--list=:borked.list --list='-s -w:warning.list' -
+	fi
+
+	git add -- *.xml results.jsonl
 	git diff --cached --quiet --exit-code || git commit -a -m "$(date -u --date="@$(cd -- "${SYNC_DIR}"/gentoo; git log --pretty="%ct" -1)" "+%Y-%m-%d %H:%M:%S UTC")"
-	git push
+	# map the scanned commit to the results, for PR baselines
+	git -C "${MIRROR_DIR}"/gentoo notes --ref=gentoo-ci add -f \
+		-m "$(git rev-parse HEAD)" "${CURRENT_HASH}" || :
+	span push "" git push
 	curl "https://qa-reports-cdn-origin.gentoo.org/cgi-bin/trigger-pull.cgi?gentoo-ci" || :
-	"${SCRIPT_DIR}"/gentoo-ci/report-borked.bash "${PREV_COMMIT}" "${CURRENT_COMMIT}"
+	span report "" \
+		"${SCRIPT_DIR}"/gentoo-ci/report-borked.bash "${PREV_COMMIT}" "${CURRENT_COMMIT}"
 	echo "${CURRENT_COMMIT}" > .last-commit
 
 	if [[ ! -s ${GENTOO_CI_GIT}/borked.list ]]; then
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# Support for incremental gentoo-ci scans: find packages whose results
+# could have been changed by commits, and splice results of rescanning
+# them into the previous report.
+
+import argparse
+import os
+import os.path
+import re
+import subprocess
+import sys
+
+import pkgcheckxml
+
+
+# generated or unchecked files, never affect results
+IGNORED_PATHS = (
+    'metadata/dtd/',
+    'metadata/glsa/',
+    'metadata/md5-cache/',
+    'metadata/news/',
+    'metadata/pkg_desc_index',
+    'metadata/timestamp',
+    'metadata/xml-schema/',
+    'profiles/use.local.desc',
+)
+DEPEND_KEYS = ('DEPEND', 'RDEPEND', 'PDEPEND', 'BDEPEND', 'IDEPEND')
+
+ATOM_PREFIX_RE = re.compile(r'^!*[<>=~]*')
+ATOM_SUFFIX_RE = re.compile(r'[:\[].*$')
+VERSION_RE = re.compile(r'-[0-9]+(\.[0-9]+)*[a-z]?'
+                        r'((_alpha|_beta|_pre|_rc|_p)[0-9]*)*'
+                        r'(-r[0-9]+)?\*?$')
+
+
+class FullScanNeeded(Exception):
+    pass
+
+
+def atom_key(token):
+    """Return 'cat/pn' for a dependency atom, or None."""
+    if '/' not in token:
+        return None
+    token = ATOM_PREFIX_RE.sub('', token)
+    token = ATOM_SUFFIX_RE.sub('', token)
+    return VERSION_RE.sub('', token)
+
+
+def git_changes(location, old, new):
+    """Yield paths of files changed between commits."""
+    out = subprocess.check_output(
+            ['git', 'diff', '--name-only', '--no-renames', '-z', old, new],
+            cwd=location)
+    for path in out.split(b'\0'):
+        if path:
+            yield path.decode()
+
+
+def changed_atoms(location, old, new, path):
+    """Return packages in lines added or removed from a package.* file."""
+    out = subprocess.check_output(
+            ['git', 'diff', '-U0', old, new, '--', path],
+            cwd=location).decode('utf8', 'replace')
+    pkgs = set()
+    for l in out.splitlines():
+        if l.startswith(('+++', '---')) or not l.startswith(('+', '-')):
+            continue
+        l = l[1:].split('#', 1)[0].split()
+        if l:
+            key = atom_key(l[0].lstrip('-'))
+            if key is not None:
+                pkgs.add(key)
+    return pkgs
+
+
+def read_cache(cache_dir):
+    """
+    Return (eclass -> consumer packages, package -> reverse dependency
+    packages) mappings from md5-cache.
+    """
+    consumers = {}
+    rdeps = {}
+    for cat in os.scandir(cache_dir):
+        if not cat.is_dir() or cat.name.startswith('.'):
+            continue
+        for e in os.scandir(cat.path):
+            m = VERSION_RE.search(e.name)
+            pkg = cat.name + '/' + (e.name[:m.start()] if m else e.name)
+            with open(e.path, encoding='utf8', errors='replace') as f:
+                for l in f:
+                    key, sep, value = l.rstrip('\n').partition('=')
+                    if key == '_eclasses_':
+                        for ec in value.split('\t')[::2]:
+                            consumers.setdefault(ec, set()).add(pkg)
+                    elif key in DEPEND_KEYS:
+                        for token in value.split():
+                            dep = atom_key(token)
+                            if dep is not None and dep != pkg:
+                                rdeps.setdefault(dep, set()).add(pkg)
+    return consumers, rdeps
+
+
+def find_affected(changes, location, old, new, cache_dir):
+    """Return the set of packages whose results could have changed."""
+    pkgs = set()
+    eclasses = set()
+    for path in changes:
+        if path.startswith(IGNORED_PATHS):
+            continue
+        parts = path.split('/')
+        if len(parts) == 1:
+            # top-level files (README, header.txt...)
+            continue
+        elif parts[0] == 'eclass':
+            if path.endswith('.eclass'):
+                eclasses.add(os.path.basename(path)[:-7])
+            elif len(parts) == 2:
+                raise FullScanNeeded(path)
+        elif parts[0] == 'profiles':
+            # package.mask, package.use.mask... affect the packages
+            # listed (and their reverse dependencies) only
+            if parts[1] != 'updates' and parts[-1].startswith('package.'):
+                pkgs.update(changed_atoms(location, old, new, path))
+            else:
+                raise FullScanNeeded(path)
+        elif parts[0] in ('licenses', 'metadata', 'scripts'):
+            raise FullScanNeeded(path)
+        elif len(parts) < 3:
+            # category metadata.xml
+            raise FullScanNeeded(path)
+        else:
+            pkgs.add(parts[0] + '/' + parts[1])
+
+    consumers, rdeps = read_cache(cache_dir)
+    for ec in eclasses:
+        pkgs.update(consumers.get(ec, ()))
+    # version, keyword and mask changes affect dependency checks
+    # in reverse dependencies
+    for pkg in list(pkgs):
+        pkgs.update(rdeps.get(pkg, ()))
+    return pkgs
+
+
+def cmd_affected(args):
+    try:
+        changes = list(git_changes(args.git_dir, args.old, args.new))
+        cache_dir = os.path.join(args.repo, 'metadata', 'md5-cache')
+        pkgs = find_affected(changes, args.git_dir, args.old, args.new,
+                             cache_dir)
+        if len(pkgs) > args.max:
+            raise FullScanNeeded('{} packages affected'.format(len(pkgs)))
+    except (FullScanNeeded, subprocess.CalledProcessError) as e:
+        print('Full scan needed: {}'.format(e), file=sys.stderr)
+        return 2
+
+    for pkg in sorted(pkgs):
+        print(pkg)
+    return 0
+
+
+def cmd_splice(args):
+    with open(args.packages) as f:
+        pkgs = set(l.strip() for l in f if l.strip())
+
+    out = sys.stdout
+    out.write(pkgcheckxml.XML_HEADER)
+    kept = 0
+    with open(args.old, 'rb') as f:
+        for r in pkgcheckxml.iter_results(f):
+            if pkgcheckxml.result_package(r) not in pkgs:
+                pkgcheckxml.write_result(out, r)
+                kept += 1
+    added = 0
+    for path in args.new:
+        with open(path, 'rb') as f:
+            for r in pkgcheckxml.iter_results(f):
+                pkgcheckxml.write_result(out, r)
+                added += 1
+    out.write(pkgcheckxml.XML_FOOTER)
+    print('Kept {} results, added {}'.format(kept, added), file=sys.stderr)
+    return 0
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Incremental pkgcheck scan support')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('affected',
+                        help='Print packages affected by commits '
+                             '(exit status 2 if full scan is needed)')
+    p.add_argument('--git-dir',
+                   default=os.path.join(os.environ.get('SYNC_DIR', ''),
+                                        'gentoo'),
+                   help='Repository to take commits from '
+                        '(default: $SYNC_DIR/gentoo)')
+    p.add_argument('--repo',
+                   default=os.path.join(os.environ.get('MIRROR_DIR', ''),
+                                        'gentoo'),
+                   help='Scanned repository, with md5-cache '
+                        '(default: $MIRROR_DIR/gentoo)')
+    p.add_argument('--max', type=int, default=2000,
+                   help='Do full scan if more packages are affected')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.set_defaults(func=cmd_affected)
+    p = subp.add_parser('splice',
+                        help='Replace results for packages in old report '
+                             'with new results, write XML to stdout')
+    p.add_argument('old', help='Previous report')
+    p.add_argument('packages', help='File listing replaced packages')
+    p.add_argument('new', nargs='*', help='Results of the rescan')
+    p.set_defaults(func=cmd_splice)
+
+    args = argp.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+# Helpers for reading and writing pkgcheck XmlReporter output.
+
+import xml.etree.ElementTree as ET
+
+from xml.sax.saxutils import escape
+
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<checks>\n'
+XML_FOOTER = '</checks>\n'
+
+
+def iter_results(f):
+    """
+    Iterate over <result/> elements in file f, without keeping
+    the whole tree in memory. The elements are dropped afterwards.
+    """
+    root = None
+    for event, elem in ET.iterparse(f, events=('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and elem.tag == 'result':
+            yield elem
+            root.clear()
+
+
+def result_package(elem):
+    """Return 'cat/pn' for a package-level result, or None."""
+    cat = elem.findtext('category')
+    pn = elem.findtext('package')
+    if cat is None or pn is None:
+        return None
+    return cat + '/' + pn
+
+
+def write_result(f, elem):
+    elem.tail = None
+    f.write(ET.tostring(elem, encoding='unicode'))
+    f.write('\n')
+
+
+def format_result(elem):
+    """Format result the way xsltproc indents it."""
+    lines = ['  <result>\n']
+    for child in elem:
+        if child.text:
+            lines.append('    <{0}>{1}</{0}>\n'.format(
+                child.tag, escape(child.text)))
+        else:
+            lines.append('    <{}/>\n'.format(child.tag))
+    lines.append('  </result>\n')
+    return ''.join(lines)
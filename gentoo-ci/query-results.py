@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# Query compact pkgcheck results (results.jsonl written by
+# sort-results.py), either from a file or from a git revision.
+#
+# Packages are looked up by bisection over the sorted lines, and two
+# result sets are compared by merging them line by line, so neither
+# requires parsing the whole report.
+
+import argparse
+import json
+import mmap
+import os
+import os.path
+import subprocess
+import sys
+
+
+def git_blob_args(args, rev):
+    return (['git', 'cat-file', 'blob', '{}:{}'.format(rev, args.file)],
+            args.git_dir)
+
+
+def load_buffer(args, rev=None):
+    """Return results as a bytes-like object."""
+    if rev is not None:
+        cmd, cwd = git_blob_args(args, rev)
+        return subprocess.check_output(cmd, cwd=cwd)
+    with open(args.file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_lines(args, rev=None):
+    """Iterate over result lines without loading all of them."""
+    if rev is not None:
+        cmd, cwd = git_blob_args(args, rev)
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE)
+        yield from p.stdout
+        p.stdout.close()
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+    else:
+        with open(args.file, 'rb') as f:
+            yield from f
+
+
+def lower_bound(buf, key):
+    """Return offset of the first line not less than key."""
+    lo = 0
+    hi = len(buf)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        nl = buf.rfind(b'\n', lo, mid)
+        start = lo if nl < 0 else nl + 1
+        end = buf.find(b'\n', start)
+        end = len(buf) if end < 0 else end + 1
+        if buf[start:end] < key:
+            lo = end
+        else:
+            hi = start
+    return lo
+
+
+def find(buf, prefix):
+    """Yield result lines starting with prefix."""
+    pos = lower_bound(buf, prefix)
+    while pos < len(buf):
+        end = buf.find(b'\n', pos)
+        end = len(buf) if end < 0 else end + 1
+        line = buf[pos:end]
+        if not line.startswith(prefix):
+            break
+        yield json.loads(line)
+        pos = end
+
+
+def target_prefixes(target):
+    """Return line prefixes for 'cat/pn' or 'cat'."""
+    if '/' in target:
+        cat, pn = target.split('/', 1)
+        return [json.dumps([2, cat, pn], separators=(',', ':'))[:-1] + ',']
+    # category results, then all its packages
+    return [json.dumps([scope, target], separators=(',', ':'))[:-1] + ','
+            for scope in (1, 2)]
+
+
+def format_result(r):
+    scope, cat, pn, cls, ver, msg, level = r
+    name = '/'.join(x for x in (cat, pn) if x) or '(repository)'
+    if ver:
+        name += '-' + ver
+    return '{}: {} {}: {}'.format(name, level, cls, msg)
+
+
+def iter_packages(lines, levels):
+    """
+    Yield sorted unique (cat, pn) having results of given levels.
+    Tuples are compared rather than 'cat/pn' strings, to match the sort
+    order of the results file.
+    """
+    last = None
+    for l in lines:
+        scope, cat, pn, cls, ver, msg, level = json.loads(l)
+        if scope != 2 or level not in levels:
+            continue
+        pkg = (cat, pn)
+        if pkg != last:
+            yield pkg
+            last = pkg
+
+
+def cmd_show(args):
+    buf = load_buffer(args, args.rev)
+    found = False
+    for target in args.targets:
+        for prefix in target_prefixes(target):
+            for r in find(buf, prefix.encode()):
+                print(format_result(r))
+                found = True
+    return 0 if found else 1
+
+
+def cmd_list(args):
+    for pkg in iter_packages(iter_lines(args, args.rev),
+                             set(args.levels.split(','))):
+        print('/'.join(pkg))
+
+
+def cmd_diff(args):
+    """Print 'fixed', 'old' and 'new' packages like diff -N would."""
+    levels = set(args.levels.split(','))
+    old = iter_packages(iter_lines(args, args.old_rev), levels)
+    new = iter_packages(iter_lines(args, args.new_rev), levels)
+    o = next(old, None)
+    n = next(new, None)
+    while o is not None or n is not None:
+        if n is None or (o is not None and o < n):
+            print('fixed {}/{}'.format(*o))
+            o = next(old, None)
+        elif o is None or n < o:
+            print('new {}/{}'.format(*n))
+            n = next(new, None)
+        else:
+            if args.all:
+                print('old {}/{}'.format(*o))
+            o = next(old, None)
+            n = next(new, None)
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Query compact pkgcheck results')
+    argp.add_argument('-f', '--file', default='results.jsonl',
+                      help='Results file (path in repository if -r is used, '
+                           'default: results.jsonl)')
+    argp.add_argument('-C', '--git-dir', default='.',
+                      help='Git repository to read revisions from')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('show', help='Print results for packages '
+                                     '(cat/pn) or categories')
+    p.add_argument('-r', '--rev', help='Take results from git revision')
+    p.add_argument('targets', nargs='+')
+    p.set_defaults(func=cmd_show)
+    p = subp.add_parser('list', help='List packages with results')
+    p.add_argument('-l', '--levels', default='error',
+                   help='Comma-separated result levels (default: error)')
+    p.add_argument('-r', '--rev', help='Take results from git revision')
+    p.set_defaults(func=cmd_list)
+    p = subp.add_parser('diff', help='Compare packages with results '
+                                     'between two revisions')
+    p.add_argument('-l', '--levels', default='error',
+                   help='Comma-separated result levels (default: error)')
+    p.add_argument('-a', '--all', action='store_true',
+                   help='Print unchanged packages as well (as old)')
+    p.add_argument('old_rev', help='Old revision')
+    p.add_argument('new_rev', nargs='?',
+                   help='New revision (default: results file)')
+    p.set_defaults(func=cmd_diff)
+
+    args = argp.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,8 @@
 
 set -e -x
 
+. "${SCRIPT_DIR}"/utils/spans.bash
+
 repo=${GENTOO_CI_GIT}
 borked_list=${repo}/borked.list
 borked_last=${repo}/borked.last
@@ -19,40 +21,25 @@ current_rev=$(cd -- "${repo}"; git rev-parse --short HEAD)
 fixed=()
 old=()
 new=()
-
-while read t l; do
-	case "${t}" in
-		fixed) fixed+=( "${l}" );;
-		old) old+=( "${l}" );;
-		new) new+=( "${l}" );;
-		*)
-			echo "Invalid diff result: ${t} ${l}" >&2
-			exit 1;;
-	esac
-done < <(diff -N \
-		--old-line-format='fixed %L' \
-		--unchanged-line-format='old %L' \
-		--new-line-format='new %L' \
-		"${borked_last}" "${borked_list}")
-
 wfixed=()
 wold=()
 wnew=()
 
-while read t l; do
-	case "${t}" in
-		fixed) wfixed+=( "${l}" );;
-		old) wold+=( "${l}" );;
-		new) wnew+=( "${l}" );;
+while read f t l; do
+	case "${f} ${t}" in
+		"e fixed") fixed+=( "${l}" );;
+		"e old") old+=( "${l}" );;
+		"e new") new+=( "${l}" );;
+		"w fixed") wfixed+=( "${l}" );;
+		"w old") wold+=( "${l}" );;
+		"w new") wnew+=( "${l}" );;
 		*)
-			echo "Invalid diff result: ${t} ${l}" >&2
+			echo "Invalid diff result: ${f} ${t} ${l}" >&2
 			exit 1;;
 	esac
-done < <(diff -N \
-		--old-line-format='fixed %L' \
-		--unchanged-line-format='old %L' \
-		--new-line-format='new %L' \
-		"${warning_last}" "${warning_list}")
+done < <("${SCRIPT_DIR}"/gentoo-ci/blame.py diff \
+		--errors "${borked_last}" "${borked_list}" \
+		--warnings "${warning_last}" "${warning_list}")
 
 subject=
 
@@ -105,6 +92,7 @@ fi
 
 broken_commits=()
 cc_line=()
+blame_args=()
 
 if [[ ( ${new[@]} || ${wnew[@]} ) && ${previous_commit} && $(( ${#new[@]} + ${#wnew[@]} )) -lt 50 ]]; then
 	trap 'rm -rf "${BISECT_TMP}"' EXIT
@@ -118,78 +106,30 @@ if [[ ( ${new[@]} || ${wnew[@]} ) && ${previous_commit} && $(( ${#new[@]} + ${#w
 	# in the commit set; this could happen e.g. when new checks
 	# are added on top of already-broken repo
 	pre_previous_commit=$(cd -- "${SYNC_DIR}"/gentoo; git rev-parse "${previous_commit}^")
-	flag=e
-	set -- "${new[@]##*#}" -WARN- "${wnew[@]##*#}"
-	while [[ ${@} ]]; do
-		if [[ ${1} == -WARN- ]]; then
-			flag=w
-			shift
-			continue
-		fi
-
-		commit=$("${SCRIPT_DIR}"/gentoo-ci/bisect-borked.bash \
-			"${next_commit}" "${pre_previous_commit}" "${flag}" "${@}")
-		pkg=${1}
-		shift
-
-		# skip breakages introduced before the commit set
-		[[ ${pre_previous_commit} != ${commit}* ]] || continue
-
-		# record the blame!
-		echo "${pkg} ${commit}" >> "${blame_list}.${flag}"
-
-		# skip duplicates
-		for c in "${broken_commits[@]}"; do
-			[[ ${c} != ${commit} ]] || continue 2
-		done
-		broken_commits+=( "${commit}" )
-
-		for a in $(cd -- "${SYNC_DIR}"/gentoo; git log --pretty='%ae %ce' "${commit}" -1)
-		do
-			for o in "${mail_cc[@]}"; do
-				[[ ${o} != ${a} ]] || continue 2
-			done
-			mail_cc+=( "${a}" )
-			cc_line+=( "<${a}>" )
-		done
-	done
+	span bisect "" "${SCRIPT_DIR}"/gentoo-ci/bisect-borked.py \
+		"${pre_previous_commit}^" "${next_commit}" \
+		--errors "${new[@]##*#}" --warnings "${wnew[@]##*#}" \
+		> "${BISECT_TMP}"/blame
 
-	trap '' EXIT
-	rm -rf "${BISECT_TMP}"
+	blame_args+=( --bisect "${BISECT_TMP}"/blame
+		--skip "${pre_previous_commit}" )
 fi
 
-# CC people whose breakages have been fixed
-if [[ ${fixed[@]} || ${wfixed[@]} ]]; then
-	flag=e
-	set -- "${fixed[@]##*#}" -WARN- "${wfixed[@]##*#}"
-	while [[ ${@} ]]; do
-		if [[ ${1} == -WARN- ]]; then
-			flag=w
-			shift
-			continue
-		fi
-
-		while read pkg commit; do
-			if [[ ${pkg} == ${1} ]]; then
-				for a in $(cd -- "${SYNC_DIR}"/gentoo; git log --pretty='%ae %ce' "${commit}" -1)
-				do
-					for o in "${mail_cc[@]}"; do
-						[[ ${o} != ${a} ]] || continue 2
-					done
-					mail_cc+=( "${a}" )
-					cc_line+=( "<${a}>" )
-				done
-
-				sed -i -e "\@^${pkg}@d" "${blame_list}.${flag}"
-
-				# we can't have more than one anyway
-				break
-			fi
-		done < <( cat "${blame_list}.${flag}" || : )
-
-		shift
-	done
-fi
+# record the blame and CC people whose breakages have been fixed
+while read t v; do
+	case "${t}" in
+		commit) broken_commits+=( "${v}" );;
+		cc)
+			mail_cc+=( "${v}" )
+			cc_line+=( "<${v}>" );;
+	esac
+done < <("${SCRIPT_DIR}"/gentoo-ci/blame.py \
+		--import-prefix "${blame_list}" update "${blame_args[@]}" \
+		--fixed-errors "${fixed[@]##*#}" \
+		--fixed-warnings "${wfixed[@]##*#}")
+
+trap '' EXIT
+rm -rf "${BISECT_TMP}"
 
 cc_line=${cc_line[*]}
 
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# Persistent store of pkgcheck results per commit and package (SQLite),
+# and a small CLI to use it from shell scripts.
+#
+# Results are stored as a set of flags per package (e.g. 'e' if it is
+# on the error list, 'w' if on the warning list, '' if it was scanned
+# and found clean). They are keyed on the scan key that identifies
+# pkgcheck version, options and excludes used.
+
+import argparse
+import contextlib
+import hashlib
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    commit_id TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    UNIQUE (key, commit_id)
+);
+CREATE INDEX IF NOT EXISTS scans_last_used ON scans (last_used);
+
+CREATE TABLE IF NOT EXISTS results (
+    scan INTEGER NOT NULL REFERENCES scans (id) ON DELETE CASCADE,
+    package TEXT NOT NULL,
+    flags TEXT NOT NULL,
+    PRIMARY KEY (scan, package)
+) WITHOUT ROWID;
+'''
+
+
+# bump when the way results are classified changes
+KEY_VERSION = 3
+
+
+def scan_key(options):
+    """Return the key for results of pkgcheck run with options."""
+    h = hashlib.sha1()
+    h.update(str(KEY_VERSION).encode())
+    h.update(subprocess.check_output(['pkgcheck', '--version']))
+    h.update('\0'.join(options).encode())
+    parser_dir = os.environ.get('PKGCHECK_RESULT_PARSER_GIT')
+    if parser_dir is not None:
+        try:
+            with open(os.path.join(parser_dir, 'excludes.json'), 'rb') as f:
+                h.update(f.read())
+        except (IOError, OSError):
+            pass
+    return h.hexdigest()
+
+
+class ResultStore(object):
+    def __init__(self, path, max_size=None):
+        self.max_size = max_size
+        self.conn = sqlite3.connect(path, timeout=300,
+                                    isolation_level=None)
+        # needs to be set before the tables are created
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self.conn.execute('COMMIT')
+
+    def lookup(self, key, commit, pkgs):
+        """Return a dict of flags for pkgs with known results."""
+        row = self.conn.execute(
+                'SELECT id FROM scans WHERE key = ? AND commit_id = ?',
+                (key, commit)).fetchone()
+        if row is None:
+            return {}
+        self.conn.execute('UPDATE scans SET last_used = ? WHERE id = ?',
+                          (time.time(), row[0]))
+
+        ret = {}
+        pkgs = list(pkgs)
+        # stay within the SQLite variable limit
+        for i in range(0, len(pkgs), 500):
+            chunk = pkgs[i:i+500]
+            ret.update(self.conn.execute('''
+                SELECT package, flags FROM results
+                WHERE scan = ? AND package IN ({})'''.format(
+                    ','.join('?' * len(chunk))), [row[0]] + chunk))
+        return ret
+
+    def store(self, key, commit, results):
+        """Store results (dict of package -> flags) for commit."""
+        with self.transaction():
+            self.conn.execute('''
+                INSERT OR IGNORE INTO scans (key, commit_id, last_used)
+                VALUES (?, ?, ?)''', (key, commit, time.time()))
+            scan_id = self.conn.execute(
+                    'SELECT id FROM scans WHERE key = ? AND commit_id = ?',
+                    (key, commit)).fetchone()[0]
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO results (scan, package, flags)
+                VALUES (?, ?, ?)''',
+                ((scan_id, pkg, ''.join(sorted(flags)))
+                 for pkg, flags in results.items()))
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def size(self):
+        page_size, = self.conn.execute('PRAGMA page_size').fetchone()
+        pages, = self.conn.execute('PRAGMA page_count').fetchone()
+        free, = self.conn.execute('PRAGMA freelist_count').fetchone()
+        return (pages - free) * page_size
+
+    def evict(self, max_size):
+        """Drop least recently used scans until the store fits max_size."""
+        removed = 0
+        while self.size() > max_size:
+            with self.transaction():
+                ids = [row[0] for row in self.conn.execute(
+                    'SELECT id FROM scans ORDER BY last_used LIMIT 10')]
+                if not ids:
+                    break
+                self.conn.execute('DELETE FROM scans WHERE id IN ({})'
+                                  .format(','.join('?' * len(ids))), ids)
+            removed += len(ids)
+        if removed:
+            self.conn.execute('PRAGMA incremental_vacuum')
+        return removed
+
+
+def open_store():
+    """Open the store specified in the environment, or return None."""
+    path = os.environ.get('PKGCHECK_RESULT_DB')
+    if not path:
+        return None
+    size = os.environ.get('PKGCHECK_RESULT_DB_SIZE')
+    return ResultStore(path, int(size) * 1024 * 1024 if size else None)
+
+
+def cmd_key(store, args):
+    print(scan_key(args.options.split()))
+
+
+def cmd_lookup(store, args):
+    for pkg, flags in sorted(store.lookup(args.key, args.commit,
+                                          args.packages).items()):
+        print('{} {}'.format(pkg, flags or '-'))
+
+
+def cmd_store(store, args):
+    results = dict((pkg, set()) for pkg in args.packages)
+    for spec in args.list:
+        flag, path = spec.split(':', 1)
+        with open(path) as f:
+            for l in f:
+                l = l.strip()
+                if l:
+                    results.setdefault(l, set()).add(flag)
+    store.store(args.key, args.commit, results)
+
+
+def cmd_stats(store, args):
+    scans, = store.conn.execute('SELECT COUNT(*) FROM scans').fetchone()
+    results, = store.conn.execute('SELECT COUNT(*) FROM results').fetchone()
+    print('{} scans, {} results, {:.1f} MiB'.format(
+        scans, results, store.size() / 1024 / 1024))
+
+
+def cmd_evict(store, args):
+    print('Removed {} scans'.format(store.evict(args.size * 1024 * 1024)))
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Query the pkgcheck result store')
+    argp.add_argument('-d', '--db',
+                      default=os.environ.get('PKGCHECK_RESULT_DB'),
+                      help='Database path (default: $PKGCHECK_RESULT_DB)')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('key', help='Print the key for pkgcheck options')
+    p.add_argument('options', help='pkgcheck options (as one argument)')
+    p.set_defaults(func=cmd_key)
+    p = subp.add_parser('lookup', help='Print known results for packages')
+    p.add_argument('key')
+    p.add_argument('commit')
+    p.add_argument('packages', nargs='*')
+    p.set_defaults(func=cmd_lookup)
+    p = subp.add_parser('store', help='Store results for scanned packages')
+    p.add_argument('-l', '--list', action='append', default=[],
+                   help='FLAG:FILE, set flag for packages listed in file')
+    p.add_argument('key')
+    p.add_argument('commit')
+    p.add_argument('packages', nargs='*')
+    p.set_defaults(func=cmd_store)
+    p = subp.add_parser('stats', help='Print store size')
+    p.set_defaults(func=cmd_stats)
+    p = subp.add_parser('evict', help='Drop least recently used scans')
+    p.add_argument('size', type=int, help='Target size (MiB)')
+    p.set_defaults(func=cmd_evict)
+
+    args = argp.parse_args()
+    if args.command == 'key':
+        return args.func(None, args)
+    if not args.db:
+        argp.error('no database specified (-d or PKGCHECK_RESULT_DB)')
+    size = os.environ.get('PKGCHECK_RESULT_DB_SIZE')
+    store = ResultStore(args.db, int(size) * 1024 * 1024 if size else None)
+    try:
+        return args.func(store, args)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
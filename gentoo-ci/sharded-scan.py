@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# Run a full pkgcheck scan split into shards by category, in a pool
+# of pkgcheck processes. Shards are balanced using timings recorded
+# in earlier runs. Finished shards are kept in the state directory
+# until the scan completes, so that a rerun after a timeout scans only
+# the missing ones. Since the repo is usually synced in between, shards
+# with packages affected by the new commits (per incremental-scan.py)
+# are rescanned as well.
+#
+# The merged (unsorted) XML is written to stdout.
+
+import argparse
+import heapq
+import json
+import os
+import os.path
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import pkgcheckxml
+import resultstore
+
+
+def list_categories(repo):
+    with open(os.path.join(repo, 'profiles', 'categories')) as f:
+        cats = [l.strip() for l in f if l.strip()]
+    return [c for c in cats if os.path.isdir(os.path.join(repo, c))]
+
+
+def estimate_times(repo, cats, timings):
+    """Return category -> expected scan time."""
+    sizes = dict((c, len(os.listdir(os.path.join(repo, c)))) for c in cats)
+    known = [c for c in cats if c in timings]
+    per_pkg = 1.0
+    if known:
+        per_pkg = (sum(timings[c] for c in known)
+                   / max(sum(sizes[c] for c in known), 1))
+    return dict((c, timings.get(c, sizes[c] * per_pkg)) for c in cats)
+
+
+def plan_shards(estimates, count):
+    """Split categories into count shards of similar expected time."""
+    shards = [(0.0, i, []) for i in range(count)]
+    heapq.heapify(shards)
+    for c in sorted(estimates, key=lambda c: -estimates[c]):
+        total, i, cats = heapq.heappop(shards)
+        cats.append(c)
+        heapq.heappush(shards, (total + estimates[c], i, cats))
+    return [sorted(cats) for total, i, cats in
+            sorted(shards, key=lambda s: -s[0]) if cats]
+
+
+class ShardedScan(object):
+    def __init__(self, repo, state_dir, commit, options, workers):
+        self.repo = repo
+        self.options = options
+        self.workers = workers
+        self.jobs = max((os.cpu_count() or 1) // workers, 1)
+        self.timings_path = os.path.join(state_dir, 'timings.json')
+        self.run_dir = os.path.join(state_dir, 'run')
+        self.running = {}
+
+        try:
+            with open(self.timings_path) as f:
+                self.timings = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.timings = {}
+
+        # finished shards are only valid for the same scan options
+        key = resultstore.scan_key(options)
+        try:
+            with open(os.path.join(self.run_dir, 'id')) as f:
+                old_key = f.read().strip()
+        except (IOError, OSError):
+            old_key = None
+        if old_key != key:
+            self.reset(key)
+
+        # commits the finished shards were scanned at
+        self.commit = commit
+        self.commits_path = os.path.join(self.run_dir, 'commits.json')
+        try:
+            with open(self.commits_path) as f:
+                self.commits = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.commits = {}
+        if not self.invalidate():
+            self.reset(key)
+
+        plan_path = os.path.join(self.run_dir, 'plan.json')
+        try:
+            with open(plan_path) as f:
+                self.plan = json.load(f)
+        except (IOError, OSError, ValueError):
+            cats = list_categories(repo)
+            self.estimates = estimate_times(repo, cats, self.timings)
+            # repo and category level checks go first, they are slow
+            self.plan = [['*']] + plan_shards(
+                    self.estimates, min(len(cats), workers * 4))
+            with open(plan_path, 'w') as f:
+                json.dump(self.plan, f)
+        else:
+            cats = [c for shard in self.plan for c in shard if c != '*']
+            self.estimates = estimate_times(repo, cats, self.timings)
+
+    def reset(self, key):
+        """Drop all finished shards and the plan."""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        os.makedirs(self.run_dir)
+        with open(os.path.join(self.run_dir, 'id'), 'w') as f:
+            f.write(key + '\n')
+        self.commits = {}
+
+    def affected(self, old):
+        """Return packages affected since old, or None if all could be."""
+        p = subprocess.run(
+                [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'incremental-scan.py'),
+                 'affected', '--repo', self.repo, old, self.commit],
+                stdout=subprocess.PIPE, universal_newlines=True)
+        if p.returncode != 0:
+            return None
+        return set(p.stdout.split())
+
+    def invalidate(self):
+        """
+        Drop finished shards with packages affected by commits since
+        they were scanned. Repo and category level results are kept,
+        as in incremental gentoo-ci runs. Return False if a full scan
+        is needed instead.
+        """
+        try:
+            with open(os.path.join(self.run_dir, 'plan.json')) as f:
+                plan = json.load(f)
+        except (IOError, OSError, ValueError):
+            return True
+        affected = {}
+        for i, cats in enumerate(plan):
+            old = self.commits.get(str(i))
+            if old is None or old == self.commit:
+                continue
+            if old not in affected:
+                affected[old] = self.affected(old)
+            if affected[old] is None:
+                return False
+            if any(p.split('/')[0] in cats for p in affected[old]):
+                print('Shard {} outdated'.format(i), file=sys.stderr)
+                os.unlink(self.shard_path(i))
+                del self.commits[str(i)]
+            else:
+                self.commits[str(i)] = self.commit
+        self.save_commits()
+        return True
+
+    def save_commits(self):
+        with open(self.commits_path + '.tmp', 'w') as f:
+            json.dump(self.commits, f)
+        os.rename(self.commits_path + '.tmp', self.commits_path)
+
+    def shard_path(self, i):
+        return os.path.join(self.run_dir, '{:03}.xml'.format(i))
+
+    def start(self, i):
+        cats = self.plan[i]
+        if cats == ['*']:
+            targets = ['*/*', '-s', 'repo,cat']
+        else:
+            targets = [c + '/*' for c in cats] + ['-s', 'pkg,ver']
+        cmd = (['pkgcheck', '--config', os.environ['CONFIG_DIR'], 'scan',
+                '--reporter', 'XmlReporter', '--jobs', str(self.jobs)]
+               + self.options + targets)
+        f = open(self.shard_path(i) + '.tmp', 'wb')
+        p = subprocess.Popen(cmd, cwd=self.repo, stdout=f)
+        f.close()
+        self.running[p.pid] = (i, p, time.time())
+        print('Shard {}/{} started: {}'.format(
+            i, len(self.plan), ' '.join(cats)), file=sys.stderr)
+
+    def finish(self, i, ret, elapsed):
+        if ret != 0:
+            print('Shard {} failed with {}'.format(i, ret), file=sys.stderr)
+            return False
+        os.rename(self.shard_path(i) + '.tmp', self.shard_path(i))
+        self.commits[str(i)] = self.commit
+        self.save_commits()
+        print('Shard {} done in {:.0f}s'.format(i, elapsed), file=sys.stderr)
+
+        # split shard time between its categories
+        cats = self.plan[i]
+        if cats == ['*']:
+            self.timings['*'] = elapsed
+        else:
+            total = sum(self.estimates[c] for c in cats) or 1
+            for c in cats:
+                self.timings[c] = elapsed * self.estimates[c] / total
+        return True
+
+    def run(self):
+        pending = [i for i in range(len(self.plan))
+                   if not os.path.exists(self.shard_path(i))]
+        print('{} of {} shards to scan'.format(len(pending), len(self.plan)),
+              file=sys.stderr)
+
+        ok = True
+        try:
+            while pending or self.running:
+                while pending and len(self.running) < self.workers:
+                    self.start(pending.pop(0))
+                pid, status = os.wait()
+                if pid not in self.running:
+                    continue
+                i, p, start_time = self.running.pop(pid)
+                p.returncode = os.waitstatus_to_exitcode(status)
+                if not self.finish(i, p.returncode, time.time() - start_time):
+                    ok = False
+        finally:
+            for i, p, start_time in self.running.values():
+                p.terminate()
+            for i, p, start_time in self.running.values():
+                p.wait()
+            with open(self.timings_path + '.tmp', 'w') as f:
+                json.dump(self.timings, f)
+            os.rename(self.timings_path + '.tmp', self.timings_path)
+        return ok
+
+    def write(self, out):
+        out.write(pkgcheckxml.XML_HEADER)
+        for i in range(len(self.plan)):
+            with open(self.shard_path(i), 'rb') as f:
+                for r in pkgcheckxml.iter_results(f):
+                    pkgcheckxml.write_result(out, r)
+        out.write(pkgcheckxml.XML_FOOTER)
+
+    def clean(self):
+        """Drop finished shards, the next scan is a new one."""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+def terminate(signum, frame):
+    sys.exit(128 + signum)
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Run full pkgcheck scan in category shards')
+    argp.add_argument('-j', '--workers', type=int,
+                      default=int(os.environ.get(
+                          'GENTOO_CI_SCAN_WORKERS', 4)),
+                      help='Number of pkgcheck processes to run')
+    argp.add_argument('--state-dir',
+                      default=os.environ.get('GENTOO_CI_SHARD_DIR'),
+                      help='Directory to keep shards and timings in '
+                           '(default: $GENTOO_CI_SHARD_DIR)')
+    argp.add_argument('--commit', required=True,
+                      help='Scanned commit (finished shards from earlier '
+                           'commits are reused if not affected since)')
+    argp.add_argument('--options', default='',
+                      help='pkgcheck options (as one argument)')
+    argp.add_argument('repo', help='Repository to scan')
+    args = argp.parse_args()
+    if not args.state_dir:
+        argp.error('no state directory specified')
+
+    # make sure children are cleaned up on timeout
+    signal.signal(signal.SIGTERM, terminate)
+    os.makedirs(args.state_dir, exist_ok=True)
+    scan = ShardedScan(args.repo, args.state_dir, args.commit,
+                       args.options.split(), args.workers)
+    if not scan.run():
+        return 1
+    scan.write(sys.stdout)
+    sys.stdout.flush()
+    scan.clean()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Sort pkgcheck XML results for better git delta compression (repo
+# results first, then category results, then package results sorted
+# by category, package, class, version and message), in one pass that
+# also feeds the sorted stream to pkgcheck2borked.py for package lists,
+# instead of reading the results again for every list.
+#
+# Results are sorted in chunks spilled to temporary files and merged,
+# so memory use does not depend on the report size.
+#
+# The sorted results can also be written in compact form, as one JSON
+# array per line: [scope, category, package, class, version, message,
+# level]. Lines are ordered bytewise, so query-results.py can find
+# packages in it by bisection.
+
+import argparse
+import heapq
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+
+import pkgcheckxml
+
+
+# results sorted in memory at once
+CHUNK_SIZE = 50000
+
+
+def sort_key(elem):
+    cat = elem.findtext('category')
+    pkg = elem.findtext('package')
+    scope = 0 if cat is None else 1 if pkg is None else 2
+    return [scope, cat or '', pkg or '', elem.findtext('class') or '',
+            elem.findtext('version') or '', elem.findtext('msg') or '']
+
+
+def load_levels():
+    """Return result class -> level mapping from pkgcheck."""
+    from pkgcheck import objects
+    return dict((name, cls.level) for name, cls in objects.KEYWORDS.items())
+
+
+def write_chunk(records):
+    f = tempfile.TemporaryFile('w+', encoding='utf8')
+    for r in sorted(records, key=lambda r: r[0]):
+        f.write(json.dumps(r))
+        f.write('\n')
+    f.seek(0)
+    return f
+
+
+def read_chunk(f):
+    for l in f:
+        yield json.loads(l)
+
+
+def iter_inputs(paths):
+    for path in paths:
+        if path == '-':
+            yield from pkgcheckxml.iter_results(sys.stdin.buffer)
+        else:
+            with open(path, 'rb') as f:
+                yield from pkgcheckxml.iter_results(f)
+
+
+def start_lists(args):
+    """Start pkgcheck2borked.py for every list, reading XML on stdin."""
+    procs = []
+    for spec in args.list:
+        opts, path = spec.rsplit(':', 1)
+        cmd = [args.parser]
+        if args.excludes is not None:
+            cmd += ['-x', args.excludes]
+        procs.append(subprocess.Popen(
+                cmd + opts.split() + ['-o', path, '/dev/stdin'],
+                stdin=subprocess.PIPE, encoding='utf8'))
+    return procs
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Sort pkgcheck results and list affected packages')
+    argp.add_argument('-o', '--output',
+                      help='Write sorted XML to file')
+    argp.add_argument('-l', '--list', action='append', default=[],
+                      help='OPTIONS:FILE, write pkgcheck2borked.py output '
+                           'for OPTIONS to file (e.g. --list=\'-s -w:'
+                           'warning.list\', or :borked.list for none)')
+    argp.add_argument('-i', '--index',
+                      help='Write sorted compact results to file')
+    argp.add_argument('-x', '--excludes',
+                      help='Excludes file for pkgcheck2borked.py')
+    argp.add_argument('-p', '--parser',
+                      default=os.path.join(
+                          os.environ.get('PKGCHECK_RESULT_PARSER_GIT', '.'),
+                          'pkgcheck2borked.py'),
+                      help='pkgcheck2borked.py path (default: in '
+                           '$PKGCHECK_RESULT_PARSER_GIT)')
+    argp.add_argument('files', nargs='+', help='Input files (- for stdin)')
+    args = argp.parse_args()
+
+    # levels are only informational, in the compact results
+    class_levels = load_levels() if args.index else {}
+
+    chunks = []
+    records = []
+    for r in iter_inputs(args.files):
+        records.append((sort_key(r), pkgcheckxml.format_result(r),
+                        class_levels.get(r.findtext('class'), 'warning')))
+        if len(records) >= CHUNK_SIZE:
+            chunks.append(write_chunk(records))
+            records = []
+    chunks.append(write_chunk(records))
+
+    outputs = [p for p in (args.output, args.index) if p is not None]
+    xml_f = index_f = None
+    if args.output is not None:
+        xml_f = open(args.output + '.tmp', 'w', encoding='utf8')
+    if args.index is not None:
+        index_f = open(args.index + '.tmp', 'w', encoding='utf8')
+    lists = start_lists(args)
+    xml_fs = [p.stdin for p in lists]
+    if xml_f is not None:
+        xml_fs.append(xml_f)
+
+    for f in xml_fs:
+        f.write(pkgcheckxml.XML_HEADER)
+    for key, text, level in heapq.merge(
+            *(read_chunk(c) for c in chunks), key=lambda r: r[0]):
+        for f in xml_fs:
+            f.write(text)
+        if index_f is not None:
+            index_f.write(json.dumps(key + [level], separators=(',', ':')))
+            index_f.write('\n')
+    for f in xml_fs:
+        f.write(pkgcheckxml.XML_FOOTER)
+        f.close()
+    if index_f is not None:
+        index_f.close()
+    for c in chunks:
+        c.close()
+    for path in outputs:
+        os.rename(path + '.tmp', path)
+
+    ret = 0
+    for spec, p in zip(args.list, lists):
+        if p.wait() != 0:
+            print('pkgcheck2borked.py failed for {}'.format(spec),
+                  file=sys.stderr)
+            ret = 1
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
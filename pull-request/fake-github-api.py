@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# Local stand-in for the subset of the GitHub API used by the pull
+# request scripts. Serves PRs, statuses and comments from a JSON fixture
+# (or a synthetic set of PRs) and counts the requests made, so that
+# the scripts can be tested and benchmarked offline. GET responses carry
+# ETags, and conditional requests for unchanged data are answered with
+# 304 and counted separately, like GitHub does.
+#
+# Point the scripts at it via GITHUB_API_URL=http://127.0.0.1:<port>.
+
+import argparse
+import collections
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import re
+import sys
+import threading
+import urllib.parse
+
+
+class FakeGitHub(object):
+    def __init__(self, repo, login):
+        self.repo = repo
+        self.login = login
+        self.pulls = {}
+        self.statuses = collections.defaultdict(list)
+        self.comments = collections.defaultdict(list)
+        self.next_id = 1
+        self.stats = collections.Counter()
+        self.not_modified = collections.Counter()
+        self.lock = threading.Lock()
+
+    def load(self, data):
+        self.repo = data.get('repo', self.repo)
+        for pr in data.get('pulls', []):
+            self.pulls[pr['number']] = {
+                'number': pr['number'],
+                'head': pr['head'],
+                'labels': list(pr.get('labels', [])),
+                'updated_at': pr.get('updated_at', now()),
+                'files': list(pr.get('files', [])),
+            }
+        for sha, sts in data.get('statuses', {}).items():
+            for st in sts:
+                self.add_status(sha, st.get('state', 'pending'),
+                                st.get('description', ''),
+                                st.get('context', 'gentoo-ci'),
+                                st.get('target_url'),
+                                st.get('creator', self.login))
+        for prid, cos in data.get('comments', {}).items():
+            for co in cos:
+                self.add_comment(int(prid), co['body'],
+                                 co.get('user', self.login))
+
+    def generate(self, count, seed=0):
+        rnd = random.Random(seed)
+        start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        for i in range(1, count + 1):
+            sha = '%040x' % rnd.getrandbits(160)
+            labels = []
+            if rnd.random() < 0.05:
+                labels.append('noci')
+            if rnd.random() < 0.05:
+                labels.append('priority-ci')
+            # mostly small PRs, a few eclass, profile or treewide ones
+            roll = rnd.random()
+            if roll < 0.03:
+                files = ['eclass/{}.eclass'.format(rnd.choice(
+                    ('cmake', 'python-r1', 'toolchain-funcs')))]
+            elif roll < 0.05:
+                files = ['profiles/package.mask']
+            else:
+                files = ['cat-{}/pkg-{}/pkg-{}-1.ebuild'.format(
+                    rnd.randrange(20), n, n) for n in range(
+                        rnd.choice((1, 1, 1, 2, 3, 10, 300)))]
+            self.pulls[i] = {
+                'number': i,
+                'head': sha,
+                'labels': labels,
+                'files': files,
+                'updated_at': (start + datetime.timedelta(
+                    minutes=rnd.randrange(10**6))).strftime(
+                        '%Y-%m-%dT%H:%M:%SZ'),
+            }
+            # most PRs were checked already
+            roll = rnd.random()
+            if roll < 0.7:
+                self.add_status(sha, rnd.choice(('success', 'failure')),
+                                'checked', 'gentoo-ci', None, self.login)
+            elif roll < 0.8:
+                self.add_status(sha, 'pending', 'QA checks pending.',
+                                'gentoo-ci', None, self.login)
+
+    def add_status(self, sha, state, description, context, target_url,
+                   creator):
+        st = {
+            'id': self.next_id,
+            'state': state,
+            'description': description,
+            'context': context,
+            'target_url': target_url,
+            'creator': {'login': creator},
+            'created_at': now(),
+        }
+        self.next_id += 1
+        # newest first, like GitHub
+        self.statuses[sha].insert(0, st)
+        return st
+
+    def add_comment(self, prid, body, user):
+        co = {
+            'id': self.next_id,
+            'body': body,
+            'user': {'login': user},
+            'created_at': now(),
+            'updated_at': now(),
+        }
+        self.next_id += 1
+        self.comments[prid].append(co)
+        return co
+
+    def find_comment(self, cid):
+        for prid, cos in self.comments.items():
+            for co in cos:
+                if co['id'] == cid:
+                    return prid, co
+        return None, None
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime(
+            '%Y-%m-%dT%H:%M:%SZ')
+
+
+ROUTES = []
+
+
+def route(method, pattern):
+    def wrap(f):
+        ROUTES.append((method, re.compile('^' + pattern + '$'), pattern, f))
+        return f
+    return wrap
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    @property
+    def gh(self):
+        return self.server.gh
+
+    @property
+    def base(self):
+        return 'http://' + self.headers.get('Host', '127.0.0.1')
+
+    def repo_url(self):
+        return self.base + '/repos/' + self.gh.repo
+
+    def handle_any(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.input = json.loads(body) if body else {}
+
+        path = url.path
+        # GHE-style prefix
+        if path.startswith('/api/v3/'):
+            path = path[7:]
+        for r_method, regex, pattern, func in ROUTES:
+            if r_method != method:
+                continue
+            m = regex.match(path)
+            if m is None:
+                continue
+            with self.gh.lock:
+                ret = func(self, *m.groups())
+                code, data, headers = (ret + ({},))[:3]
+                body = json.dumps(data).encode() if data is not None else b''
+                if method == 'GET' and code == 200:
+                    # conditional requests, not counted against the limit
+                    etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                    headers = dict(headers, ETag=etag)
+                    if self.headers.get('If-None-Match') == etag:
+                        self.gh.not_modified[func.__name__] += 1
+                        return self.reply(304, headers=headers)
+                if not pattern.startswith('/_'):
+                    self.gh.stats[func.__name__] += 1
+            return self.reply(code, body=body, headers=headers)
+        self.reply(404, {'message': 'Not Found'})
+
+    def reply(self, code, data=None, headers={}, body=None):
+        if body is None:
+            body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', '5000')
+        self.send_header('X-RateLimit-Remaining',
+                         str(max(0, 5000 - sum(self.gh.stats.values()))))
+        self.send_header('X-RateLimit-Reset', '0')
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def paginate(self, items, url):
+        per_page = int(self.query.get('per_page', 30))
+        page = int(self.query.get('page', 1))
+        last = max(1, (len(items) + per_page - 1) // per_page)
+        # like GitHub, no prev/first on the first page and no next/last
+        # on the last one
+        rels = []
+        if page > 1:
+            rels += [('prev', page - 1), ('first', 1)]
+        if page < last:
+            rels += [('next', page + 1), ('last', last)]
+        links = ['<%s?per_page=%d&page=%d>; rel="%s"' % (
+                 url, per_page, target, rel) for rel, target in rels]
+        headers = {}
+        if links:
+            headers['Link'] = ', '.join(links)
+        return (200, items[(page - 1) * per_page:page * per_page],
+                headers)
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PATCH(self):
+        self.handle_any('PATCH')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+    # -- JSON representations --
+
+    def repo_json(self):
+        owner, name = self.gh.repo.split('/')
+        return {
+            'id': 1,
+            'name': name,
+            'full_name': self.gh.repo,
+            'owner': {'login': owner},
+            'url': self.repo_url(),
+        }
+
+    def pull_json(self, pr):
+        return {
+            'id': pr['number'],
+            'number': pr['number'],
+            'state': 'open',
+            'url': '%s/pulls/%d' % (self.repo_url(), pr['number']),
+            'issue_url': '%s/issues/%d' % (self.repo_url(), pr['number']),
+            'head': {'sha': pr['head']},
+            'labels': [{'name': l} for l in pr['labels']],
+            'updated_at': pr['updated_at'],
+        }
+
+    def status_json(self, sha, st):
+        st = dict(st)
+        st['url'] = '%s/statuses/%s' % (self.repo_url(), sha)
+        return st
+
+    def comment_json(self, co):
+        co = dict(co)
+        co['url'] = '%s/issues/comments/%d' % (self.repo_url(), co['id'])
+        return co
+
+    # -- control endpoints --
+
+    @route('GET', '/_stats')
+    def get_stats(self):
+        return 200, {
+            'total': sum(self.gh.stats.values()),
+            'requests': dict(self.gh.stats),
+            'not_modified': dict(self.gh.not_modified),
+        }
+
+    @route('POST', '/_reset')
+    def reset_stats(self):
+        self.gh.stats.clear()
+        self.gh.not_modified.clear()
+        return 204, None
+
+    @route('GET', '/_state')
+    def get_state(self):
+        return 200, {
+            'repo': self.gh.repo,
+            'pulls': list(self.gh.pulls.values()),
+            'statuses': self.gh.statuses,
+            'comments': self.gh.comments,
+        }
+
+    # -- REST API --
+
+    @route('GET', '/rate_limit')
+    def get_rate_limit(self):
+        remaining = max(0, 5000 - sum(self.gh.stats.values()))
+        core = {'limit': 5000, 'remaining': remaining, 'reset': 0}
+        return 200, {'resources': {'core': core, 'graphql': core},
+                     'rate': core}
+
+    @route('GET', '/repos/([^/]+/[^/]+)')
+    def get_repo(self, repo):
+        return 200, self.repo_json()
+
+    @route('GET', '/repos/[^/]+/[^/]+/pulls')
+    def get_pulls(self):
+        return self.paginate(
+                [self.pull_json(pr) for _, pr
+                 in sorted(self.gh.pulls.items())],
+                self.repo_url() + '/pulls')
+
+    @route('GET', '/repos/[^/]+/[^/]+/pulls/(\\d+)')
+    def get_pull(self, prid):
+        pr = self.gh.pulls.get(int(prid))
+        if pr is None:
+            return 404, {'message': 'Not Found'}
+        return 200, self.pull_json(pr)
+
+    @route('GET', '/repos/[^/]+/[^/]+/commits/([0-9a-f]+)')
+    def get_commit(self, sha):
+        return 200, {'sha': sha,
+                     'url': '%s/commits/%s' % (self.repo_url(), sha)}
+
+    @route('GET', '/repos/[^/]+/[^/]+/commits/([0-9a-f]+)/statuses')
+    def get_statuses(self, sha):
+        return self.paginate(
+                [self.status_json(sha, st)
+                 for st in self.gh.statuses.get(sha, [])],
+                '%s/commits/%s/statuses' % (self.repo_url(), sha))
+
+    @route('POST', '/repos/[^/]+/[^/]+/statuses/([0-9a-f]+)')
+    def create_status(self, sha):
+        st = self.gh.add_status(sha, self.input['state'],
+                                self.input.get('description', ''),
+                                self.input.get('context', 'default'),
+                                self.input.get('target_url'),
+                                self.gh.login)
+        return 201, self.status_json(sha, st)
+
+    @route('GET', '/repos/[^/]+/[^/]+/issues/(\\d+)/comments')
+    def get_comments(self, prid):
+        return self.paginate(
+                [self.comment_json(co)
+                 for co in self.gh.comments.get(int(prid), [])],
+                '%s/issues/%s/comments' % (self.repo_url(), prid))
+
+    @route('POST', '/repos/[^/]+/[^/]+/issues/(\\d+)/comments')
+    def create_comment(self, prid):
+        co = self.gh.add_comment(int(prid), self.input['body'],
+                                 self.gh.login)
+        return 201, self.comment_json(co)
+
+    @route('GET', '/repos/[^/]+/[^/]+/issues/comments/(\\d+)')
+    def get_comment(self, cid):
+        prid, co = self.gh.find_comment(int(cid))
+        if co is None:
+            return 404, {'message': 'Not Found'}
+        return 200, self.comment_json(co)
+
+    @route('PATCH', '/repos/[^/]+/[^/]+/issues/comments/(\\d+)')
+    def edit_comment(self, cid):
+        prid, co = self.gh.find_comment(int(cid))
+        if co is None:
+            return 404, {'message': 'Not Found'}
+        co['body'] = self.input['body']
+        co['updated_at'] = now()
+        return 200, self.comment_json(co)
+
+    @route('DELETE', '/repos/[^/]+/[^/]+/issues/comments/(\\d+)')
+    def delete_comment(self, cid):
+        prid, co = self.gh.find_comment(int(cid))
+        if co is None:
+            return 404, {'message': 'Not Found'}
+        self.gh.comments[prid].remove(co)
+        return 204, None
+
+    # -- GraphQL API --
+
+    @route('POST', '/(?:api/)?graphql')
+    def graphql(self):
+        query = self.input.get('query', '')
+        variables = self.input.get('variables') or {}
+        if 'pullRequests(' in query:
+            return 200, {'data': self.graphql_pulls(variables)}
+        return 200, {'errors': [{'message': 'Query not supported by fake API'}]}
+
+    def graphql_pulls(self, variables):
+        context = variables.get('context', 'gentoo-ci')
+        start = int(variables.get('cursor') or 0)
+        pulls = [pr for _, pr in sorted(self.gh.pulls.items())]
+        page = pulls[start:start + 100]
+
+        nodes = []
+        for pr in page:
+            status = None
+            for st in self.gh.statuses.get(pr['head'], []):
+                if st['context'] == context:
+                    status = {'context': {
+                        'state': st['state'].upper(),
+                        'creator': st['creator'],
+                    }}
+                    break
+            nodes.append({
+                'number': pr['number'],
+                'updatedAt': pr['updated_at'],
+                'headRefOid': pr['head'],
+                'changedFiles': len(pr.get('files', [])),
+                'files': {'nodes': [{'path': f} for f
+                                    in pr.get('files', [])[:100]]},
+                'labels': {'nodes': [{'name': l} for l in pr['labels']]},
+                'commits': {'nodes': [{'commit': {'status': status}}]},
+            })
+
+        end = start + len(page)
+        return {'repository': {'pullRequests': {
+            'pageInfo': {
+                'hasNextPage': end < len(pulls),
+                'endCursor': str(end),
+            },
+            'nodes': nodes,
+        }}}
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument('-b', '--bind', default='127.0.0.1',
+                      help='Address to listen on (default: 127.0.0.1)')
+    argp.add_argument('-p', '--port', type=int, default=8080,
+                      help='Port to listen on (default: 8080)')
+    argp.add_argument('-f', '--fixture',
+                      help='JSON file with initial PRs, statuses and comments')
+    argp.add_argument('-g', '--generate', type=int, default=0,
+                      help='Generate specified number of synthetic PRs')
+    argp.add_argument('-l', '--login', default='gentoo-repo-qa-bot',
+                      help='Login to attribute statuses and comments to')
+    argp.add_argument('-r', '--repo', default='gentoo/gentoo',
+                      help='Repository to serve (default: gentoo/gentoo)')
+    argp.add_argument('-v', '--verbose', action='store_true',
+                      help='Log all requests')
+    args = argp.parse_args()
+
+    gh = FakeGitHub(args.repo, args.login)
+    if args.fixture:
+        with open(args.fixture) as f:
+            gh.load(json.load(f))
+    if args.generate:
+        gh.generate(args.generate)
+
+    server = http.server.ThreadingHTTPServer((args.bind, args.port), Handler)
+    server.gh = gh
+    server.verbose = args.verbose
+    print('Serving {} on http://{}:{}'.format(gh.repo, *server.server_address),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(dict(gh.stats), indent=2, sort_keys=True),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
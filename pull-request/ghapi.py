@@ -0,0 +1,364 @@
+# GitHub API client shared by the pull request scripts.
+#
+# A single Client keeps one HTTP session for all calls, sends
+# conditional GET requests using ETags cached on disk (so that pages
+# that did not change are answered with 304 and do not count against
+# the rate limit), tracks the remaining rate limit and backs off when
+# it is exhausted or the server fails temporarily.
+
+import collections
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import requests
+
+import spans
+
+
+DEFAULT_API_URL = 'https://api.github.com'
+
+# all the state we need to schedule open PRs, fetched in pages
+# of 100 PRs rather than a few REST requests per PR
+OPEN_PULLS_QUERY = '''
+query($owner: String!, $name: String!, $context: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        updatedAt
+        headRefOid
+        changedFiles
+        files(first: 100) { nodes { path } }
+        labels(first: 50) { nodes { name } }
+        commits(last: 1) {
+          nodes {
+            commit {
+              status {
+                context(name: $context) { state creator { login } }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+
+PullRequest = collections.namedtuple('PullRequest',
+        ('number', 'head_sha', 'labels', 'updated_at', 'ci_state',
+         'changed_files', 'files'))
+
+
+ETAG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS etags (
+    url TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    body BLOB NOT NULL,
+    link TEXT
+);
+'''
+
+# retries for temporary server errors, with exponential backoff
+MAX_RETRIES = 5
+# longest wait for the rate limit to reset before giving up
+MAX_RATE_LIMIT_WAIT = 15 * 60
+
+
+class GraphQLError(Exception):
+    pass
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def api_url():
+    return os.environ.get('GITHUB_API_URL') or DEFAULT_API_URL
+
+
+class ETagCache(object):
+    """ETag -> response cache, in SQLite or in memory if path is None."""
+
+    def __init__(self, path=None):
+        self.conn = sqlite3.connect(path or ':memory:', timeout=300,
+                                    isolation_level=None)
+        if path is not None:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(ETAG_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, url):
+        return self.conn.execute(
+                'SELECT etag, body, link FROM etags WHERE url = ?',
+                (url,)).fetchone()
+
+    def put(self, url, etag, body, link):
+        self.conn.execute(
+                'INSERT OR REPLACE INTO etags (url, etag, body, link) '
+                'VALUES (?, ?, ?, ?)', (url, etag, body, link))
+
+    def drop(self, url):
+        self.conn.execute('DELETE FROM etags WHERE url = ?', (url,))
+
+
+class Response(object):
+    """Minimal response, possibly reconstructed from the ETag cache."""
+
+    def __init__(self, status_code, body, link=None, cached=False):
+        self.status_code = status_code
+        self.body = body
+        self.link = link
+        self.cached = cached
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+    @property
+    def links(self):
+        """Return rel -> URL mapping from the Link header."""
+        if not self.link:
+            return {}
+        return dict((l.get('rel'), l['url']) for l
+                    in requests.utils.parse_header_links(self.link))
+
+
+class Client(object):
+    def __init__(self, token, repo, login, cache_path=None, url=None):
+        self.repo = repo
+        self.login = login
+        self.url = url or api_url()
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'token ' + token,
+            'Accept': 'application/vnd.github.v3+json',
+        })
+        self.cache = ETagCache(cache_path)
+        # last known rate limit state, updated from every response
+        self.remaining = None
+        self.reset = None
+        self.stats = collections.Counter()
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+
+    def repo_url(self, path=''):
+        return '{}/repos/{}{}'.format(self.url, self.repo, path)
+
+    def update_rate_limit(self, resp):
+        # GraphQL queries have a separate limit
+        if resp.headers.get('X-RateLimit-Resource', 'core') != 'core':
+            return
+        remaining = resp.headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            self.remaining = int(remaining)
+            self.reset = int(resp.headers.get('X-RateLimit-Reset', 0))
+
+    def backoff_time(self, resp, attempt):
+        """Return seconds to wait before retrying, or None to fail."""
+        if resp is None or resp.status_code >= 500:
+            if attempt >= MAX_RETRIES:
+                return None
+            return 2 ** attempt
+        if resp.status_code in (403, 429):
+            if 'Retry-After' in resp.headers:
+                # secondary rate limit
+                return int(resp.headers['Retry-After'])
+            if resp.headers.get('X-RateLimit-Remaining') == '0':
+                wait = (int(resp.headers.get('X-RateLimit-Reset', 0))
+                        - time.time())
+                if wait > MAX_RATE_LIMIT_WAIT:
+                    raise RateLimitExceeded(
+                        'Rate limit exhausted, resets in {:.0f}s'.format(wait))
+                return max(wait, 1)
+        return None
+
+    def request(self, method, url, **kwargs):
+        """Perform request, waiting out rate limits and server errors."""
+        if not url.startswith(('http://', 'https://')):
+            url = self.url + url
+        attempt = 0
+        while True:
+            error = None
+            start = time.time()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as e:
+                spans.record('github', start, time.time(), status=1)
+                resp = None
+                error = e
+            else:
+                spans.record('github', start, time.time(),
+                             status=(resp.status_code
+                                     if resp.status_code >= 400 else 0))
+                self.update_rate_limit(resp)
+                self.stats[resp.status_code] += 1
+                if resp.status_code < 400:
+                    return resp
+            wait = self.backoff_time(resp, attempt)
+            if wait is None:
+                if error is not None:
+                    raise error
+                resp.raise_for_status()
+                return resp
+            print('GitHub API: {} {} failed ({}), retrying in {:.0f}s'.format(
+                method, url, resp.status_code if resp is not None
+                else 'connection error', wait), file=sys.stderr)
+            time.sleep(wait)
+            attempt += 1
+
+    def get(self, url, params=None):
+        """Conditional GET, using the cached response if unchanged."""
+        if not url.startswith(('http://', 'https://')):
+            url = self.url + url
+        if params:
+            url = requests.Request('GET', url, params=params).prepare().url
+        headers = {}
+        cached = self.cache.get(url)
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        resp = self.request('GET', url, headers=headers)
+        if resp.status_code == 304:
+            return Response(200, cached[1], cached[2], cached=True)
+        link = resp.headers.get('Link')
+        if 'ETag' in resp.headers:
+            self.cache.put(url, resp.headers['ETag'], resp.content, link)
+        return Response(resp.status_code, resp.content, link)
+
+    def iter_pages(self, url, params=None):
+        """Iterate over items of a paginated list."""
+        resp = self.get(url, params)
+        while True:
+            yield from resp.json()
+            if 'next' not in resp.links:
+                break
+            resp = self.get(resp.links['next'])
+
+    def iter_pages_reversed(self, url, params=None):
+        """Iterate over items of a paginated list, last page first."""
+        resp = self.get(url, params)
+        if 'last' in resp.links:
+            resp = self.get(resp.links['last'])
+        while True:
+            yield from reversed(resp.json())
+            if 'prev' not in resp.links:
+                break
+            resp = self.get(resp.links['prev'])
+
+    def post(self, url, data):
+        return self.request('POST', url, json=data)
+
+    def budget(self, reserve=0):
+        """Return the number of requests that can be made, less reserve."""
+        if self.remaining is None:
+            # /rate_limit itself does not count against the limit
+            data = self.request('GET', '/rate_limit').json()
+            core = data['resources']['core']
+            self.remaining = core['remaining']
+            self.reset = core['reset']
+        return self.remaining - reserve
+
+    def graphql(self, query, variables):
+        resp = self.post('/graphql',
+                         {'query': query, 'variables': variables})
+        data = resp.json()
+        if data.get('errors'):
+            raise GraphQLError('; '.join(e.get('message', repr(e))
+                                         for e in data['errors']))
+        return data['data']
+
+    # -- REST API calls used by the scripts --
+
+    def create_status(self, sha, state, description, target_url=None,
+                      context='gentoo-ci'):
+        data = {'state': state, 'description': description,
+                'context': context}
+        if target_url is not None:
+            data['target_url'] = target_url
+        return self.post(self.repo_url('/statuses/' + sha), data).json()
+
+    def iter_comments(self, prid, newest_first=False):
+        it = self.iter_pages_reversed if newest_first else self.iter_pages
+        return it(self.repo_url('/issues/{}/comments'.format(prid)),
+                  {'per_page': 100})
+
+    def get_comment(self, cid):
+        """Return comment, or None if it no longer exists."""
+        try:
+            return self.get(
+                    self.repo_url('/issues/comments/{}'.format(cid))).json()
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+
+    def create_comment(self, prid, body):
+        return self.post(self.repo_url('/issues/{}/comments'.format(prid)),
+                         {'body': body}).json()
+
+    def edit_comment(self, cid, body):
+        return self.request(
+                'PATCH', self.repo_url('/issues/comments/{}'.format(cid)),
+                json={'body': body}).json()
+
+    def delete_comment(self, cid):
+        self.request('DELETE',
+                     self.repo_url('/issues/comments/{}'.format(cid)))
+
+
+def open_client():
+    """Create a Client using the configuration from the environment."""
+    with open(os.environ['GITHUB_TOKEN_FILE']) as f:
+        token = f.read().strip()
+    return Client(token, os.environ['GITHUB_REPO'],
+                  os.environ['GITHUB_USERNAME'],
+                  os.environ.get('PULL_REQUEST_GITHUB_CACHE'))
+
+
+def iter_open_pulls(client, context='gentoo-ci'):
+    """
+    Iterate over all open PRs in the repo, yielding PullRequest tuples.
+    ci_state is the state of the newest context status posted by
+    the client user on the PR head, or None if there is none.
+    """
+    owner, name = client.repo.split('/', 1)
+    cursor = None
+    while True:
+        data = client.graphql(OPEN_PULLS_QUERY, {
+            'owner': owner,
+            'name': name,
+            'context': context,
+            'cursor': cursor,
+        })
+        pulls = data['repository']['pullRequests']
+        for node in pulls['nodes']:
+            ci_state = None
+            commits = node['commits']['nodes']
+            if commits:
+                status = commits[0]['commit']['status']
+                st = status and status['context']
+                # foreign statuses do not count
+                if st and (st['creator'] or {}).get('login') == client.login:
+                    ci_state = st['state'].lower()
+            yield PullRequest(
+                    number=node['number'],
+                    head_sha=node['headRefOid'],
+                    labels=frozenset(l['name']
+                                     for l in node['labels']['nodes']),
+                    updated_at=node['updatedAt'],
+                    ci_state=ci_state,
+                    changed_files=node['changedFiles'],
+                    # only the first 100 files
+                    files=tuple(f['path'] for f
+                                in (node['files'] or {}).get('nodes', [])))
+        if not pulls['pageInfo']['hasNextPage']:
+            break
+        cursor = pulls['pageInfo']['endCursor']
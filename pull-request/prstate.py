@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# Pull request state database (SQLite), and a small CLI to query it.
+
+import argparse
+import contextlib
+import datetime
+import errno
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pulls (
+    number INTEGER PRIMARY KEY,
+    -- last head taken for processing ('' if it needs to be checked)
+    head TEXT NOT NULL DEFAULT '',
+    -- queued, running, success, failure, error, noci, closed
+    status TEXT,
+    queued_head TEXT,
+    queue_position INTEGER,
+    enqueued_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    borked INTEGER,
+    pre_borked INTEGER,
+    report_hash TEXT,
+    -- worker processing the PR
+    worker TEXT,
+    -- last status published on GitHub
+    published_head TEXT,
+    published_state TEXT,
+    published_desc TEXT,
+    -- id of the report comment, edited by subsequent reports
+    report_comment INTEGER
+);
+CREATE INDEX IF NOT EXISTS pulls_queue ON pulls (status, queue_position);
+
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    number INTEGER NOT NULL,
+    head TEXT,
+    event TEXT NOT NULL,
+    time REAL NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS history_number ON history (number, time);
+'''
+
+# columns added after the initial schema
+NEW_COLUMNS = (
+    ('pulls', 'worker', 'TEXT'),
+    ('pulls', 'report_comment', 'INTEGER'),
+)
+
+
+class PullRequestDB(object):
+    def __init__(self, path, pickle_path=None, check_same_thread=True):
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, timeout=300,
+                                    isolation_level=None,
+                                    check_same_thread=check_same_thread)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        for table, column, ctype in NEW_COLUMNS:
+            columns = [row['name'] for row in self.conn.execute(
+                'PRAGMA table_info({})'.format(table))]
+            if column not in columns:
+                self.conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, column, ctype))
+        if is_new and pickle_path is not None:
+            self.import_pickle(pickle_path)
+
+    def close(self):
+        self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self.conn.execute('COMMIT')
+
+    def import_pickle(self, path):
+        """Import the old PR -> head pickle, if it exists."""
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+        heads = data['heads'] if 'heads' in data else data
+        published = data.get('published', {}) if 'heads' in data else {}
+        with self.transaction():
+            for number, head in heads.items():
+                self.set_head(number, head)
+                self.log(number, head, 'imported')
+            for number, (head, state, desc) in published.items():
+                self.set_published(number, head, state, desc)
+        return len(heads)
+
+    def log(self, number, head, event, detail=None):
+        self.conn.execute('''
+            INSERT INTO history (number, head, event, time, detail)
+            VALUES (?, ?, ?, ?, ?)''',
+            (number, head, event, time.time(), detail))
+
+    def get(self, number):
+        return self.conn.execute('SELECT * FROM pulls WHERE number = ?',
+                                 (number,)).fetchone()
+
+    def heads(self):
+        return dict(self.conn.execute(
+                'SELECT number, head FROM pulls WHERE status IS NOT ?',
+                ('noci',)))
+
+    def published(self):
+        return dict((row[0], tuple(row[1:])) for row in self.conn.execute('''
+            SELECT number, published_head, published_state, published_desc
+            FROM pulls WHERE published_head IS NOT NULL'''))
+
+    def _ensure(self, number):
+        self.conn.execute('INSERT OR IGNORE INTO pulls (number) VALUES (?)',
+                          (number,))
+
+    def set_head(self, number, head):
+        self._ensure(number)
+        self.conn.execute('''
+            UPDATE pulls SET head = ?,
+                status = CASE status WHEN 'noci' THEN NULL ELSE status END
+            WHERE number = ?''', (head, number))
+
+    def set_published(self, number, head, state, desc):
+        self._ensure(number)
+        self.conn.execute('''
+            UPDATE pulls SET published_head = ?, published_state = ?,
+                published_desc = ?
+            WHERE number = ?''', (head, state, desc, number))
+
+    def clear_published(self, number):
+        self.conn.execute('''
+            UPDATE pulls SET published_head = NULL, published_state = NULL,
+                published_desc = NULL
+            WHERE number = ?''', (number,))
+
+    def enqueue(self, number, head, position):
+        row = self.get(number)
+        if (row is None or row['status'] not in ('queued', 'running')
+                or row['queued_head'] != head):
+            self._ensure(number)
+            self.conn.execute('''
+                UPDATE pulls SET status = 'queued', queued_head = ?,
+                    enqueued_at = ?, started_at = NULL, finished_at = NULL
+                WHERE number = ?''', (head, time.time(), number))
+            self.log(number, head, 'queued')
+        self.conn.execute('UPDATE pulls SET queue_position = ? '
+                          'WHERE number = ?', (position, number))
+
+    def next_position(self, priority=False):
+        """Return queue position for a PR queued outside the scan."""
+        first, last = self.conn.execute('''
+            SELECT MIN(queue_position), MAX(queue_position) FROM pulls
+            WHERE status = 'queued' ''').fetchone()
+        if priority:
+            return min(first or 1, 1) - 1
+        return (last or 0) + 1
+
+    def mark_closed(self, number, head):
+        self._ensure(number)
+        self.conn.execute('''
+            UPDATE pulls SET status = 'closed', queue_position = NULL,
+                published_head = NULL, published_state = NULL,
+                published_desc = NULL
+            WHERE number = ? AND status IS NOT 'running' ''', (number,))
+        self.log(number, head, 'closed')
+
+    def start(self, number, head, worker=None):
+        self._ensure(number)
+        self.conn.execute('''
+            UPDATE pulls SET status = 'running', head = ?, queued_head = ?,
+                queue_position = 0, started_at = ?, finished_at = NULL,
+                worker = ?
+            WHERE number = ?''', (head, head, time.time(), worker, number))
+        self.log(number, head, 'started', worker)
+
+    def claim(self, worker):
+        """Atomically take the first queued PR, returning its number."""
+        with self.transaction():
+            row = self.conn.execute('''
+                SELECT number, queued_head FROM pulls
+                WHERE status = 'queued' AND worker IS NULL
+                ORDER BY queue_position LIMIT 1''').fetchone()
+            if row is None:
+                return None
+            self.start(row['number'], row['queued_head'], worker)
+            return row['number']
+
+    def finish(self, number, head, status, borked=None, pre_borked=None,
+               report_hash=None):
+        self._ensure(number)
+        # a newer head queued in the meantime stays in the queue
+        self.conn.execute('''
+            UPDATE pulls SET
+                status = CASE WHEN status = 'queued' AND queued_head IS NOT ?
+                    THEN status ELSE ? END,
+                queue_position = CASE WHEN status = 'queued'
+                    AND queued_head IS NOT ? THEN queue_position END,
+                finished_at = ?, borked = ?, pre_borked = ?,
+                report_hash = ?, worker = NULL
+            WHERE number = ?''',
+            (head, status, head, time.time(), borked, pre_borked,
+             report_hash, number))
+        self.log(number, head, status, report_hash)
+
+    def cancel(self, number, head):
+        """Release the worker of a check superseded by a newer head."""
+        self.conn.execute('UPDATE pulls SET worker = NULL WHERE number = ?',
+                          (number,))
+        self.log(number, head, 'cancelled')
+
+    def superseded(self):
+        """Return numbers of running PRs whose newer head is queued."""
+        return [row['number'] for row in self.conn.execute('''
+            SELECT number FROM pulls
+            WHERE status = 'queued' AND worker IS NOT NULL''')]
+
+    def set_report_comment(self, number, comment_id):
+        self._ensure(number)
+        self.conn.execute('UPDATE pulls SET report_comment = ? '
+                          'WHERE number = ?', (comment_id, number))
+
+    def skip(self, number, head):
+        """Mark a PR as excluded from CI (noci)."""
+        self._ensure(number)
+        self.conn.execute('''
+            UPDATE pulls SET status = 'noci', head = '', queued_head = NULL,
+                queue_position = NULL
+            WHERE number = ?''', (number,))
+        self.log(number, head, 'noci')
+
+    def dequeue_others(self, queued, open_numbers):
+        """Drop queue state for PRs that were not queued this time."""
+        for row in self.conn.execute('''
+                SELECT number, status, queued_head FROM pulls
+                WHERE status = 'queued' OR published_head IS NOT NULL'''
+                ).fetchall():
+            number = row['number']
+            if number not in open_numbers:
+                self.conn.execute('''
+                    UPDATE pulls SET status = 'closed', queue_position = NULL,
+                        published_head = NULL, published_state = NULL,
+                        published_desc = NULL
+                    WHERE number = ?''', (number,))
+                self.log(number, row['queued_head'], 'closed')
+            elif row['status'] == 'queued' and number not in queued:
+                self.conn.execute('''
+                    UPDATE pulls SET status = NULL, queue_position = NULL
+                    WHERE number = ?''', (number,))
+                self.log(number, row['queued_head'], 'dequeued')
+
+
+def open_db():
+    """Open the database specified in the environment."""
+    return PullRequestDB(os.environ['PULL_REQUEST_DB'],
+                         os.environ.get('PULL_REQUEST_PICKLE_DB'))
+
+
+def format_time(ts):
+    if ts is None:
+        return '-'
+    return datetime.datetime.fromtimestamp(
+            ts, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def cmd_list(db, args):
+    q = 'SELECT * FROM pulls'
+    params = ()
+    if args.status:
+        q += ' WHERE status = ?'
+        params = (args.status,)
+    q += ' ORDER BY queue_position IS NULL, queue_position, number'
+    for row in db.conn.execute(q, params):
+        print('{:>6} {:<8} {:>4} {:<12} {} {}'.format(
+            row['number'], row['status'] or '-',
+            row['queue_position'] if row['queue_position'] is not None
+            else '-',
+            (row['queued_head'] or row['head'] or '-')[:12],
+            format_time(row['enqueued_at']), row['worker'] or ''))
+
+
+def cmd_show(db, args):
+    row = db.get(args.number)
+    if row is None:
+        print('{}: not found'.format(args.number), file=sys.stderr)
+        return 1
+    for k in row.keys():
+        v = row[k]
+        if k.endswith('_at'):
+            v = format_time(v)
+        print('{}: {}'.format(k, v))
+    print()
+    for ev in db.conn.execute('SELECT * FROM history WHERE number = ? '
+                              'ORDER BY time, id', (args.number,)):
+        print('{} {:<8} {} {}'.format(format_time(ev['time']), ev['event'],
+                                      (ev['head'] or '-')[:12],
+                                      ev['detail'] or ''))
+
+
+def cmd_head(db, args):
+    row = db.get(args.number)
+    if row is None or not row['head']:
+        return 1
+    print(row['head'])
+
+
+def cmd_claim(db, args):
+    number = db.claim(args.worker)
+    if number is None:
+        return 1
+    print(number)
+
+
+def cmd_start(db, args):
+    with db.transaction():
+        db.start(args.number, args.head, args.worker)
+
+
+def cmd_finish(db, args):
+    with db.transaction():
+        row = db.get(args.number)
+        head = row['head'] if row is not None else None
+        db.finish(args.number, head, args.status, report_hash=args.report)
+
+
+def cmd_latency(db, args):
+    since = time.time() - args.days * 86400
+    rows = db.conn.execute('''
+        SELECT h1.number, h1.time AS queued, h2.time AS started,
+            h3.time AS finished
+        FROM history h1
+        JOIN history h2 ON h2.number = h1.number AND h2.head = h1.head
+            AND h2.event = 'started' AND h2.time >= h1.time
+        LEFT JOIN history h3 ON h3.number = h1.number AND h3.head = h1.head
+            AND h3.event IN ('success', 'failure', 'error')
+            AND h3.time >= h2.time
+        WHERE h1.event = 'queued' AND h1.time >= ?
+        GROUP BY h1.id''', (since,)).fetchall()
+    if not rows:
+        print('No finished checks in the last {} days'.format(args.days))
+        return 0
+
+    waits = [r['started'] - r['queued'] for r in rows]
+    runs = [r['finished'] - r['started'] for r in rows if r['finished']]
+    totals = [r['finished'] - r['queued'] for r in rows if r['finished']]
+    for name, values in (('queue wait', waits), ('check time', runs),
+                         ('time to report', totals)):
+        if not values:
+            continue
+        print('{:<15} n={:<5} p50={:>7.1f}m p90={:>7.1f}m max={:>7.1f}m'
+              .format(name, len(values), percentile(values, 50) / 60,
+                      percentile(values, 90) / 60, max(values) / 60))
+
+
+def cmd_import(db, args):
+    print('Imported {} PRs'.format(db.import_pickle(args.path)))
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Query the pull request state database')
+    argp.add_argument('-d', '--db', default=os.environ.get('PULL_REQUEST_DB'),
+                      help='Database path (default: $PULL_REQUEST_DB)')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('list', help='List known PRs, queue first')
+    p.add_argument('-s', '--status', help='Limit to PRs in given status')
+    p.set_defaults(func=cmd_list)
+    p = subp.add_parser('show', help='Show PR state and history')
+    p.add_argument('number', type=int)
+    p.set_defaults(func=cmd_show)
+    p = subp.add_parser('head', help='Print the head being checked for PR')
+    p.add_argument('number', type=int)
+    p.set_defaults(func=cmd_head)
+    p = subp.add_parser('claim', help='Take the first queued PR for worker')
+    p.add_argument('worker')
+    p.set_defaults(func=cmd_claim)
+    p = subp.add_parser('start', help='Record PR check start at given head')
+    p.add_argument('number', type=int)
+    p.add_argument('head')
+    p.add_argument('worker', nargs='?')
+    p.set_defaults(func=cmd_start)
+    p = subp.add_parser('finish', help='Record PR check result')
+    p.add_argument('number', type=int)
+    p.add_argument('status', help='Resulting status (e.g. error)')
+    p.add_argument('-r', '--report', help='Report commit hash')
+    p.set_defaults(func=cmd_finish)
+    p = subp.add_parser('latency', help='Print queue latency statistics')
+    p.add_argument('--days', type=int, default=7,
+                   help='Time range to consider (default: 7 days)')
+    p.set_defaults(func=cmd_latency)
+    p = subp.add_parser('import-pickle', help='Import old pickle state')
+    p.add_argument('path')
+    p.set_defaults(func=cmd_import)
+
+    args = argp.parse_args()
+    if not args.db:
+        argp.error('no database specified (-d or PULL_REQUEST_DB)')
+    db = PullRequestDB(args.db)
+    try:
+        return args.func(db, args)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
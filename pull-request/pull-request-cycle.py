@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Run a whole pull request cycle in one process: scan open PRs, keep
+# the worker slots busy with pull-request-worker.bash, and post their
+# statuses and reports. All GitHub calls share a single client, so its
+# connection, ETag cache and rate limit state are reused throughout.
+
+import argparse
+import importlib.util
+import os
+import os.path
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import ghapi
+import prstate
+import spans
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# seconds between checks for superseded heads (in the state database,
+# e.g. updated by webhook-service.py)
+POLL_INTERVAL = 5
+# seconds between scans of open PRs while workers are busy
+RESCAN_INTERVAL = 300
+
+
+def load_script(name):
+    """Import one of the pull request scripts as a module."""
+    spec = importlib.util.spec_from_file_location(
+            name.replace('-', '_'), os.path.join(SCRIPT_DIR, name + '.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+class Cycle(object):
+    def __init__(self, client, state, pull_dir, workers):
+        self.client = client
+        self.state = state
+        self.pull_dir = pull_dir
+        self.workers = workers
+        self.scanner = load_script('scan-pull-requests')
+        self.reporter = load_script('report-pull-request')
+        self.running = {}
+        self.env = dict(os.environ, PULL_REQUEST_DEFER_REPORT='1')
+
+    def slot_path(self, slot, name):
+        return os.path.join(self.pull_dir, 'w{}'.format(slot), name)
+
+    def handle_crash(self, slot, prid=None):
+        marker = self.slot_path(slot, 'current-pr')
+        if prid is None:
+            try:
+                with open(marker) as f:
+                    prid = f.read().strip()
+            except (IOError, OSError):
+                return
+            if not prid:
+                return
+        prid = int(prid)
+
+        # the head being checked, set by start(); a newer queued head
+        # has not been checked yet
+        row = self.state.get(prid)
+        head = row is not None and row['head']
+        if head:
+            self.client.create_status(head, 'error',
+                    'QA checks crashed. Please rebase and check profile '
+                    'changes for syntax errors.')
+        with self.state.transaction():
+            self.state.finish(prid, head or None, 'error')
+        subprocess.run(['sendmail', os.environ['CRONJOB_ADMIN_MAIL']],
+                       input='''Subject: Pull request crash: {prid}
+To: <{to}>
+Content-Type: text/plain; charset=utf8
+
+It seems that pull request check for {prid} crashed [1].
+
+[1]:{repo}/pull/{prid}
+'''.format(prid=prid, to=os.environ['CRONJOB_ADMIN_MAIL'],
+           repo=os.environ['PULL_REQUEST_REPO']).encode(), check=False)
+        try:
+            os.unlink(marker)
+        except (IOError, OSError):
+            pass
+
+    def start(self, slot, prid):
+        head = self.state.get(prid)['queued_head']
+        self.client.create_status(head, 'pending', 'QA checks in progress...')
+        try:
+            os.unlink(self.slot_path(slot, 'report'))
+        except (IOError, OSError):
+            pass
+        log = open(self.slot_path(slot, 'log'), 'wb')
+        p = subprocess.Popen(
+                [os.path.join(SCRIPT_DIR, 'pull-request-worker.bash'),
+                 str(slot), str(prid)],
+                stdout=log, stderr=subprocess.STDOUT, env=self.env,
+                start_new_session=True)
+        log.close()
+        p.start_time = time.time()
+        self.running[p.pid] = (slot, prid, p)
+
+    def kill(self, p):
+        """Terminate worker p along with its children."""
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        p.wait()
+
+    def cancel_superseded(self):
+        """Stop checks of PRs whose head moved since they started."""
+        superseded = set(self.state.superseded())
+        for pid, (slot, prid, p) in list(self.running.items()):
+            if prid not in superseded:
+                continue
+            print('{}: head moved, cancelling check in w{}'.format(
+                prid, slot), file=sys.stderr)
+            del self.running[pid]
+            self.kill(p)
+            with self.state.transaction():
+                self.state.cancel(prid, self.state.get(prid)['head'])
+            try:
+                os.unlink(self.slot_path(slot, 'current-pr'))
+            except (IOError, OSError):
+                pass
+
+    def finish(self, slot, prid, ret):
+        # include worker output in the cronjob log
+        sys.stdout.flush()
+        with open(self.slot_path(slot, 'log'), 'rb') as f:
+            shutil.copyfileobj(f, sys.stdout.buffer)
+        sys.stdout.flush()
+
+        if ret == 0:
+            try:
+                with open(self.slot_path(slot, 'report')) as f:
+                    args = f.read().splitlines()
+                with spans.span('report'):
+                    self.reporter.report(self.client, self.state, *args)
+            except Exception as e:
+                print('{}: report failed: {}'.format(prid, e),
+                      file=sys.stderr)
+                ret = 1
+        if ret != 0:
+            self.handle_crash(slot, prid)
+            return False
+        return True
+
+    def run(self):
+        for slot in range(self.workers):
+            self.handle_crash(slot)
+
+        ok = True
+        next_scan = 0
+        try:
+            while True:
+                # rescan when a worker finishes, and periodically to
+                # notice PRs updated while their check is running
+                if time.time() >= next_scan:
+                    with spans.span('scan'):
+                        self.scanner.scan(self.client, self.state)
+                    next_scan = time.time() + RESCAN_INTERVAL
+                self.cancel_superseded()
+
+                busy = set(slot for slot, prid, p in self.running.values())
+                for slot in range(self.workers):
+                    if slot in busy:
+                        continue
+                    prid = self.state.claim('w{}'.format(slot))
+                    if prid is None:
+                        break
+                    self.start(slot, prid)
+
+                if not self.running:
+                    break
+
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                if pid not in self.running:
+                    continue
+                slot, prid, p = self.running.pop(pid)
+                p.returncode = os.waitstatus_to_exitcode(status)
+                spans.record('check', p.start_time, time.time(),
+                             status=p.returncode)
+                if not self.finish(slot, prid, p.returncode):
+                    ok = False
+                next_scan = 0
+        finally:
+            for slot, prid, p in self.running.values():
+                self.kill(p)
+        return ok
+
+
+def terminate(signum, frame):
+    sys.exit(128 + signum)
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Scan, check and report pull requests')
+    argp.add_argument('-j', '--workers', type=int,
+                      default=int(os.environ.get('PULL_REQUEST_WORKERS', 1)),
+                      help='Number of worker slots '
+                           '(default: $PULL_REQUEST_WORKERS)')
+    args = argp.parse_args()
+
+    signal.signal(signal.SIGTERM, terminate)
+    client = ghapi.open_client()
+    state = prstate.open_db()
+    try:
+        cycle = Cycle(client, state, os.environ['PULL_REQUEST_DIR'],
+                      args.workers)
+        ret = 0 if cycle.run() else 1
+    finally:
+        state.close()
+        client.close()
+    print('GitHub API responses: {}'.format(
+        ', '.join('{}: {}'.format(k, v) for k, v
+                  in sorted(client.stats.items()))), file=sys.stderr)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
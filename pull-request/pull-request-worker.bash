@@ -0,0 +1,268 @@
+#!/bin/bash
+# Check a single pull request in worker slot ${1}.
+
+set -e -x
+
+. "${SCRIPT_DIR}"/utils/spans.bash
+
+# SANITY!
+export TZ=UTC
+
+slot=${1}
+prid=${2}
+
+sync=${SYNC_DIR}/gentoo
+mirror=${MIRROR_DIR}/gentoo
+gentooci=${GENTOO_CI_GIT}
+pull=${PULL_REQUEST_DIR}/w${slot}
+jobs=${PULL_REQUEST_JOBS:-16}
+
+[[ ${slot} && ${prid} ]]
+
+# find the note in ref ${1} for commit ${2} or its closest ancestor
+# having one, print "<commit> <note>"
+find_note() {
+	local ref=${1}
+	local commit=${2}
+	local blob obj c
+	local -A notes=()
+
+	while read blob obj; do
+		notes[${obj}]=${blob}
+	done < <(git notes --ref="${ref}" list 2>/dev/null)
+	[[ ${#notes[@]} -gt 0 ]] || return 0
+
+	while read c; do
+		if [[ ${notes[${c}]} ]]; then
+			echo "${c} $(git cat-file blob "${notes[${c}]}")"
+			return 0
+		fi
+	done < <(git rev-list --max-count=1000 "${commit}")
+}
+
+# print packages changed between commits ${1} and ${2}, fail if
+# the changes can affect results for other packages too
+changed_pkgs() {
+	local path pn
+
+	while IFS= read -r -d '' path; do
+		case ${path} in
+			metadata/md5-cache/*|metadata/dtd/*|metadata/glsa/*)
+				;;
+			metadata/news/*|metadata/xml-schema/*)
+				;;
+			eclass/*|licenses/*|metadata/*|profiles/*)
+				return 1
+				;;
+			*/*/*)
+				pn=${path#*/}
+				echo "${path%%/*}/${pn%%/*}"
+				;;
+			*/*)
+				return 1
+				;;
+		esac
+	done < <(git diff --name-only --no-renames -z "${1}" "${2}")
+}
+
+echo "${prid}" > "${pull}"/current-pr
+
+cd -- "${sync}"
+ref=refs/pull/${prid}
+span fetch "" \
+	git fetch --no-write-fetch-head -f origin "refs/pull/${prid}/head:${ref}"
+
+hash=$(git rev-parse "${ref}")
+queued_hash=$("${SCRIPT_DIR}"/pull-request/prstate.py head "${prid}")
+# the PR could have been updated since it was queued
+if [[ ${hash} != ${queued_hash} ]]; then
+	"${SCRIPT_DIR}"/pull-request/prstate.py start "${prid}" "${hash}" "w${slot}"
+fi
+# pull-request-cycle.py marks the queued head in progress itself
+if [[ ! ${PULL_REQUEST_DEFER_REPORT} || ${hash} != ${queued_hash} ]]; then
+	"${SCRIPT_DIR}"/pull-request/set-pull-request-status.py "${hash}" pending \
+		"QA checks in progress..."
+fi
+
+cd -- "${pull}"
+# the working trees are kept between runs and reset for every PR
+if [[ ! -d tmp/.git ]]; then
+	rm -rf -- tmp
+	git clone -s --no-checkout "${mirror}" tmp
+fi
+cd -- tmp
+# a cancelled check can leave a stale lock behind
+rm -f .git/index.lock
+git fetch -q origin +master:refs/remotes/origin/master
+git fetch -q origin +refs/notes/md5-cache:refs/notes/md5-cache || :
+git fetch -q origin +refs/notes/gentoo-ci:refs/notes/gentoo-ci || :
+git fetch "${sync}" "+${ref}:${ref}"
+# start on top of last common commit, like fast-forward would do
+base=$(git merge-base "${ref}" origin/master)
+# find the mirror commit with md5-cache for base (or its closest ancestor)
+cache_base=
+cache_commit=
+read cache_base cache_commit < <(find_note md5-cache "${base}") || :
+
+if [[ ${cache_commit} ]] && git cat-file -e "${cache_commit}^{commit}"; then
+	# the mirror commit has the exact cache for its sync commit, and its
+	# tree differs from base only by the commits since
+	git checkout -q -f -B pull "${cache_commit}"
+	git clean -q -f -d -x
+	git merge -q -m "Update to ${base}" "${base}"
+else
+	git checkout -q -f -B pull "${base}"
+	git clean -q -f -d -x
+	# copy existing md5-cache
+	git restore --source=origin/master --worktree -- metadata/md5-cache
+fi
+git restore --source=origin/master --worktree -- \
+	metadata/{dtd,glsa,news,xml-schema}
+
+# merge the PR on top of cache
+git tag -f pre-merge
+git merge --quiet -m "Merge PR ${prid}" "${ref}"
+
+# update cache (incrementally if we know which commit it is for)
+CONFIG_DIR=${pull}/etc/portage
+time span regen "" timeout -k 30s "${PMAINT_TIMEOUT}" \
+	"${SCRIPT_DIR}"/repos/incremental-regen.py --config "${CONFIG_DIR}" \
+	--use-local-desc --pkg-desc-index -t "${jobs}" \
+	--index "${pull}"/eclass-index.json gentoo ${cache_base} || :
+
+cd ..
+if [[ ! -d gentoo-ci/.git ]]; then
+	rm -rf -- gentoo-ci
+	git clone -s "${gentooci}" gentoo-ci
+fi
+cd -- gentoo-ci
+rm -f .git/index.lock
+git fetch -q origin HEAD
+git checkout -q -f -B pull FETCH_HEAD
+git clean -q -f -d -x
+( cd -- "${pull}"/tmp &&
+	time HOME=${pull}/gentoo-ci \
+	span scan "" timeout -k 30s "${CI_TIMEOUT}" pkgcheck --config "${CONFIG_DIR}" \
+		scan --reporter XmlReporter --jobs "${jobs}" ${PKGCHECK_PR_OPTIONS}
+) | "${SCRIPT_DIR}"/gentoo-ci/sort-results.py \
+	-o output.xml -i results.jsonl \
+	-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
+	--list='-w -e:borked.list' -
+# ^^ Sort XML for better Git delta compression
+ts=$(cd -- "${pull}"/tmp; git log --pretty='%ct' -1)
+
+git add -- *.xml results.jsonl
+git diff --cached --quiet --exit-code || git commit -a -m "PR ${prid} @ $(date -u --date="@${ts}" "+%Y-%m-%d %H:%M:%S UTC")"
+pr_hash=$(git rev-parse --short HEAD)
+span push "" git push -f origin "HEAD:refs/heads/pull-${prid}"
+
+cd -- "${gentooci}"
+span push "" git push -f origin "pull-${prid}"
+curl "https://qa-reports-cdn-origin.gentoo.org/cgi-bin/trigger-pull.cgi?gentoo-ci" || :
+
+# if we have any breakages...
+if [[ -s ${pull}/gentoo-ci/borked.list ]]; then
+	# go back to pre-merge state and see if they were there
+	cd -- "${pull}"/tmp
+	git checkout -q pre-merge
+
+	# gentoo-ci results for base (or its closest scanned ancestor) serve
+	# as the baseline, only packages changed since need to be rechecked
+	ci_base=
+	ci_commit=
+	read ci_base ci_commit < <(find_note gentoo-ci "${base}") || :
+	if [[ ${ci_commit} ]] &&
+		git -C "${gentooci}" cat-file -e "${ci_commit}:output.xml" &&
+		changed_pkgs "${ci_base}" "${base}" > .stale.list
+	then
+		git -C "${gentooci}" show "${ci_commit}:output.xml" > .baseline.xml
+		"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
+			-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
+			-w -e -o .baseline.borked .baseline.xml
+		grep -v -x -F -f .stale.list .baseline.borked \
+			> .pre-merge.borked || :
+
+		# borked packages that changed since the scanned commit
+		pkgs=()
+		while read l; do
+			[[ ${l} ]] && pkgs+=( "${l}" )
+		done < <(grep -x -F -f .stale.list "${pull}"/gentoo-ci/borked.list)
+
+		# reuse results stored by earlier PRs with the same base
+		if [[ ${#pkgs[@]} -gt 0 && ${PKGCHECK_RESULT_DB} ]]; then
+			store_key=$("${SCRIPT_DIR}"/gentoo-ci/resultstore.py key \
+				"${PKGCHECK_PR_OPTIONS} -s pkg,ver -w -e")
+			declare -A known=()
+			while read p flags; do
+				known[${p}]=1
+				[[ ${flags} == - ]] || echo "${p}" >> .pre-merge.borked
+			done < <("${SCRIPT_DIR}"/gentoo-ci/resultstore.py lookup \
+				"${store_key}" "${base}" "${pkgs[@]}")
+			for i in "${!pkgs[@]}"; do
+				[[ ! ${known[${pkgs[${i}]}]} ]] || unset "pkgs[${i}]"
+			done
+		fi
+
+		if [[ ${#pkgs[@]} -gt 0 ]]; then
+			span scan-base "" pkgcheck --config "${CONFIG_DIR}" \
+				scan --reporter XmlReporter "${pkgs[@]}" \
+				--jobs "${jobs}" ${PKGCHECK_PR_OPTIONS} \
+				-s pkg,ver \
+				> .pre-merge.xml
+			"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
+				-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
+				-w -e -o .pre-merge-stale.borked .pre-merge.xml
+			cat .pre-merge-stale.borked >> .pre-merge.borked
+			if [[ ${PKGCHECK_RESULT_DB} ]]; then
+				"${SCRIPT_DIR}"/gentoo-ci/resultstore.py store \
+					-l b:.pre-merge-stale.borked \
+					"${store_key}" "${base}" "${pkgs[@]}"
+			fi
+		fi
+	else
+		pkgs=()
+		while read l; do
+			[[ ${l} ]] && pkgs+=( "${l}" )
+		done <"${pull}"/gentoo-ci/borked.list
+
+		if [[ ${#pkgs[@]} -le ${PULL_REQUEST_BORKED_LIMIT} ]]; then
+			outfiles=()
+
+			if [[ ${#pkgs[@]} -gt 0 ]]; then
+				span scan-base "" pkgcheck --config "${CONFIG_DIR}" \
+					scan --reporter XmlReporter "${pkgs[@]}" \
+					--jobs "${jobs}" ${PKGCHECK_PR_OPTIONS} \
+					-s pkg,ver \
+					> .pre-merge.xml
+				outfiles+=( .pre-merge.xml )
+			fi
+
+			span scan-base "" pkgcheck --config "${CONFIG_DIR}" \
+				scan --reporter XmlReporter "*/*" \
+				--jobs "${jobs}" ${PKGCHECK_PR_OPTIONS} \
+				-s repo,cat \
+				> .pre-merge-g.xml
+			outfiles+=( .pre-merge-g.xml )
+
+			"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
+				-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
+				-w -e -o .pre-merge.borked "${outfiles[@]}"
+		else
+			echo ETOOMANY > .pre-merge.borked
+		fi
+	fi
+fi
+
+cd -- "${pull}"/tmp
+if [[ ${PULL_REQUEST_DEFER_REPORT} ]]; then
+	# pull-request-cycle.py posts the report using its GitHub client
+	printf '%s\n' "${prid}" "${pr_hash}" "${pull}"/gentoo-ci/borked.list \
+		"${PWD}"/.pre-merge.borked "${hash}" > "${pull}"/report
+else
+	"${SCRIPT_DIR}"/pull-request/report-pull-request.py "${prid}" "${pr_hash}" \
+		"${pull}"/gentoo-ci/borked.list .pre-merge.borked "${hash}"
+fi
+
+git update-ref -d "${ref}"
+
+rm -f -- "${pull}"/current-pr
@@ -5,67 +5,66 @@ import os
 import os.path
 import sys
 
-import github
-
-
-def main(prid, prhash, borked_path, pre_borked_path, commit_hash):
-    GITHUB_USERNAME = os.environ['GITHUB_USERNAME']
-    GITHUB_TOKEN_FILE = os.environ['GITHUB_TOKEN_FILE']
-    GITHUB_REPO = os.environ['GITHUB_REPO']
-
+import ghapi
+import prstate
+
+
+def report_status(body):
+    """
+    Return whether a report comment listed issues, or None if it does
+    not look like a CI report.
+    """
+    if 'All QA issues have been fixed' in body:
+        return False
+    elif 'has found no issues' in body:
+        return False
+    elif 'No issues found' in body:
+        return False
+    elif 'New issues' in body:
+        return True
+    elif 'Issues already there' in body:
+        return True
+    elif 'Issues inherited from Gentoo' in body:
+        return True
+    elif 'There are existing issues already' in body:
+        return True
+    elif 'There are too many broken packages' in body:
+        return True
+    return None
+
+
+def report(client, state, prid, prhash, borked_path, pre_borked_path,
+           commit_hash):
     REPORT_URI_PREFIX = os.environ['GENTOO_CI_URI_PREFIX']
 
-    borked = []
     with open(borked_path) as f:
-        for l in f:
-            borked.append(REPORT_URI_PREFIX + '/' + prhash + '/output.html#' + l)
+        borked = set(l.strip() for l in f if l.strip())
 
-    pre_borked = []
+    pre_borked = set()
     too_many_borked = False
     if borked:
         with open(pre_borked_path) as f:
-            for l in f:
-                if l.strip() == 'ETOOMANY':
-                    too_many_borked = True
-                    break
-
-                lf = REPORT_URI_PREFIX + '/' + prhash + '/output.html#' + l
-                if lf in borked:
-                    pre_borked.append(lf)
-                    borked.remove(lf)
-
-    with open(GITHUB_TOKEN_FILE) as f:
-        token = f.read().strip()
-
-    g = github.Github(GITHUB_USERNAME, token, per_page=50)
-    r = g.get_repo(GITHUB_REPO)
-    pr = r.get_pull(int(prid))
-    c = r.get_commit(commit_hash)
-
-    # delete old results
-    had_broken = False
-    old_comments = []
-    # note: technically we could have multiple leftover comments
-    for co in pr.get_issue_comments():
-        if co.user.login == GITHUB_USERNAME:
-            if 'All QA issues have been fixed' in co.body:
-                had_broken = False
-            elif 'has found no issues' in co.body:
-                had_broken = False
-            elif 'No issues found' in co.body:
-                had_broken = False
-            elif 'New issues' in co.body:
-                had_broken = True
-            elif 'Issues already there' in co.body:
-                had_broken = True
-            elif 'Issues inherited from Gentoo' in co.body:
-                had_broken = True
-            else:
-                # skip comments that don't look like CI results
-                continue
-            old_comments.append(co)
-    for co in old_comments:
-        co.delete()
+            pre = set(l.strip() for l in f if l.strip())
+        if 'ETOOMANY' in pre:
+            too_many_borked = True
+        else:
+            pre_borked = borked & pre
+            borked -= pre
+
+    # find the previous report, preferably by the stored id
+    row = state.get(int(prid))
+    old_comment = None
+    if row is not None and row['report_comment'] is not None:
+        old_comment = client.get_comment(row['report_comment'])
+    if old_comment is None:
+        # reports are usually among the newest comments
+        for co in client.iter_comments(prid, newest_first=True):
+            if (co['user']['login'] == client.login
+                    and report_status(co['body']) is not None):
+                old_comment = co
+                break
+    had_broken = (old_comment is not None
+                  and report_status(old_comment['body']))
 
     report_url = REPORT_URI_PREFIX + '/' + prhash + '/output.html'
     body = '''## Pull request CI report
@@ -83,8 +82,9 @@ def main(prid, prhash, borked_path, pre_borked_path, commit_hash):
                 body += '\nThere are too many broken packages to determine whether the breakages were added by the pull request. If in doubt, please rebase.\n\nIssues:'
             else:
                 body += '\nNew issues caused by PR:\n'
-            for url in borked:
-                body += url
+            for pkg in sorted(borked):
+                body += (REPORT_URI_PREFIX + '/' + prhash
+                         + '/output.html#' + pkg + '\n')
         if pre_borked:
             body += '\nThere are existing issues already. Please look into the report to make sure none of them affect the packages in question:\n%s\n' % report_url
     elif had_broken:
@@ -92,17 +92,38 @@ def main(prid, prhash, borked_path, pre_borked_path, commit_hash):
     else:
         body += '\nNo issues found\n'
 
-    pr.create_issue_comment(body)
+    if old_comment is not None:
+        comment_id = client.edit_comment(old_comment['id'], body)['id']
+    else:
+        comment_id = client.create_comment(prid, body)['id']
 
     if borked:
-        c.create_status('failure', description='PR introduced new issues',
-                target_url=report_url, context='gentoo-ci')
+        client.create_status(commit_hash, 'failure',
+                'PR introduced new issues', target_url=report_url)
     elif pre_borked:
-        c.create_status('success', description='No new issues found',
-                target_url=report_url, context='gentoo-ci')
+        client.create_status(commit_hash, 'success',
+                'No new issues found', target_url=report_url)
     else:
-        c.create_status('success', description='All pkgcheck QA checks passed',
-                target_url=report_url, context='gentoo-ci')
+        client.create_status(commit_hash, 'success',
+                'All pkgcheck QA checks passed', target_url=report_url)
+
+    with state.transaction():
+        state.set_report_comment(int(prid), comment_id)
+        state.finish(int(prid), commit_hash,
+                     'failure' if borked else 'success',
+                     borked=len(borked), pre_borked=len(pre_borked),
+                     report_hash=prhash)
+
+
+def main(*args):
+    client = ghapi.open_client()
+    state = prstate.open_db()
+    try:
+        report(client, state, *args)
+    finally:
+        state.close()
+        client.close()
+    return 0
 
 
 if __name__ == '__main__':
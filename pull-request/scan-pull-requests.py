@@ -1,115 +1,231 @@
 #!/usr/bin/env python
-# Scan open pull requests, update their statuses and print the next
-# one for processing (if any).
+# Scan open pull requests, update their statuses and queue the ones
+# needing processing in the state database.
 
 from __future__ import print_function
 
-import errno
+import json
 import os
-import pickle
+import re
 import sys
+import time
+
+import ghapi
+import prstate
+
+
+# max number of status updates posted per run
+STATUS_BUDGET = int(os.environ.get('PULL_REQUEST_STATUS_BUDGET', 100))
+# API requests left untouched for other scripts
+RATE_LIMIT_RESERVE = 500
+
+
+# estimated seconds needed to check a PR: setup (fetching, merging,
+# regenerating metadata) and scanning a single package
+BASE_COST = 300
+PACKAGE_COST = 5
+# used when the eclass index is not available
+DEFAULT_ECLASS_USERS = 1000
+DEFAULT_PACKAGES = 20000
+# seconds of estimated cost forgiven per second spent in the queue,
+# so that large PRs are not starved by a stream of small ones
+AGING = 1.0
+
+VERSION_RE = re.compile(r'-[0-9][^-]*(-r[0-9]+)?$')
+
+
+class CostEstimator(object):
+    """Estimate PR check time from the files it changes."""
+
+    def __init__(self, index_path=None):
+        if index_path is None:
+            # maintained by incremental-regen.py in worker slots
+            index_path = os.path.join(os.environ['PULL_REQUEST_DIR'],
+                                      'w0', 'eclass-index.json')
+        self.index_path = index_path
+        self.consumers = None
+        self.packages = DEFAULT_PACKAGES
+
+    def load_index(self):
+        self.consumers = {}
+        try:
+            with open(self.index_path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        pkgs = set()
+        for key, (stamp, eclasses) in entries.items():
+            pkg = VERSION_RE.sub('', key)
+            pkgs.add(pkg)
+            for ec in eclasses:
+                self.consumers.setdefault(ec, set()).add(pkg)
+        self.packages = len(pkgs) or DEFAULT_PACKAGES
+
+    def eclass_users(self, eclass):
+        if self.consumers is None:
+            self.load_index()
+        if not self.consumers:
+            return DEFAULT_ECLASS_USERS
+        return len(self.consumers.get(eclass, ()))
+
+    def estimate(self, pr):
+        pkgs = set()
+        count = 0
+        for path in pr.files:
+            parts = path.split('/')
+            if parts[0] == 'eclass' and path.endswith('.eclass'):
+                count += self.eclass_users(parts[-1][:-len('.eclass')])
+            elif parts[0] in ('profiles', 'licenses'):
+                # can affect any package
+                if self.consumers is None:
+                    self.load_index()
+                count += self.packages
+            elif len(parts) >= 3 and parts[0] != 'metadata':
+                pkgs.add(parts[0] + '/' + parts[1])
+        count += len(pkgs)
+        # only the first 100 files are listed
+        if pr.files and pr.changed_files > len(pr.files):
+            count = count * pr.changed_files // len(pr.files)
+        return BASE_COST + min(count, self.packages) * PACKAGE_COST
+
+
+def scan(client, state):
+    """Scan open PRs using client, and queue them in state."""
+    db = state.heads()
+    # last status published per PR: (head, state, description)
+    published = state.published()
+    # keep the original values to store only what we changed
+    old_heads = dict(db)
+    old_published = dict(published)
+    noci = {}
 
-import github
-
-
-def main():
-    GITHUB_USERNAME = os.environ['GITHUB_USERNAME']
-    GITHUB_TOKEN_FILE = os.environ['GITHUB_TOKEN_FILE']
-    GITHUB_REPO = os.environ['GITHUB_REPO']
-    PULL_REQUEST_DB = os.environ['PULL_REQUEST_DB']
-
-    with open(GITHUB_TOKEN_FILE) as f:
-        token = f.read().strip()
-
-    db = {}
-    try:
-        with open(PULL_REQUEST_DB, 'rb') as f:
-            db = pickle.load(f)
-    except (IOError, OSError) as e:
-        if e.errno != errno.ENOENT:
-            raise
+    to_process = []
+    open_pulls = set()
 
-    g = github.Github(GITHUB_USERNAME, token, per_page=250)
-    r = g.get_repo(GITHUB_REPO)
+    # fetch the state of all open PRs in a few batched requests
+    # instead of querying statuses separately for every PR
+    for pr in ghapi.iter_open_pulls(client):
+        open_pulls.add(pr.number)
 
-    to_process = []
+        # forget the published status if it was replaced since
+        # (e.g. by the report)
+        last = published.get(pr.number)
+        if last is not None and last[:2] != (pr.head_sha, pr.ci_state):
+            del published[pr.number]
 
-    for pr in r.get_pulls():
         # skip PRs marked noci
-        if any(x.name == 'noci' for x in pr.labels):
+        if 'noci' in pr.labels:
             print('{}: noci'.format(pr.number),
                   file=sys.stderr)
 
             # if it made it to the cache, we probably need to wipe
             # pending status
             if pr.number in db:
-                commit = r.get_commit(pr.head.sha)
-                for status in commit.get_statuses():
-                    # skip foreign statuses
-                    if status.creator.login != GITHUB_USERNAME:
-                        continue
-                    # if it's pending, mark it done
-                    if status.state == 'pending':
-                        commit.create_status(
-                                context='gentoo-ci',
-                                state='success',
-                                description='Checks skipped due to [noci] label')
-                    break
+                # if it's pending, mark it done
+                if pr.ci_state == 'pending':
+                    client.create_status(
+                            pr.head_sha, 'success',
+                            'Checks skipped due to [noci] label')
                 del db[pr.number]
+                noci[pr.number] = pr.head_sha
 
             continue
 
-        # if it's not cached, get its status
+        # if it's not cached, use its status
         if pr.number not in db:
-            print('{}: updating status ...'.format(pr.number), file=sys.stderr)
-            commit = r.get_commit(pr.head.sha)
-            for status in commit.get_statuses():
-                # skip foreign statuses
-                if status.creator.login != GITHUB_USERNAME:
-                    continue
-                # if it's not pending, mark it done
-                if status.state != 'pending':
-                    db[pr.number] = commit.sha
-                    print('{}: at {}'.format(pr.number, commit.sha),
-                          file=sys.stderr)
-                else:
-                    db[pr.number] = ''
-                    print('{}: found pending'.format(pr.number),
-                          file=sys.stderr)
-                break
-            else:
+            if pr.ci_state is None:
                 db[pr.number] = ''
                 print('{}: unprocessed'.format(pr.number),
                       file=sys.stderr)
+            # if it's not pending, mark it done
+            elif pr.ci_state != 'pending':
+                db[pr.number] = pr.head_sha
+                print('{}: at {}'.format(pr.number, pr.head_sha),
+                      file=sys.stderr)
+            else:
+                db[pr.number] = ''
+                print('{}: found pending'.format(pr.number),
+                      file=sys.stderr)
 
-        if db.get(pr.number, '') != pr.head.sha:
+        if db.get(pr.number, '') != pr.head_sha:
             to_process.append(pr)
 
+    for prid in list(published):
+        if prid not in open_pulls:
+            del published[prid]
+
+    # stay within the budget and leave some API requests for the rest
+    # of the run; statuses that do not fit will be posted next time
+    budget = min(STATUS_BUDGET, client.budget(RATE_LIMIT_RESERVE))
+
+    # shortest job first, with priority increasing as PRs wait so that
+    # large ones are not starved
+    now = time.time()
+    estimator = CostEstimator()
+    priorities = {}
+    for pr in to_process:
+        cost = estimator.estimate(pr)
+        row = state.get(pr.number)
+        waited = 0
+        if (row is not None and row['status'] == 'queued'
+                and row['queued_head'] == pr.head_sha):
+            waited = now - row['enqueued_at']
+        priorities[pr.number] = cost - AGING * waited
+        print('{}: estimated {:.0f}s, waiting {:.0f}s'.format(
+            pr.number, cost, waited), file=sys.stderr)
     to_process = sorted(to_process,
-            key=lambda x: (not any(x.name == 'priority-ci' for x in x.labels), x.updated_at))
-    for i, pr in enumerate(to_process):
-        commit = r.get_commit(pr.head.sha)
-        if i == 0:
-            desc = 'QA checks in progress...'
-            db[pr.number] = commit.sha
-        else:
-            desc = 'QA checks pending. Currently {}. in queue.'.format(i)
-        commit.create_status(
-                context='gentoo-ci',
-                state='pending',
-                description=desc)
+            key=lambda x: ('priority-ci' not in x.labels,
+                           priorities[x.number], x.updated_at))
+    skipped = 0
+    for i, pr in enumerate(to_process, 1):
+        desc = 'QA checks pending. Currently {}. in queue.'.format(i)
 
         print('{}: {} -> {}'.format(pr.number,
-                db.get(pr.number, '') or '(none)', pr.head.sha),
+                db.get(pr.number, '') or '(none)', pr.head_sha),
+              file=sys.stderr)
+
+        # only post statuses that changed since the last run
+        status = (pr.head_sha, 'pending', desc)
+        if published.get(pr.number) == status:
+            continue
+        if budget <= 0:
+            skipped += 1
+            continue
+
+        client.create_status(pr.head_sha, 'pending', desc)
+        published[pr.number] = status
+        budget -= 1
+
+    if skipped:
+        print('{} status updates deferred to next run'.format(skipped),
               file=sys.stderr)
 
-    with open(PULL_REQUEST_DB + '.tmp', 'wb') as f:
-        pickle.dump(db, f)
-    os.rename(PULL_REQUEST_DB + '.tmp', PULL_REQUEST_DB)
+    with state.transaction():
+        for prid, head in db.items():
+            if old_heads.get(prid) != head:
+                state.set_head(prid, head)
+        for prid, head in noci.items():
+            state.skip(prid, head)
+        for prid in old_published:
+            if prid not in published:
+                state.clear_published(prid)
+        for prid, st in published.items():
+            if old_published.get(prid) != st:
+                state.set_published(prid, *st)
+        for i, pr in enumerate(to_process, 1):
+            state.enqueue(pr.number, pr.head_sha, i)
+        state.dequeue_others(set(pr.number for pr in to_process),
+                             open_pulls)
 
-    if to_process:
-        print(to_process[0].number)
 
+def main():
+    client = ghapi.open_client()
+    state = prstate.open_db()
+    try:
+        scan(client, state)
+    finally:
+        state.close()
+        client.close()
     return 0
 
 
@@ -1,25 +1,16 @@
 #!/usr/bin/env python
 
-import os
-import os.path
 import sys
 
-import github
+import ghapi
 
 
 def main(commit_hash, stat, desc):
-    GITHUB_USERNAME = os.environ['GITHUB_USERNAME']
-    GITHUB_TOKEN_FILE = os.environ['GITHUB_TOKEN_FILE']
-    GITHUB_REPO = os.environ['GITHUB_REPO']
-
-    with open(GITHUB_TOKEN_FILE) as f:
-        token = f.read().strip()
-
-    g = github.Github(GITHUB_USERNAME, token, per_page=50)
-    r = g.get_repo(GITHUB_REPO)
-    c = r.get_commit(commit_hash)
-
-    c.create_status(stat, description=desc, context='gentoo-ci')
+    client = ghapi.open_client()
+    try:
+        client.create_status(commit_hash, stat, desc)
+    finally:
+        client.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# Long-running service receiving GitHub webhooks. Pull request events
+# update the state database and queue the new head right away, push
+# events schedule a repository sync. The jobs are started immediately
+# rather than on the next cron tick; events arriving while a job runs
+# are collapsed into a single rerun, so superseded pushes cost nothing.
+#
+# The cron jobs remain as a (less frequent) reconciliation pass.
+# Requests must be signed with the secret from GITHUB_WEBHOOK_SECRET_FILE.
+# Recorded payloads can be replayed locally against a service started
+# with --insecure, e.g.:
+#
+#   curl -H 'X-GitHub-Event: pull_request' -d @payload.json \
+#       http://127.0.0.1:8099/
+
+import argparse
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import os.path
+import subprocess
+import sys
+import threading
+
+import prstate
+
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# pull_request actions that change the head to check
+HEAD_ACTIONS = frozenset(('opened', 'reopened', 'synchronize',
+                          'ready_for_review'))
+
+
+class Job(object):
+    """A cron job run on demand, at most one instance at a time."""
+
+    def __init__(self, script, dry_run=False):
+        self.script = script
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+        self.running = False
+        self.pending = False
+
+    def trigger(self):
+        with self.lock:
+            if self.running:
+                # rerun once the current run finishes
+                self.pending = True
+                return 'pending'
+            self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+        return 'started'
+
+    def run(self):
+        while True:
+            print('Running {}'.format(self.script), file=sys.stderr)
+            if not self.dry_run:
+                subprocess.run([os.path.join(SCRIPT_DIR, 'run-cronjob.sh'),
+                                os.path.join(SCRIPT_DIR, self.script)])
+            with self.lock:
+                if not self.pending:
+                    self.running = False
+                    return
+                self.pending = False
+
+
+class WebhookService(object):
+    def __init__(self, state, repo, secret=None, dry_run=False):
+        self.state = state
+        self.repo = repo
+        self.secret = secret
+        self.lock = threading.Lock()
+        self.pulls_job = Job('pull-request/pull-requests.bash', dry_run)
+        self.repos_job = Job('repos-ci.bash', dry_run)
+
+    def verify(self, body, signature):
+        # secret is None only with --insecure
+        if self.secret is None:
+            return True
+        expected = 'sha256=' + hmac.new(self.secret, body,
+                                        hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    def handle(self, event, payload):
+        """Handle event, return a short description of what was done."""
+        if event == 'ping':
+            return 'pong'
+        if event not in ('push', 'pull_request'):
+            return 'ignored'
+        if payload['repository']['full_name'] != self.repo:
+            return 'ignored'
+        if event == 'push':
+            # only pushes to the synced branch matter
+            branch = payload['repository'].get('default_branch', 'master')
+            if payload['ref'] != 'refs/heads/' + branch:
+                return 'ignored'
+            return 'repos ' + self.repos_job.trigger()
+
+        action = payload['action']
+        pr = payload['pull_request']
+        number = pr['number']
+        head = pr['head']['sha']
+        labels = set(l['name'] for l in pr.get('labels', []))
+
+        with self.lock, self.state.transaction():
+            row = self.state.get(number)
+            status = row['status'] if row is not None else None
+            if action == 'closed':
+                self.state.mark_closed(number, head)
+                return 'closed'
+            if 'noci' in labels:
+                if status != 'noci':
+                    self.state.skip(number, head)
+                return 'noci'
+            if (action in HEAD_ACTIONS
+                    or (action == 'unlabeled'
+                        and payload['label']['name'] == 'noci')
+                    or (action == 'labeled'
+                        and payload['label']['name'] == 'priority-ci')):
+                if (status in ('queued', 'running')
+                        and row['queued_head'] == head
+                        and action != 'labeled'):
+                    return 'already queued'
+                if status == 'noci':
+                    self.state.set_head(number, '')
+                # a newer head replaces the queued one in place
+                position = (row['queue_position']
+                            if status == 'queued'
+                            and row['queue_position'] is not None
+                            else None)
+                if position is None or 'priority-ci' in labels:
+                    position = self.state.next_position(
+                            'priority-ci' in labels)
+                self.state.enqueue(number, head, position)
+            else:
+                return 'ignored'
+        return 'queued, pulls ' + self.pulls_job.trigger()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def reply(self, code, message):
+        body = (message + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        service = self.server.service
+        if not service.verify(body,
+                              self.headers.get('X-Hub-Signature-256')):
+            return self.reply(403, 'invalid signature')
+        event = self.headers.get('X-GitHub-Event', '')
+        try:
+            payload = json.loads(body)
+            result = service.handle(event, payload)
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, 'invalid payload: {}'.format(e))
+        print('{} {}: {}'.format(event, payload.get('action', ''), result),
+              file=sys.stderr)
+        self.reply(200, result)
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Receive GitHub webhooks and start CI jobs')
+    argp.add_argument('-b', '--bind',
+                      default=os.environ.get('PULL_REQUEST_WEBHOOK_ADDRESS',
+                                             '127.0.0.1'),
+                      help='Address to listen on '
+                           '(default: $PULL_REQUEST_WEBHOOK_ADDRESS)')
+    argp.add_argument('-p', '--port', type=int,
+                      default=int(os.environ.get('PULL_REQUEST_WEBHOOK_PORT',
+                                                 8099)),
+                      help='Port to listen on '
+                           '(default: $PULL_REQUEST_WEBHOOK_PORT)')
+    argp.add_argument('-n', '--dry-run', action='store_true',
+                      help='Update the state database but do not run jobs')
+    argp.add_argument('-v', '--verbose', action='store_true',
+                      help='Log all requests')
+    argp.add_argument('--insecure', action='store_true',
+                      help='Accept requests without a valid signature '
+                           '(for replaying payloads locally)')
+    args = argp.parse_args()
+
+    secret = None
+    if not args.insecure:
+        secret_file = os.environ.get('GITHUB_WEBHOOK_SECRET_FILE')
+        if not secret_file:
+            argp.error('GITHUB_WEBHOOK_SECRET_FILE not set '
+                       '(use --insecure to accept unsigned requests)')
+        try:
+            with open(secret_file, 'rb') as f:
+                secret = f.read().strip()
+        except (IOError, OSError) as e:
+            argp.error('unable to read webhook secret: {}'.format(e))
+        if not secret:
+            argp.error('webhook secret in {} is empty'.format(secret_file))
+
+    # the database is shared between the handler threads
+    state = prstate.PullRequestDB(os.environ['PULL_REQUEST_DB'],
+                                  check_same_thread=False)
+    server = http.server.ThreadingHTTPServer((args.bind, args.port), Handler)
+    server.service = WebhookService(state, os.environ['GITHUB_REPO'],
+                                    secret, args.dry_run)
+    server.verbose = args.verbose
+    print('Listening on http://{}:{}'.format(*server.server_address),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    state.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
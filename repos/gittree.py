@@ -0,0 +1,72 @@
+# Helpers for building git trees and commits with plumbing commands,
+# without touching the index or worktree.
+
+import subprocess
+
+
+def git(git_dir, *args, input=None, check=True):
+    return subprocess.run(('git',) + args, cwd=git_dir, input=input,
+                          stdout=subprocess.PIPE, check=check).stdout
+
+
+def rev_parse(git_dir, rev):
+    out = git(git_dir, 'rev-parse', '-q', '--verify', rev, check=False)
+    return out.decode().strip() or None
+
+
+def is_ancestor(git_dir, a, b):
+    return subprocess.run(['git', 'merge-base', '--is-ancestor', a, b],
+                          cwd=git_dir).returncode == 0
+
+
+def ls_tree(git_dir, tree, paths=()):
+    """Return {name: b'<mode> <type> <sha>'} for tree (or paths in it)."""
+    entries = {}
+    out = git(git_dir, 'ls-tree', '-z', tree, '--', *paths)
+    for e in out.split(b'\0'):
+        if e:
+            meta, name = e.split(b'\t', 1)
+            entries[name] = meta
+    return entries
+
+
+def commit_tree(git_dir, tree, parents, message):
+    """
+    Create a commit of tree, signed if commit.gpgsign is enabled
+    (commit-tree does not respect it on its own). Return its sha.
+    """
+    args = ['commit-tree', tree]
+    for p in parents:
+        args += ['-p', p]
+    if git(git_dir, 'config', '--bool', 'commit.gpgsign',
+           check=False).strip() == b'true':
+        args.append('-S')
+    return git(git_dir, *args, '-m', message).decode().strip()
+
+
+def mktree(git_dir, entries):
+    data = b''.join(meta + b'\t' + name + b'\0'
+                    for name, meta in entries.items())
+    return git(git_dir, 'mktree', '-z', input=data).strip()
+
+
+def overlay(git_dir, tree, overrides):
+    """
+    Return sha of tree with entries replaced by overrides
+    ({path: meta}). Only the trees leading to them are rewritten.
+    """
+    entries = ls_tree(git_dir, tree) if tree is not None else {}
+    nested = {}
+    for path, meta in overrides.items():
+        name, sep, rest = path.partition(b'/')
+        if sep:
+            nested.setdefault(name, {})[rest] = meta
+        else:
+            entries[name] = meta
+    for name, sub in nested.items():
+        old = entries.get(name)
+        subtree = (old.split()[2].decode()
+                   if old is not None and old.split()[1] == b'tree'
+                   else None)
+        entries[name] = b'040000 tree ' + overlay(git_dir, subtree, sub)
+    return mktree(git_dir, entries)
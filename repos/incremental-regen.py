@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# Regenerate the metadata cache only for ebuilds changed between two
+# git commits, plus ebuilds inheriting changed eclasses. Falls back
+# to full 'pmaint regen' when the change can not be handled
+# incrementally.
+#
+# Exits with EXIT_BAD_METADATA if the cache was updated but some ebuilds
+# failed to regenerate, so that callers can tell it from a failure.
+
+import argparse
+import json
+import os
+import os.path
+import signal
+import subprocess
+import sys
+
+import pkgcore.config
+from pkgcore.ebuild.atom import atom
+from pkgcore.ebuild.cpv import CPV
+from pkgcore.operations import observer as observer_mod
+from pkgcore.operations import regen
+
+
+# cache updated, but some ebuilds have bad metadata
+EXIT_BAD_METADATA = 3
+
+# changes to these require full regen (cache entries depend only
+# on ebuilds and eclasses, other profile changes do not matter)
+FULL_REGEN_PATHS = (
+    'metadata/layout.conf',
+    'profiles/repo_name',
+)
+# generated files, never trigger anything
+IGNORED_PATHS = (
+    'metadata/md5-cache/',
+    'metadata/pkg_desc_index',
+    'metadata/timestamp',
+    'profiles/use.local.desc',
+)
+
+
+class FullRegenNeeded(Exception):
+    pass
+
+
+def git_changes(location, old, new):
+    """Yield (status, path) for files changed between commits."""
+    out = subprocess.check_output(
+            ['git', 'diff', '--name-status', '--no-renames', '-z',
+             old, new],
+            cwd=location)
+    fields = out.split(b'\0')
+    for st, path in zip(fields[::2], fields[1::2]):
+        yield st.decode(), path.decode()
+
+
+def load_eclass_index(cache_dir, index_path):
+    """
+    Build eclass -> consumer mapping from md5-cache entries.
+
+    Per-entry inherited eclasses are stored in index_path along
+    with entry mtime and size, so only entries modified since need
+    to be reread.
+    """
+    old = {}
+    if index_path is not None:
+        try:
+            with open(index_path) as f:
+                old = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    entries = {}
+    for cat in os.scandir(cache_dir):
+        if not cat.is_dir() or cat.name.startswith('.'):
+            continue
+        for e in os.scandir(cat.path):
+            key = cat.name + '/' + e.name
+            st = e.stat()
+            stamp = [st.st_mtime_ns, st.st_size]
+            prev = old.get(key)
+            if prev is not None and prev[0] == stamp:
+                entries[key] = prev
+                continue
+            eclasses = []
+            with open(e.path, encoding='utf8', errors='replace') as f:
+                for l in f:
+                    if l.startswith('_eclasses_='):
+                        eclasses = l.rstrip('\n').split('=', 1)[1].split(
+                                '\t')[::2]
+                        break
+            entries[key] = [stamp, eclasses]
+
+    if index_path is not None and entries != old:
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.rename(index_path + '.tmp', index_path)
+
+    consumers = {}
+    for key, (stamp, eclasses) in entries.items():
+        for ec in eclasses:
+            consumers.setdefault(ec, set()).add(key)
+    return consumers
+
+
+def find_changes(changes, eclass_consumers, changed_eclasses=()):
+    """
+    Return (cpvs to regen, removed cpvs, packages with changed
+    metadata.xml, packages with changed versions).
+    """
+    regen_cpvs = set()
+    removed_cpvs = set()
+    xml_pkgs = set()
+    ebuild_pkgs = set()
+    eclasses = set(changed_eclasses)
+
+    for st, path in changes:
+        if path.startswith(IGNORED_PATHS):
+            continue
+        if path.startswith(FULL_REGEN_PATHS):
+            raise FullRegenNeeded(path)
+
+        parts = path.split('/')
+        if parts[0] == 'eclass':
+            if path.endswith('.eclass'):
+                eclasses.add(os.path.basename(path)[:-7])
+        elif len(parts) == 3 and parts[0] not in ('metadata', 'licenses'):
+            cat, pn, fn = parts
+            if fn.endswith('.ebuild'):
+                cpv = cat + '/' + fn[:-7]
+                ebuild_pkgs.add((cat, pn))
+                if st == 'D':
+                    removed_cpvs.add(cpv)
+                else:
+                    regen_cpvs.add(cpv)
+            elif fn == 'metadata.xml':
+                xml_pkgs.add((cat, pn))
+
+    for ec in eclasses:
+        for cpv in eclass_consumers.get(ec, ()):
+            regen_cpvs.add(cpv)
+            c = CPV.versioned(cpv)
+            ebuild_pkgs.add((c.category, c.package))
+
+    return regen_cpvs - removed_cpvs, removed_cpvs, xml_pkgs, ebuild_pkgs
+
+
+def patch_sorted_file(path, pkgs, new_lines, key, header_prefix='#'):
+    """
+    Replace lines for pkgs in sorted file at path with new_lines.
+    key(line) returns ((cat, pn), sort key) for data lines.
+    """
+    header = []
+    lines = []
+    with open(path, encoding='utf8') as f:
+        for l in f:
+            if l.startswith(header_prefix) or not l.strip():
+                if not lines:
+                    header.append(l)
+                continue
+            if key(l)[0] not in pkgs:
+                lines.append(l)
+    lines.extend(new_lines)
+    lines.sort(key=lambda l: key(l)[1])
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        f.writelines(header)
+        f.writelines(lines)
+    os.rename(path + '.tmp', path)
+
+
+def use_local_desc_key(l):
+    pkg, rest = l.split(':', 1)
+    cat, pn = pkg.split('/', 1)
+    return (cat, pn), (cat, pn, rest.split(' ', 1)[0])
+
+
+def pkg_desc_index_key(l):
+    cat, pn = l.split(' ', 1)[0].split('/', 1)
+    return (cat, pn), (cat, pn)
+
+
+def update_use_local_desc(repo, pkgs):
+    new_lines = []
+    for cat, pn in pkgs:
+        if not os.path.exists(os.path.join(repo.location, cat, pn,
+                                           'metadata.xml')):
+            continue
+        metadata = repo._get_metadata_xml(cat, pn)
+        for flag, desc in sorted(metadata.local_use.items()):
+            new_lines.append('{}/{}:{} - {}\n'.format(cat, pn, flag, desc))
+    patch_sorted_file(os.path.join(repo.location, 'profiles',
+                                   'use.local.desc'),
+                      pkgs, new_lines, use_local_desc_key)
+
+
+def update_pkg_desc_index(repo, pkgs):
+    new_lines = []
+    for cat, pn in pkgs:
+        try:
+            versions = repo.versions[(cat, pn)]
+        except KeyError:
+            versions = ()
+        cpvs = sorted(CPV(cat, pn, v) for v in versions)
+        # the most recent description, skipping bad packages
+        for cpv in reversed(cpvs):
+            try:
+                desc = repo[(cat, pn, cpv.fullver)].description
+            except Exception:
+                continue
+            new_lines.append('{}/{} {}: {}\n'.format(
+                cat, pn, ' '.join(x.fullver for x in cpvs), desc))
+            break
+    patch_sorted_file(os.path.join(repo.location, 'metadata',
+                                   'pkg_desc_index'),
+                      pkgs, new_lines, pkg_desc_index_key)
+
+
+def full_regen(args):
+    # everything may change, the list would not be complete
+    if args.changed_list is not None:
+        try:
+            os.unlink(args.changed_list)
+        except FileNotFoundError:
+            pass
+    cmd = ['pmaint', '--config', args.config, 'regen',
+           '-t', str(args.threads)]
+    if args.use_local_desc:
+        cmd.append('--use-local-desc')
+    if args.pkg_desc_index:
+        cmd.append('--pkg-desc-index')
+    cmd.append(args.repo)
+    print('Running full regen: {}'.format(' '.join(cmd)), file=sys.stderr)
+    sys.stderr.flush()
+    p = subprocess.Popen(cmd)
+    # pass termination (e.g. by timeout) on to pmaint
+    signal.signal(signal.SIGTERM, lambda signum, frame: p.terminate())
+    ret = p.wait()
+    # pmaint regen reports ebuilds with bad metadata via exit status 1
+    if ret == 1:
+        ret = EXIT_BAD_METADATA
+    sys.exit(ret)
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Regenerate metadata for changes between commits')
+    argp.add_argument('--config', required=True,
+                      help='Portage configuration directory')
+    argp.add_argument('-t', '--threads', type=int, default=os.cpu_count(),
+                      help='Number of regen threads')
+    argp.add_argument('--use-local-desc', action='store_true',
+                      help='Update profiles/use.local.desc')
+    argp.add_argument('--pkg-desc-index', action='store_true',
+                      help='Update metadata/pkg_desc_index')
+    argp.add_argument('--index',
+                      help='Path to store eclass consumer index in')
+    argp.add_argument('--changed-eclass', action='append', default=[],
+                      help='Treat eclass as changed (e.g. in master repo)')
+    argp.add_argument('--git-dir',
+                      help='Git checkout to take changes from, if the '
+                           'repository is a copy without .git')
+    argp.add_argument('--changed-list',
+                      help='Write paths of updated cache files to this file '
+                           '(removed if full regen is done)')
+    argp.add_argument('repo', help='Repository name')
+    argp.add_argument('old', nargs='?',
+                      help='Commit the current cache corresponds to '
+                           '(if not specified, full regen is done)')
+    argp.add_argument('new', nargs='?', default='HEAD',
+                      help='Commit to update cache to (default: HEAD)')
+    args = argp.parse_args()
+
+    if not args.old:
+        full_regen(args)
+
+    config = pkgcore.config.load_config(location=args.config)
+    domain = config.get_default('domain')
+    repo = next(r for r in domain.source_repos_raw
+                if r.repo_id == args.repo)
+    cache_dir = os.path.join(repo.location, 'metadata', 'md5-cache')
+
+    required = [cache_dir]
+    if args.use_local_desc:
+        required.append(os.path.join(repo.location, 'profiles',
+                                     'use.local.desc'))
+    if args.pkg_desc_index:
+        required.append(os.path.join(repo.location, 'metadata',
+                                     'pkg_desc_index'))
+
+    try:
+        for path in required:
+            if not os.path.exists(path):
+                raise FullRegenNeeded('{} missing'.format(path))
+        changes = list(git_changes(args.git_dir or repo.location,
+                                   args.old, args.new))
+        eclass_consumers = load_eclass_index(cache_dir, args.index)
+        regen_cpvs, removed_cpvs, xml_pkgs, ebuild_pkgs = find_changes(
+                changes, eclass_consumers, args.changed_eclass)
+    except (FullRegenNeeded, subprocess.CalledProcessError) as e:
+        print('Full regen needed: {}'.format(e), file=sys.stderr)
+        full_regen(args)
+
+    print('Regenerating {} ebuilds, removing {}'.format(
+        len(regen_cpvs), len(removed_cpvs)), file=sys.stderr)
+
+    pkgs = []
+    for cat, pn in sorted(ebuild_pkgs):
+        for pkg in repo.itermatch(atom('{}/{}'.format(cat, pn)),
+                                  pkg_filter=None):
+            if pkg.cpvstr in regen_cpvs:
+                pkgs.append(pkg)
+
+    ret = 0
+    observer = observer_mod.repo_observer(observer_mod.null_output())
+    for pkg, e in regen.regen_repository(repo, pkgs, observer=observer,
+                                         threads=args.threads,
+                                         eclass_caching=True):
+        print('caught exception {} while processing {}'.format(
+            e, pkg.cpvstr), file=sys.stderr)
+        ret = EXIT_BAD_METADATA
+
+    # report packages with bad metadata -- matching via the filtered
+    # repo populates the masked repo
+    for cat, pn in sorted(ebuild_pkgs):
+        list(repo.itermatch(atom('{}/{}'.format(cat, pn))))
+    for pkg in sorted(repo._bad_masked):
+        print('{}: {}'.format(pkg.cpvstr, pkg.data.msg(verbosity=0)),
+              file=sys.stderr)
+        ret = EXIT_BAD_METADATA
+
+    for cache in repo.cache:
+        if cache.readonly:
+            continue
+        for cpv in removed_cpvs:
+            try:
+                del cache[cpv]
+            except KeyError:
+                pass
+    repo.operations.run_if_supported('flush_cache')
+
+    if args.use_local_desc and xml_pkgs:
+        update_use_local_desc(repo, xml_pkgs)
+    if args.pkg_desc_index and ebuild_pkgs:
+        update_pkg_desc_index(repo, ebuild_pkgs)
+
+    if args.changed_list is not None:
+        changed = ['metadata/md5-cache/' + cpv
+                   for cpv in regen_cpvs | removed_cpvs]
+        if args.use_local_desc and xml_pkgs:
+            changed.append('profiles/use.local.desc')
+        if args.pkg_desc_index and ebuild_pkgs:
+            changed.append('metadata/pkg_desc_index')
+        with open(args.changed_list, 'w') as f:
+            f.writelines(p + '\n' for p in sorted(changed))
+
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
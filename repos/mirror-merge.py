@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# Merge upstream updates into a mirror branch at tree level. The mirror
+# content is the upstream tree with generated paths (metadata cache,
+# data subtrees added by repo-postmerge...) taken from the mirror, so
+# the merge commit can be built directly with git plumbing: only the
+# trees on the way to the generated paths are rewritten, and there are
+# never any conflicts.
+# The upstream commit is kept as the second parent.
+#
+# 'bench' compares it with 'git merge -X theirs' on a synthetic repo.
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+from gittree import (commit_tree, git, is_ancestor, ls_tree, overlay,
+                     rev_parse)
+
+
+# paths regenerated on the mirror side for every repo
+GENERATED_PATHS = (
+    'metadata/md5-cache',
+    'metadata/pkg_desc_index',
+    'metadata/timestamp.chk',
+    'profiles/use.local.desc',
+)
+# paths added by update-subrepo.py (in repo-postmerge) are recorded here
+SUBREPO_STATE = 'subrepo.json'
+
+
+def subrepo_paths(git_dir):
+    """Return paths of subrepos and files added by update-subrepo.py."""
+    path = os.path.join(
+            git(git_dir, 'rev-parse', '--absolute-git-dir').decode().strip(),
+            SUBREPO_STATE)
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return ()
+    return tuple(sorted(list(data.get('subtrees', {}))
+                        + [v['path'] for v in data.get('files', {}).values()
+                           if v.get('path')]))
+
+
+def merge(git_dir, upstream, branch, message, keep=GENERATED_PATHS,
+          keep_missing=(), checkout=True):
+    """
+    Merge upstream into branch, return the new commit (or None if up-to-date).
+    Paths in keep are taken from the mirror, paths in keep_missing only
+    if upstream does not have them.
+    """
+    ref = 'refs/heads/' + branch
+    head = rev_parse(git_dir, ref)
+    upstream = rev_parse(git_dir, upstream + '^{commit}')
+    if head is None:
+        raise ValueError('{} does not exist'.format(ref))
+    if is_ancestor(git_dir, upstream, head):
+        return None
+
+    up_tree = rev_parse(git_dir, upstream + '^{tree}')
+    overrides = ls_tree(git_dir, head, keep)
+    if keep_missing:
+        present = ls_tree(git_dir, up_tree, keep_missing)
+        for name, meta in ls_tree(git_dir, head, keep_missing).items():
+            if name not in present:
+                overrides.setdefault(name, meta)
+    tree = overlay(git_dir, up_tree, overrides).decode()
+    if tree == up_tree and is_ancestor(git_dir, head, upstream):
+        # nothing of our own, fast-forward
+        new = upstream
+    else:
+        new = commit_tree(git_dir, tree, (head, upstream), message)
+    git(git_dir, 'update-ref', '-m', 'mirror-merge: ' + message, ref, new,
+        head)
+
+    # update the index and worktree if the branch is checked out,
+    # touching only files that differ
+    if (checkout and git(git_dir, 'symbolic-ref', '-q', 'HEAD',
+                         check=False).strip() == ref.encode()):
+        git(git_dir, 'read-tree', '--reset', '-u', new)
+    return new
+
+
+def cmd_merge(args):
+    new = merge(args.git_dir, args.upstream, args.branch, args.message,
+                GENERATED_PATHS + subrepo_paths(args.git_dir)
+                + tuple(args.keep), args.keep_missing)
+    if new is None:
+        print('{}: already up-to-date'.format(args.branch), file=sys.stderr)
+    else:
+        print('{}: updated to {}'.format(args.branch, new), file=sys.stderr)
+    return 0
+
+
+def write_packages(repo, packages, version, start=0):
+    for i in range(start, start + packages):
+        d = os.path.join(repo, 'cat-{}'.format(i % 100), 'pkg-{}'.format(i))
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, 'pkg-{}-{}.ebuild'.format(i, version)),
+                  'w') as f:
+            f.write('EAPI=8\nDESCRIPTION="Package {}"\nSLOT=0\n'.format(i))
+        if version > 1:
+            os.unlink(os.path.join(d, 'pkg-{}-{}.ebuild'.format(i,
+                                                                version - 1)))
+
+
+def write_cache(repo, packages, version, start=0):
+    for i in range(start, start + packages):
+        d = os.path.join(repo, 'metadata', 'md5-cache',
+                         'cat-{}'.format(i % 100))
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, 'pkg-{}-{}'.format(i, version)),
+                  'w') as f:
+            f.write('DESCRIPTION=Package {}\nSLOT=0\n'.format(i))
+        if version > 1:
+            os.unlink(os.path.join(d, 'pkg-{}-{}'.format(i, version - 1)))
+
+
+def commit_all(repo, message):
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-q', '-m', message)
+
+
+def cmd_bench(args):
+    os.environ.setdefault('GIT_AUTHOR_NAME', 'bench')
+    os.environ.setdefault('GIT_AUTHOR_EMAIL', 'bench@localhost')
+    os.environ.setdefault('GIT_COMMITTER_NAME', 'bench')
+    os.environ.setdefault('GIT_COMMITTER_EMAIL', 'bench@localhost')
+    tmp = tempfile.mkdtemp(prefix='mirror-merge-bench.')
+    try:
+        upstream = os.path.join(tmp, 'upstream')
+        os.mkdir(upstream)
+        git(upstream, 'init', '-q', '-b', 'master')
+        write_packages(upstream, args.packages, 1)
+        commit_all(upstream, 'initial')
+
+        mirrors = {}
+        for method in ('git-merge', 'tree'):
+            m = os.path.join(tmp, method)
+            git(tmp, 'clone', '-q', upstream, m)
+            write_cache(m, args.packages, 1)
+            commit_all(m, 'cache')
+            mirrors[method] = m
+
+        write_packages(upstream, args.changed, 2)
+        commit_all(upstream, 'update')
+
+        results = {}
+        for method, m in mirrors.items():
+            git(m, 'fetch', '-q', upstream, '+master:refs/orig/master')
+            start = time.perf_counter()
+            if method == 'tree':
+                merge(m, 'refs/orig/master', 'master',
+                      'Merge updates from master')
+            else:
+                git(m, 'merge', '-q', '-s', 'recursive', '-X', 'theirs',
+                    '-m', 'Merge updates from master', 'refs/orig/master')
+            results[method] = time.perf_counter() - start
+
+        trees = set(rev_parse(m, 'HEAD^{tree}') for m in mirrors.values())
+        for method, t in results.items():
+            print('{}: {:.3f} s'.format(method, t))
+        if len(trees) != 1:
+            print('** resulting trees differ', file=sys.stderr)
+            return 1
+    finally:
+        if args.keep_dir:
+            print('Repositories left in {}'.format(tmp), file=sys.stderr)
+        else:
+            shutil.rmtree(tmp)
+    return 0
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Merge upstream updates into a mirror branch')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('merge', help='Merge upstream into mirror')
+    p.add_argument('-C', '--git-dir', default='.',
+                   help='Mirror repository (default: current directory)')
+    p.add_argument('-b', '--branch', default='master',
+                   help='Mirror branch (default: master)')
+    p.add_argument('-m', '--message', default='Merge updates',
+                   help='Merge commit message')
+    p.add_argument('-k', '--keep', action='append', default=[],
+                   help='Additional path to take from the mirror')
+    p.add_argument('-K', '--keep-missing', action='append', default=[],
+                   help='Path to take from the mirror unless upstream '
+                        'has it (e.g. data added by repo-postmerge)')
+    p.add_argument('upstream', help='Upstream commit to merge')
+    p.set_defaults(func=cmd_merge)
+    p = subp.add_parser('bench', help='Compare with git merge on '
+                                      'a synthetic repo')
+    p.add_argument('-n', '--packages', type=int, default=20000,
+                   help='Number of packages (default: 20000)')
+    p.add_argument('-c', '--changed', type=int, default=1000,
+                   help='Number of packages updated (default: 1000)')
+    p.add_argument('--keep-dir', action='store_true',
+                   help='Do not remove the repositories afterwards')
+    p.set_defaults(func=cmd_bench)
+
+    args = argp.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,8 @@
 set -e -x
 ulimit -t 800
 
+. "${SCRIPT_DIR}"/utils/spans.bash
+
 # SANITY!
 export TZ=UTC
 
@@ -52,7 +54,7 @@ do
 done
 
 # sync all repos
-pmaint --config "${CONFIG_ROOT_SYNC}/etc/portage" sync
+span sync "" pmaint --config "${CONFIG_ROOT_SYNC}/etc/portage" sync
 
 # check signed repos
 for r in ${SIGNED_REPOS}; do
@@ -61,57 +63,254 @@ for r in ${SIGNED_REPOS}; do
 	) == [GU] ]]
 done
 
-# rsync repos to main dir
-rsync -rlpt --delete \
-	'--exclude=.*/' \
-	'--exclude=*/metadata/md5-cache' \
-	'--exclude=*/profiles/use.local.desc' \
-	'--exclude=*/metadata/pkg_desc_index' \
-	'--exclude=*/metadata/timestamp.chk' \
-	"${SYNC_DIR}/." "${REPOS_DIR}"
-
-# regen caches
+# copy repos to main dir and regen caches, incrementally for changes
+# since the commit each copy and cache was last updated for; unchanged
+# repos are skipped
 # (ignore failures, if it's ::gentoo, pkgcheck should detect it)
-pmaint --config "${CONFIG_ROOT}/etc/portage" regen \
-	--use-local-desc --pkg-desc-index -t "$(nproc)" || :
-
-# prepare mirrors
+sync_excludes=(
+	'.*/'
+	'/metadata/md5-cache'
+	'/profiles/use.local.desc'
+	'/metadata/pkg_desc_index'
+	'/metadata/timestamp.chk'
+)
+regen_state=${REPOS_DIR}/.regen
+mkdir -p -- "${regen_state}"
+declare -A changed_eclasses=() regen_base=()
 for r in ${REPOS}; do
 	name=${r%%:*}
+	new=$(git -C "${SYNC_DIR}/${name}" rev-parse HEAD)
+	old=
+	[[ ! -s ${regen_state}/${name} ]] || old=$(<"${regen_state}/${name}")
+	# full regen if we do not know the old commit anymore, or the cache
+	# is gone
+	if [[ ! -d ${REPOS_DIR}/${name}/metadata/md5-cache ]] ||
+		! git -C "${SYNC_DIR}/${name}" cat-file -e "${old}^{commit}" 2>/dev/null
+	then
+		old=
+	fi
+
+	if [[ ${old} ]]; then
+		span copy "${name}" "${SCRIPT_DIR}"/repos/stage-changes.py \
+			"${sync_excludes[@]/#/--exclude=}" \
+			--diff "${old}" "${new}" \
+			"${SYNC_DIR}/${name}" "${REPOS_DIR}/${name}"
+	else
+		# (hardlink the files rather than copying them)
+		span copy "${name}" rsync -rlpt --delete \
+			"${sync_excludes[@]/#/--exclude=}" \
+			--link-dest="${SYNC_DIR}/${name}" \
+			"${SYNC_DIR}/${name}/." "${REPOS_DIR}/${name}"
+	fi
+
+	# eclasses changed in masters affect their consumers here too
+	masters=$(sed -n -e 's/^masters *= *//p' \
+		"${REPOS_DIR}/${name}/metadata/layout.conf" 2>/dev/null || :)
+	eclass_args=()
+	for m in ${masters}; do
+		[[ ${m} != ${name} ]] || continue
+		if [[ ! -v changed_eclasses[${m}] ]]; then
+			# master not handled (yet), be safe
+			old=
+			continue
+		fi
+		for ec in ${changed_eclasses[${m}]}; do
+			eclass_args+=( --changed-eclass "${ec}" )
+		done
+	done
+
+	if [[ ${old} ]]; then
+		changed_eclasses[${name}]=$(git -C "${SYNC_DIR}/${name}" \
+			diff --name-only "${old}" "${new}" -- 'eclass/*.eclass' |
+			sed -e 's@^eclass/@@' -e 's@[.]eclass$@@')
+		if [[ ${old} == ${new} && ${#eclass_args[@]} -eq 0 ]]; then
+			echo "${name}: cache up-to-date"
+			: > "${regen_state}/${name}.changes"
+			regen_base[${name}]=${old}
+			continue
+		fi
+	else
+		# unknown changes, force full regen of the dependent repos
+		unset "changed_eclasses[${name}]"
+	fi
+
+	span regen "${name}" "${SCRIPT_DIR}"/repos/incremental-regen.py \
+		--config "${CONFIG_ROOT}/etc/portage" \
+		--git-dir "${SYNC_DIR}/${name}" \
+		--index "${regen_state}/${name}.eclass-index.json" \
+		--use-local-desc --pkg-desc-index -t "$(nproc)" \
+		--changed-list "${regen_state}/${name}.changes" \
+		"${eclass_args[@]}" "${name}" ${old} "${new}" && ret=0 || ret=${?}
+	# 3 means the cache was updated but some ebuilds have bad metadata,
+	# they do not need regenerating again until they change
+	if [[ ${ret} -eq 0 || ${ret} -eq 3 ]]; then
+		echo "${new}" > "${regen_state}/${name}"
+		if [[ ${old} && -e ${regen_state}/${name}.changes ]]; then
+			regen_base[${name}]=${old}
+		fi
+	else
+		# the regen failed (and master eclass changes are not recorded),
+		# retry from scratch
+		rm -f -- "${regen_state}/${name}"
+	fi
+done
+
+# merge the updates into mirror ${1}, commit and record the cache note;
+# touch ${2} if the mirror needs to be pushed
+prepare_mirror() (
+	set -e -x
+	local name=${1}
+	local push_flag=${2}
 
 	if [[ ! -e ${MIRROR_DIR}/${name} ]]; then
 		git clone "git@github.com:gentoo-mirror/${name}" \
 			"${MIRROR_DIR}/${name}"
 	fi
 
-	"${SCRIPT_DIR}"/repos/smart-merge.bash "${SYNC_DIR}/${name}" \
-		"${MIRROR_DIR}/${name}" master
+	# data added by repo-postmerge, not copied from ${REPOS_DIR}
+	local mirror_paths=(
+		metadata/dtd
+		metadata/glsa
+		metadata/news
+		metadata/projects.xml
+		metadata/xml-schema
+	)
 
-	"${SCRIPT_DIR}/repos/repo-postmerge/${name}" "${MIRROR_DIR}/${name}"
+	span merge "${name}" \
+		"${SCRIPT_DIR}"/repos/smart-merge.bash "${SYNC_DIR}/${name}" \
+		"${MIRROR_DIR}/${name}" master "${mirror_paths[@]}"
 
-	rsync -rlpt --delete \
-		'--exclude=.*/' \
-		'--exclude=metadata/timestamp.chk' \
-		'--exclude=metadata/dtd' \
-		'--exclude=metadata/glsa' \
-		'--exclude=metadata/news' \
-		'--exclude=metadata/projects.xml' \
-		'--exclude=metadata/xml-schema' \
-		"${REPOS_DIR}/${name}/." "${MIRROR_DIR}/${name}/"
+	span postmerge "${name}" \
+		"${SCRIPT_DIR}/repos/repo-postmerge/${name}" "${MIRROR_DIR}/${name}"
 
-	(
+	local excludes=(
+		'.*/'
+		'/metadata/timestamp.chk'
+		"${mirror_paths[@]/#//}"
+	)
+	local base=${regen_base[${name}]}
+	local staged=
+	[[ ! -s ${regen_state}/${name}.mirror ]] ||
+		staged=$(<"${regen_state}/${name}.mirror")
+	rm -f -- "${regen_state}/${name}.mirror"
+
+	if [[ ${base} && ${base} == ${staged} ]]; then
+		# the mirror is up-to-date with ${base}, so copy and stage only
+		# the paths changed by the sync and the cache regen
+		span mirror-copy "${name}" \
+			"${SCRIPT_DIR}"/repos/stage-changes.py --stage \
+			"${excludes[@]/#/--exclude=}" \
+			--git-dir "${SYNC_DIR}/${name}" \
+			--diff "${base}" "$(<"${regen_state}/${name}")" \
+			--list "${regen_state}/${name}.changes" \
+			"${REPOS_DIR}/${name}" "${MIRROR_DIR}/${name}"
 		cd "${MIRROR_DIR}/${name}"
-		git add -A -f
-		if ! git diff --cached --quiet --exit-code; then
-			LANG=C date -u "+%a, %d %b %Y %H:%M:%S +0000" > metadata/timestamp.chk
-			git add -f metadata/timestamp.chk
-			git commit --quiet -m "$(date -u '+%F %T UTC')"
-		fi
-		out=$(git rev-list origin/master..master)
-		ret=$?
-		if [[ -n "${out}" || "${ret}" -ne 0 ]]; then
-			git fetch --all
-			git push
+		[[ ! -e metadata/projects.xml ]] ||
+			git add -f metadata/projects.xml
+	else
+		span mirror-copy "${name}" rsync -rlpt --delete \
+			"${excludes[@]/#/--exclude=}" \
+			--link-dest="${REPOS_DIR}/${name}" \
+			"${REPOS_DIR}/${name}/." "${MIRROR_DIR}/${name}/"
+		cd "${MIRROR_DIR}/${name}"
+		span mirror-copy "${name}" git add -A -f
+	fi
+	if ! git diff --cached --quiet --exit-code; then
+		LANG=C date -u "+%a, %d %b %Y %H:%M:%S +0000" > metadata/timestamp.chk
+		git add -f metadata/timestamp.chk
+		git commit --quiet -m "$(date -u '+%F %T UTC')"
+	fi
+	if [[ -s ${regen_state}/${name} ]]; then
+		cp -- "${regen_state}/${name}" "${regen_state}/${name}.mirror"
+	fi
+	# remember which mirror commit holds the cache for the synced
+	# commit, so that PR checks can reuse it
+	orig=$(git rev-parse -q --verify refs/orig/master || :)
+	if [[ ${orig} && $(git notes --ref=md5-cache show "${orig}" 2>/dev/null) != $(git rev-parse HEAD) ]]; then
+		git notes --ref=md5-cache add -f -m "$(git rev-parse HEAD)" "${orig}"
+	fi
+	out=$(git rev-list origin/master..master) && ret=0 || ret=${?}
+	if [[ -n "${out}" || "${ret}" -ne 0 ]]; then
+		touch -- "${push_flag}"
+	fi
+)
+
+push_mirror() (
+	set -e -x
+	cd "${MIRROR_DIR}/${1}"
+	git fetch --all
+	git push
+)
+
+# prepare mirrors in parallel, pushing each as soon as it is ready;
+# a failing repo does not stop the others
+logs=$(mktemp -d)
+trap 'rm -rf -- "${logs}"' EXIT
+
+prepare_jobs=${REPOS_JOBS:-4}
+push_jobs=${REPOS_PUSH_JOBS:-4}
+pending=()
+for r in ${REPOS}; do
+	pending+=( "${r%%:*}" )
+done
+push_queue=()
+failed=()
+declare -A preparing=() pushing=()
+
+while [[ ${#pending[@]} -gt 0 || ${#push_queue[@]} -gt 0 ||
+		${#preparing[@]} -gt 0 || ${#pushing[@]} -gt 0 ]]; do
+	while [[ ${#pending[@]} -gt 0 && ${#preparing[@]} -lt ${prepare_jobs} ]]; do
+		name=${pending[0]}
+		pending=( "${pending[@]:1}" )
+		prepare_mirror "${name}" "${logs}/${name}.push" \
+			&> "${logs}/${name}.log" &
+		preparing[${!}]=${name}
+	done
+	while [[ ${#push_queue[@]} -gt 0 && ${#pushing[@]} -lt ${push_jobs} ]]; do
+		name=${push_queue[0]}
+		push_queue=( "${push_queue[@]:1}" )
+		span push "${name}" push_mirror "${name}" &>> "${logs}/${name}.log" &
+		pushing[${!}]=${name}
+	done
+
+	wait -n -p pid && wret=0 || wret=${?}
+	if [[ ${preparing[${pid}]} ]]; then
+		name=${preparing[${pid}]}
+		unset "preparing[${pid}]"
+		stage=prepare
+		if [[ ${wret} -eq 0 && -e ${logs}/${name}.push ]]; then
+			push_queue+=( "${name}" )
+			continue
 		fi
-	)
+	elif [[ ${pushing[${pid}]} ]]; then
+		name=${pushing[${pid}]}
+		unset "pushing[${pid}]"
+		stage=push
+	else
+		continue
+	fi
+
+	# the repo is done, include its output in the cronjob log
+	cat -- "${logs}/${name}.log"
+	if [[ ${wret} -ne 0 ]]; then
+		echo "** ${name}: ${stage} failed with ${wret}" >&2
+		failed+=( "${name}" )
+		cp -- "${logs}/${name}.log" "${CRONJOB_STATE_DIR}/repos-${name}.log.${date}"
+	fi
 done
+
+if [[ ${#failed[@]} -gt 0 ]]; then
+	sendmail "${CRONJOB_ADMIN_MAIL}" <<-EOF
+		Subject: repos: mirror update failed for ${failed[*]}
+		To: <${CRONJOB_ADMIN_MAIL}>
+		Content-Type: text/plain; charset=utf8
+
+		Updating the following mirrors failed: ${failed[*]}
+		The logs were saved as ${CRONJOB_STATE_DIR}/repos-<name>.log.${date}.
+	EOF
+
+	# gentoo-ci runs on the ::gentoo mirror, so it needs to be up-to-date
+	for name in "${failed[@]}"; do
+		[[ ${name} != gentoo ]] || exit 1
+	done
+fi
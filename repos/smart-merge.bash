@@ -4,6 +4,8 @@ set -e -x
 repo=${1}
 mirror=${2}
 m_branch=${3}
+# paths added on the mirror side, kept unless upstream has them
+keep_missing=( "${@:4}" )
 
 [[ ${repo} && ${mirror} && ${m_branch} ]]
 
@@ -17,29 +19,11 @@ branch=$(git symbolic-ref -q --short HEAD)
 cd -- "${mirror}"
 git fetch -- "${repo}" "+${branch}:refs/orig/${branch}"
 if git merge-base -- "${m_branch}" "refs/orig/${branch}" > /dev/null; then
-	# regular update
-	if ! git merge -q -s recursive -X theirs -m "Merge updates from ${branch}" -- "refs/orig/${branch}"; then
-		# check for conflicts
-		conflicts=no
-		while read st filename rest; do
-			case "${st}" in
-				DD|AU|UD|UA|DU|AA|UU)
-					# be lazy, handle all merge conflicts via rm...
-					git rm --cached -- "${filename}"
-					conflicts=yes
-					;;
-				*)
-					conflicts=yes
-					;;
-			esac
-		done < <(git status --porcelain --untracked-files=no)
-		if [[ ${conflicts} == yes ]]; then
-			git commit -q -m "Merge updates from ${branch}"
-		else
-			echo "** git merge failed, no conflicts found" >&2
-			exit 1
-		fi
-	fi
+	# regular update: take the upstream tree, keeping generated paths
+	# from the mirror (no worktree merge, hence no conflicts)
+	"${SCRIPT_DIR}"/repos/mirror-merge.py merge -b "${m_branch}" \
+		"${keep_missing[@]/#/--keep-missing=}" \
+		-m "Merge updates from ${branch}" -- "refs/orig/${branch}"
 elif ! git rev-parse HEAD &>/dev/null; then
 	# empty repo
 	git merge -q --ff -- "refs/orig/${branch}"
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Update a copy of a repository by touching only the paths known to
+# have changed (from a git diff and/or lists of paths), rather than
+# walking the whole tree with rsync. Files are hardlinked when possible,
+# and copied (reflinked, if the filesystem supports it) otherwise.
+# Optionally, the paths are staged in the git index of the copy, so
+# that it does not need to be rehashed with 'git add -A'.
+
+import argparse
+import fnmatch
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+
+
+def git_diff_paths(git_dir, old, new):
+    """Return paths changed between commits."""
+    out = subprocess.check_output(
+            ['git', 'diff', '--name-only', '--no-renames', '-z', old, new],
+            cwd=git_dir)
+    return [p.decode() for p in out.split(b'\0') if p]
+
+
+def excluded(path, patterns):
+    """
+    Match path against rsync-style exclude patterns. Patterns ending
+    with '/' match directories only, patterns containing '/' match
+    from the top, others match any path component.
+    """
+    parts = path.split('/')
+    for i, name in enumerate(parts, 1):
+        for pat in patterns:
+            if pat.endswith('/'):
+                if i == len(parts):
+                    continue
+                pat = pat[:-1]
+            if '/' in pat:
+                if fnmatch.fnmatchcase('/'.join(parts[:i]),
+                                       pat.lstrip('/')):
+                    return True
+            elif fnmatch.fnmatchcase(name, pat):
+                return True
+    return False
+
+
+def remove(dst, src_root, dst_root, path):
+    """Remove path from dst, along with directories gone from source."""
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        return False
+    except IsADirectoryError:
+        shutil.rmtree(dst)
+    d = os.path.dirname(path)
+    while d and not os.path.isdir(os.path.join(src_root, d)):
+        try:
+            os.rmdir(os.path.join(dst_root, d))
+        except OSError:
+            break
+        d = os.path.dirname(d)
+    return True
+
+
+def link_or_copy(src, dst):
+    """Replace dst with src, atomically."""
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    else:
+        try:
+            if os.path.samefile(src, dst):
+                return False
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    tmp = os.path.join(os.path.dirname(dst),
+                       '.{}.stage'.format(os.path.basename(dst)))
+    try:
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), tmp)
+        else:
+            try:
+                os.link(src, tmp, follow_symlinks=False)
+            except OSError:
+                # different filesystem, or hardlinks not permitted
+                subprocess.check_call(['cp', '--reflink=auto', '-p', '--',
+                                       src, tmp])
+        os.rename(tmp, dst)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    return True
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Copy changed paths between repository copies')
+    argp.add_argument('-C', '--git-dir',
+                      help='Git repository to take --diff from '
+                           '(default: source)')
+    argp.add_argument('-d', '--diff', nargs=2, metavar=('OLD', 'NEW'),
+                      help='Update paths changed between commits')
+    argp.add_argument('-l', '--list', action='append', default=[],
+                      help='Update paths listed in file (one per line)')
+    argp.add_argument('-x', '--exclude', action='append', default=[],
+                      help='Skip paths matching rsync-style pattern')
+    argp.add_argument('--stage', action='store_true',
+                      help='Stage the updated paths in git index '
+                           'of destination')
+    argp.add_argument('src', help='Source directory')
+    argp.add_argument('dst', help='Destination directory')
+    argp.add_argument('paths', nargs='*', help='Additional paths to update')
+    args = argp.parse_args()
+
+    paths = set(args.paths)
+    if args.diff is not None:
+        paths.update(git_diff_paths(args.git_dir or args.src, *args.diff))
+    for l in args.list:
+        with open(l) as f:
+            paths.update(x.rstrip('\n') for x in f if x.strip())
+
+    updated = 0
+    removed = 0
+    staged = []
+    for path in sorted(paths):
+        if excluded(path, args.exclude):
+            continue
+        src = os.path.join(args.src, path)
+        dst = os.path.join(args.dst, path)
+        if os.path.lexists(src):
+            if os.path.isdir(src) and not os.path.islink(src):
+                # replaced by a directory, its files are listed too
+                if os.path.lexists(dst) and not os.path.isdir(dst):
+                    os.unlink(dst)
+                continue
+            if link_or_copy(src, dst):
+                updated += 1
+        elif remove(dst, args.src, args.dst, path):
+            removed += 1
+        staged.append(path)
+
+    if args.stage and staged:
+        subprocess.run(['git', 'update-index', '--add', '--remove', '-z',
+                        '--stdin'],
+                       input=''.join(p + '\0' for p in staged).encode(),
+                       cwd=args.dst, check=True)
+
+    print('{}: {} paths updated, {} removed'.format(args.dst, updated,
+                                                    removed),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# Keep data subrepos (dtd, glsa...) and fetched files in a mirror
+# up-to-date cheaply. Subrepos are checked with 'git ls-remote' first,
+# and fetched and grafted into the branch with plumbing only when their
+# head moved, instead of 'git subtree pull' walking the history on every
+# run. Files are fetched with conditional requests. The last merged
+# commits and HTTP validators are cached in .git/subrepo.json, along
+# with the paths, so that mirror-merge.py keeps them.
+
+import argparse
+import email.utils
+import hashlib
+import json
+import os
+import os.path
+import sys
+import urllib.error
+import urllib.request
+
+from gittree import commit_tree, git, ls_tree, overlay, rev_parse
+
+
+STATE_FILE = 'subrepo.json'
+
+
+class State(object):
+    def __init__(self, git_dir):
+        self.path = os.path.join(
+                git(git_dir, 'rev-parse', '--absolute-git-dir').decode()
+                .strip(), STATE_FILE)
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.data = {}
+        self.data.setdefault('subtrees', {})
+        self.data.setdefault('files', {})
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def remote_head(url, branch):
+    out = git('.', 'ls-remote', '--', url, 'refs/heads/' + branch)
+    if not out.strip():
+        raise ValueError('{}: branch {} not found'.format(url, branch))
+    return out.split()[0].decode()
+
+
+def cmd_pull(args):
+    state = State(args.git_dir)
+    path = args.path.rstrip('/')
+    cached = state.data['subtrees'].get(path, {})
+    ref = git(args.git_dir, 'symbolic-ref', 'HEAD').decode().strip()
+    head = rev_parse(args.git_dir, ref)
+    current = ls_tree(args.git_dir, head, [path]).get(path.encode())
+
+    remote = remote_head(args.url, args.branch)
+    if (cached.get('commit') == remote and cached.get('url') == args.url
+            and current is not None):
+        print('{}: up-to-date at {}'.format(path, remote), file=sys.stderr)
+        return 0
+
+    if rev_parse(args.git_dir, remote + '^{commit}') is None:
+        git(args.git_dir, 'fetch', '-q', '--no-tags', '--', args.url,
+            '+refs/heads/{}:refs/subrepo/{}'.format(args.branch, path))
+    tree = rev_parse(args.git_dir, remote + '^{tree}')
+    if current is None or current.split()[2].decode() != tree:
+        new_tree = overlay(args.git_dir,
+                           rev_parse(args.git_dir, head + '^{tree}'),
+                           {path.encode(): b'040000 tree ' + tree.encode()})
+        # trailers as used by git subtree, so that it still works
+        message = '''{} '{}/' from commit '{}'
+
+git-subtree-dir: {}
+git-subtree-mainline: {}
+git-subtree-split: {}
+'''.format('Update' if current is not None else 'Add', path, remote,
+           path, head, remote)
+        new = commit_tree(args.git_dir, new_tree.decode(), (head, remote),
+                          message)
+        git(args.git_dir, 'update-ref', '-m', 'update-subrepo: ' + path,
+            ref, new, head)
+        git(args.git_dir, 'read-tree', '--reset', '-u', new)
+        print('{}: updated to {}'.format(path, remote), file=sys.stderr)
+    else:
+        print('{}: tree matches {}'.format(path, remote), file=sys.stderr)
+
+    state.data['subtrees'][path] = {'url': args.url, 'commit': remote}
+    state.save()
+    return 0
+
+
+def cmd_fetch(args):
+    state = State(args.git_dir)
+    path = os.path.normpath(os.path.join(args.dir,
+                                         args.url.rsplit('/', 1)[-1]))
+    dest = os.path.join(args.git_dir, path)
+    cached = state.data['files'].get(args.url, {})
+
+    req = urllib.request.Request(args.url)
+    try:
+        with open(dest, 'rb') as f:
+            current = hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        current = None
+    # validators are good only if the file was not replaced since
+    if current is not None and current == cached.get('sha1'):
+        if cached.get('etag'):
+            req.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            req.add_header('If-Modified-Since', cached['last_modified'])
+        else:
+            req.add_header('If-Modified-Since', email.utils.formatdate(
+                os.stat(dest).st_mtime, usegmt=True))
+    try:
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            data = resp.read()
+            headers = resp.headers
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        print('{}: not modified'.format(dest), file=sys.stderr)
+        if cached.get('path') != path:
+            cached['path'] = path
+            state.save()
+        return 0
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(dest + '.tmp', dest)
+    state.data['files'][args.url] = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'sha1': hashlib.sha1(data).hexdigest(),
+        'path': path,
+    }
+    state.save()
+    print('{}: fetched {} bytes'.format(dest, len(data)), file=sys.stderr)
+    return 0
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Update subrepos and fetched files in a mirror')
+    argp.add_argument('-C', '--git-dir', default='.',
+                      help='Mirror repository (default: current directory)')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('pull', help='Update subrepo at path')
+    p.add_argument('url', help='Subrepo URL')
+    p.add_argument('path', help='Path in the mirror')
+    p.add_argument('branch', nargs='?', default='master',
+                   help='Subrepo branch (default: master)')
+    p.set_defaults(func=cmd_pull)
+    p = subp.add_parser('fetch', help='Fetch file into directory '
+                                      'if modified')
+    p.add_argument('url', help='File URL')
+    p.add_argument('dir', help='Directory in the mirror')
+    p.set_defaults(func=cmd_fetch)
+
+    args = argp.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,12 +13,26 @@ exec &> "${CRONJOB_STATE_DIR}/${basename}.log"
 
 start=$(date -u "+%Y-%m-%dT%H:%M:%SZ")
 echo "Start: ${start}"
+
+# stages record their timings into a file per run
+. "${SCRIPT_DIR}"/utils/spans.bash
+mkdir -p -- "${SPANS_DIR}"
+export SPANS_JOB=${basename}
+export SPANS_RUN=${basename}@${start}
+export SPANS_FILE=${SPANS_DIR}/${basename}.${start}.jsonl
+start_time=${EPOCHREALTIME}
+
 bash "${script}"
 ret=${?}
 stop=$(date -u "+%Y-%m-%dT%H:%M:%SZ")
 echo "Stop: ${stop} (exited with ${ret})"
 
 echo "${start} ${stop}" >> "${CRONJOB_STATE_DIR}/${basename}.times"
+span_record run "" "${start_time}" "${EPOCHREALTIME}" "${ret}"
+find "${SPANS_DIR}" -name '*.jsonl' -mtime +"${SPANS_KEEP_DAYS}" -delete
+if [[ ${SPANS_PROMETHEUS_FILE} ]]; then
+	"${SCRIPT_DIR}"/utils/spans.py prometheus -o "${SPANS_PROMETHEUS_FILE}"
+fi
 
 if [[ ${ret} -ne 0 ]]; then
 	# close logs
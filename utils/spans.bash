@@ -0,0 +1,29 @@
+# Span recording for the cron job scripts, source it and use:
+#
+#   span <stage> <repo> <command>...
+#
+# to run the command and append its timing to ${SPANS_FILE} (set
+# by run-cronjob.sh) as a JSON line.  <repo> may be empty.  The exit
+# status of the command is preserved.  See utils/spans.py for reports.
+
+# span_record <stage> <repo> <start> <end> <status>
+span_record() {
+	[[ ${SPANS_FILE} ]] || return 0
+	local repo=null
+	[[ ! ${2} ]] || repo="\"${2}\""
+	# (EPOCHREALTIME uses the locale decimal separator)
+	printf '{"run":"%s","job":"%s","stage":"%s","repo":%s,"start":%s,"end":%s,"status":%d}\n' \
+		"${SPANS_RUN}" "${SPANS_JOB}" "${1}" "${repo}" \
+		"${3/,/.}" "${4/,/.}" "${5}" >> "${SPANS_FILE}"
+}
+
+span() {
+	local stage=${1}
+	local repo=${2}
+	shift 2
+	local start=${EPOCHREALTIME}
+	local ret
+	"${@}" && ret=0 || ret=${?}
+	span_record "${stage}" "${repo}" "${start}" "${EPOCHREALTIME}" "${ret}"
+	return "${ret}"
+}
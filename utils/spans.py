@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Per-stage timing for the cron jobs. Stages record spans as JSON lines
+# in ${SPANS_FILE}, one file per job run (set up by run-cronjob.sh),
+# either via utils/spans.bash or span() below. The reporter aggregates
+# them into percentiles per stage and repo, exports them as a Prometheus
+# textfile, or renders job runs like the old .times files and vcal.
+#
+# Span fields: run, job, stage, repo (or null), start and end (Unix
+# time) and status (0 on success, exit or HTTP status otherwise).
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import os.path
+import sys
+import time
+
+
+# stage recorded by run-cronjob.sh for the whole job
+RUN_STAGE = 'run'
+QUANTILES = (0.5, 0.9, 0.99)
+METRIC_PREFIX = 'repo_mirror_ci_'
+
+
+def record(stage, start, end, repo=None, status=0):
+    """Append a span to ${SPANS_FILE}, if set."""
+    path = os.environ.get('SPANS_FILE')
+    if not path:
+        return
+    line = json.dumps({
+        'run': os.environ.get('SPANS_RUN', ''),
+        'job': os.environ.get('SPANS_JOB', ''),
+        'stage': stage,
+        'repo': repo,
+        'start': start,
+        'end': end,
+        'status': status,
+    }) + '\n'
+    with open(path, 'a') as f:
+        f.write(line)
+
+
+@contextlib.contextmanager
+def span(stage, repo=None):
+    """Record the enclosed block as a span."""
+    start = time.time()
+    status = 1
+    try:
+        yield
+        status = 0
+    finally:
+        record(stage, start, time.time(), repo, status)
+
+
+def load(paths, since=None):
+    """Yield spans from files, skipping malformed lines."""
+    for path in paths:
+        try:
+            f = open(path)
+        except (IOError, OSError):
+            continue
+        with f:
+            for l in f:
+                try:
+                    s = json.loads(l)
+                    if since is not None and s['start'] < since:
+                        continue
+                except (ValueError, KeyError, TypeError):
+                    continue
+                yield s
+
+
+def percentile(values, q):
+    """Return q-th quantile of sorted values (linear interpolation)."""
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def aggregate(spans):
+    """
+    Return {(job, stage, repo): (sorted durations, failures)}, and
+    {job: last run span}.
+    """
+    groups = {}
+    last_runs = {}
+    for s in spans:
+        key = (s['job'], s['stage'], s.get('repo'))
+        durations, failures = groups.setdefault(key, ([], [0]))
+        durations.append(s['end'] - s['start'])
+        if s.get('status'):
+            failures[0] += 1
+        if (s['stage'] == RUN_STAGE
+                and s['end'] > last_runs.get(s['job'], {}).get('end', 0)):
+            last_runs[s['job']] = s
+    return ({k: (sorted(d), f[0]) for k, (d, f) in groups.items()},
+            last_runs)
+
+
+def labels(**kwargs):
+    return ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in kwargs.items() if v is not None)
+
+
+def iso(ts):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+
+
+def cmd_summary(args, spans):
+    groups, last_runs = aggregate(spans)
+    print('{:<16} {:<16} {:<12} {:>6} {:>9} {:>9} {:>9} {:>9} {:>5}'.format(
+        'job', 'stage', 'repo', 'count', 'p50', 'p90', 'p99', 'max', 'fail'))
+    for (job, stage, repo), (d, failures) in sorted(
+            groups.items(), key=lambda x: tuple(y or '' for y in x[0])):
+        print('{:<16} {:<16} {:<12} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} '
+              '{:>9.1f} {:>5}'.format(job, stage, repo or '-', len(d),
+                                      percentile(d, 0.5),
+                                      percentile(d, 0.9),
+                                      percentile(d, 0.99), d[-1],
+                                      failures))
+
+
+def cmd_prometheus(args, spans):
+    groups, last_runs = aggregate(spans)
+    out = []
+    name = METRIC_PREFIX + 'stage_duration_seconds'
+    out.append('# HELP {} Duration of cron job stages.'.format(name))
+    out.append('# TYPE {} summary'.format(name))
+    for (job, stage, repo), (d, failures) in sorted(
+            groups.items(), key=lambda x: tuple(y or '' for y in x[0])):
+        for q in QUANTILES:
+            out.append('{}{{{}}} {:.3f}'.format(
+                name, labels(job=job, stage=stage, repo=repo, quantile=q),
+                percentile(d, q)))
+        out.append('{}_sum{{{}}} {:.3f}'.format(
+            name, labels(job=job, stage=stage, repo=repo), sum(d)))
+        out.append('{}_count{{{}}} {}'.format(
+            name, labels(job=job, stage=stage, repo=repo), len(d)))
+
+    name = METRIC_PREFIX + 'stage_failures'
+    out.append('# HELP {} Number of failed stage runs.'.format(name))
+    out.append('# TYPE {} gauge'.format(name))
+    for (job, stage, repo), (d, failures) in sorted(
+            groups.items(), key=lambda x: tuple(y or '' for y in x[0])):
+        out.append('{}{{{}}} {}'.format(
+            name, labels(job=job, stage=stage, repo=repo), failures))
+
+    for metric, help, value in (
+            ('last_run_end_timestamp_seconds',
+             'End time of the last job run.', lambda s: s['end']),
+            ('last_run_duration_seconds',
+             'Duration of the last job run.',
+             lambda s: s['end'] - s['start']),
+            ('last_run_status', 'Exit status of the last job run.',
+             lambda s: s['status'])):
+        name = METRIC_PREFIX + metric
+        out.append('# HELP {} {}'.format(name, help))
+        out.append('# TYPE {} gauge'.format(name))
+        for job, s in sorted(last_runs.items()):
+            out.append('{}{{{}}} {}'.format(name, labels(job=job),
+                                           round(value(s), 3)))
+
+    data = '\n'.join(out) + '\n'
+    if args.output == '-':
+        sys.stdout.write(data)
+    else:
+        # the textfile collector may read it any time
+        with open(args.output + '.tmp', 'w') as f:
+            f.write(data)
+        os.rename(args.output + '.tmp', args.output)
+
+
+def matching(args, spans):
+    for s in spans:
+        if s['stage'] != args.stage:
+            continue
+        if args.job is not None and s['job'] != args.job:
+            continue
+        yield s
+
+
+def cmd_times(args, spans):
+    """Print '<start> <stop>' lines, like <job>.times files."""
+    for s in sorted(matching(args, spans), key=lambda s: s['start']):
+        print('{} {}'.format(iso(s['start']), iso(s['end'])))
+
+
+def cmd_vcal(args, spans):
+    """Print spans as vCalendar events, like utils/times2vcal.awk."""
+    print('BEGIN:VCALENDAR')
+    print('VERSION:1.0')
+    counts = {}
+    for s in sorted(matching(args, spans), key=lambda s: s['start']):
+        category = '/'.join(x for x in (s['job'], s.get('repo'))
+                            if x)
+        counts[category] = counts.get(category, 0) + 1
+        print('BEGIN:VEVENT')
+        print('DTSTART:' + iso(s['start']).replace('-', '').replace(':', ''))
+        print('DTEND:' + iso(s['end']).replace('-', '').replace(':', ''))
+        print('SUMMARY:{} ({})'.format(category, counts[category]))
+        print('CATEGORIES:' + category)
+        print('END:VEVENT')
+    print('END:VCALENDAR')
+
+
+def main():
+    argp = argparse.ArgumentParser(
+            description='Report cron job stage timings')
+    argp.add_argument('-d', '--dir',
+                      default=os.environ.get('SPANS_DIR', '.'),
+                      help='Directory with span files (default: $SPANS_DIR)')
+    argp.add_argument('--days', type=float, default=7,
+                      help='Use spans from that many last days '
+                           '(default: 7)')
+    argp.add_argument('-f', '--file', action='append', default=[],
+                      help='Span file (default: all in --dir)')
+    subp = argp.add_subparsers(dest='command', required=True)
+
+    p = subp.add_parser('summary', help='Print percentiles per stage '
+                                        'and repo')
+    p.set_defaults(func=cmd_summary)
+    p = subp.add_parser('prometheus', help='Write Prometheus textfile')
+    p.add_argument('-o', '--output', default='-',
+                   help='Output file, replaced atomically (default: stdout)')
+    p.set_defaults(func=cmd_prometheus)
+    for name, func, help in (
+            ('times', cmd_times, 'Print spans like .times files'),
+            ('vcal', cmd_vcal, 'Print spans as vCalendar')):
+        p = subp.add_parser(name, help=help)
+        p.add_argument('-j', '--job', help='Only spans of this job')
+        p.add_argument('-s', '--stage', default=RUN_STAGE,
+                       help='Stage to print (default: whole job runs)')
+        p.set_defaults(func=func)
+
+    args = argp.parse_args()
+    files = args.file or sorted(glob.glob(os.path.join(args.dir,
+                                                        '*.jsonl')))
+    since = time.time() - args.days * 86400 if args.days else None
+    return args.func(args, list(load(files, since)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())